@@ -0,0 +1,235 @@
+package api
+
+import (
+	"bufio"
+	"context"
+	"math/rand"
+	"net"
+	"net/http"
+	"sync/atomic"
+	"time"
+)
+
+/*
+Structured access log.
+Sampled requests produce one record each once their response has been written.
+Records go into a fixed-size ring where writers claim slots with atomics and
+never block. When the ring is full, new records are dropped and counted.
+Records are drained in batches over CFFI.
+*/
+
+const (
+	defaultAccessLogSize            = 4096
+	accessKey            contextKey = "access"
+)
+
+type AccessRecord struct {
+	Time        time.Time `json:"time"`
+	Instance    string    `json:"instance"`
+	Session     string    `json:"session,omitempty"`
+	Method      string    `json:"method"`
+	Host        string    `json:"host"`
+	Fingerprint string    `json:"fingerprint,omitempty"`
+	Status      int       `json:"status"`
+	BytesIn     uint64    `json:"bytes_in"`
+	BytesOut    uint64    `json:"bytes_out"`
+	// Seconds until the upstream response headers, and until the response was sent
+	FirstByte float64 `json:"first_byte"`
+	Duration  float64 `json:"duration"`
+	Injected  bool    `json:"injected"`
+	Error     string  `json:"error,omitempty"`
+	// hit, revalidated or miss for requests that could use the response cache
+	Cache string `json:"cache,omitempty"`
+}
+
+// A record being filled in while its request is served
+type accessEntry struct {
+	AccessRecord
+	// The upstream body may be read on another goroutine when streaming
+	bytesIn atomic.Uint64
+}
+
+type AccessLogBatch struct {
+	Records []AccessRecord `json:"records"`
+	// Records dropped because the ring was full, since the instance started
+	Dropped uint64 `json:"dropped"`
+	Error   string `json:"error,omitempty"`
+}
+
+type accessLog struct {
+	instance string
+	sample   float64
+	ring     *accessRing
+}
+
+// Returns nil if the access log is disabled
+func newAccessLog(Flags *ProxySetup) *accessLog {
+	if !Flags.AccessLog {
+		return nil
+	}
+	size := Flags.AccessLogSize
+	if size <= 0 {
+		size = defaultAccessLogSize
+	}
+	sample := Flags.AccessLogSample
+	if sample <= 0 || sample > 1 {
+		sample = 1
+	}
+	return &accessLog{instance: Flags.Id, sample: sample, ring: newAccessRing(size)}
+}
+
+// Handler records sampled proxied requests handled by next
+func (l *accessLog) Handler(next http.Handler) http.Handler {
+	if l == nil {
+		return next
+	}
+	return http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		// CONNECTs are recorded by the requests inside them, and requests for
+		// the proxy itself aren't recorded
+		if r.Method == http.MethodConnect || !r.URL.IsAbs() || (l.sample < 1 && rand.Float64() >= l.sample) {
+			next.ServeHTTP(w, r)
+			return
+		}
+		entry := &accessEntry{AccessRecord: AccessRecord{
+			Time:     time.Now(),
+			Instance: l.instance,
+			Method:   r.Method,
+			Host:     r.URL.Host,
+		}}
+		writer := &accessWriter{ResponseWriter: w, record: &entry.AccessRecord}
+		next.ServeHTTP(writer, r.WithContext(context.WithValue(r.Context(), accessKey, entry)))
+
+		if entry.Status == 0 && entry.Error == "" {
+			entry.Status = http.StatusOK
+		}
+		entry.BytesIn = entry.bytesIn.Load()
+		entry.Duration = time.Since(entry.Time).Seconds()
+		l.ring.Push(&entry.AccessRecord)
+	})
+}
+
+func (l *accessLog) Drain(limit int) AccessLogBatch {
+	return AccessLogBatch{Records: l.ring.Drain(limit), Dropped: l.ring.dropped.Load()}
+}
+
+// Returns the record of a request, or nil if it isn't sampled.
+// Other than bytesIn, it is only touched by the goroutine serving the request.
+func accessRecordFrom(ctx context.Context) *accessEntry {
+	entry, _ := ctx.Value(accessKey).(*accessEntry)
+	return entry
+}
+
+// Captures the status and counts the bytes written to the client
+type accessWriter struct {
+	http.ResponseWriter
+	record *AccessRecord
+}
+
+func (w *accessWriter) WriteHeader(status int) {
+	if w.record.Status == 0 {
+		w.record.Status = status
+	}
+	w.ResponseWriter.WriteHeader(status)
+}
+
+func (w *accessWriter) Write(p []byte) (int, error) {
+	if w.record.Status == 0 {
+		w.record.Status = http.StatusOK
+	}
+	n, err := w.ResponseWriter.Write(p)
+	w.record.BytesOut += uint64(n)
+	return n, err
+}
+
+func (w *accessWriter) Flush() {
+	if flusher, ok := w.ResponseWriter.(http.Flusher); ok {
+		flusher.Flush()
+	}
+}
+
+// Hijack hands the connection over for WebSocket upgrades goproxy relays itself
+func (w *accessWriter) Hijack() (net.Conn, *bufio.ReadWriter, error) {
+	conn, rw, err := http.NewResponseController(w.ResponseWriter).Hijack()
+	if err == nil && w.record.Status == 0 {
+		w.record.Status = http.StatusSwitchingProtocols
+	}
+	return conn, rw, err
+}
+
+func (w *accessWriter) Unwrap() http.ResponseWriter {
+	return w.ResponseWriter
+}
+
+/*
+Bounded multi-producer, multi-consumer ring.
+Each slot carries a sequence number telling whether it is free for the
+writer at a position, or holds the record for the reader at that position.
+*/
+
+type accessRing struct {
+	mask    uint64
+	slots   []accessSlot
+	head    atomic.Uint64
+	tail    atomic.Uint64
+	dropped atomic.Uint64
+}
+
+type accessSlot struct {
+	seq    atomic.Uint64
+	record AccessRecord
+}
+
+func newAccessRing(size int) *accessRing {
+	// Round up to a power of two so positions map to slots with a mask
+	capacity := 1
+	for capacity < size {
+		capacity <<= 1
+	}
+	r := &accessRing{mask: uint64(capacity - 1), slots: make([]accessSlot, capacity)}
+	for i := range r.slots {
+		r.slots[i].seq.Store(uint64(i))
+	}
+	return r
+}
+
+// Push copies a record into the ring, dropping it if the ring is full
+func (r *accessRing) Push(record *AccessRecord) bool {
+	for {
+		pos := r.head.Load()
+		slot := &r.slots[pos&r.mask]
+		seq := slot.seq.Load()
+		if seq == pos {
+			if r.head.CompareAndSwap(pos, pos+1) {
+				slot.record = *record
+				slot.seq.Store(pos + 1)
+				return true
+			}
+		} else if seq < pos {
+			// The slot still holds a record from the previous lap
+			r.dropped.Add(1)
+			return false
+		}
+		// Another writer claimed the position first, retry with the next one
+	}
+}
+
+// Drain removes up to limit records, oldest first
+func (r *accessRing) Drain(limit int) []AccessRecord {
+	records := make([]AccessRecord, 0, max(0, min(limit, len(r.slots))))
+	for len(records) < limit {
+		pos := r.tail.Load()
+		slot := &r.slots[pos&r.mask]
+		seq := slot.seq.Load()
+		if seq == pos+1 {
+			if r.tail.CompareAndSwap(pos, pos+1) {
+				records = append(records, slot.record)
+				slot.record = AccessRecord{}
+				slot.seq.Store(pos + r.mask + 1)
+			}
+		} else if seq < pos+1 {
+			// Empty, or the next writer hasn't finished copying its record
+			break
+		}
+	}
+	return records
+}
@@ -0,0 +1,173 @@
+package api
+
+import (
+	"bufio"
+	"io"
+	"net"
+	"net/http"
+	"net/http/httptest"
+	"sync"
+	"testing"
+	"time"
+)
+
+// Records are numbered through BytesIn so they can be told apart
+func pushRecords(r *accessRing, from, n int) (pushed int) {
+	for i := from; i < from+n; i++ {
+		if r.Push(&AccessRecord{BytesIn: uint64(i)}) {
+			pushed++
+		}
+	}
+	return pushed
+}
+
+func TestAccessRing(t *testing.T) {
+	// Rounds of pushes followed by a drain
+	type round struct {
+		push, drain int
+		// Expected first record and count drained, and the dropped total so far
+		first, drained int
+		dropped        uint64
+	}
+	tests := []struct {
+		name   string
+		size   int
+		rounds []round
+	}{
+		{"empty", 4, []round{{0, 4, 0, 0, 0}}},
+		{"drain 0", 4, []round{{3, 0, 0, 0, 0}, {0, 4, 0, 3, 0}}},
+		{"partial drain", 4, []round{{3, 2, 0, 2, 0}, {0, 4, 2, 1, 0}}},
+		{"full", 4, []round{{6, 10, 0, 4, 2}}},
+		{"drops are counted once dropped", 4, []round{{6, 0, 0, 0, 2}, {1, 10, 0, 4, 3}}},
+		{"size rounded up", 3, []round{{5, 10, 0, 4, 1}}},
+		{"wraparound", 4, []round{{3, 3, 0, 3, 0}, {3, 3, 3, 3, 0}, {4, 4, 6, 4, 0}, {5, 1, 10, 1, 1}, {0, 4, 11, 3, 1}}},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			ring := newAccessRing(tt.size)
+			next := 0
+			for i, rd := range tt.rounds {
+				next += pushRecords(ring, next, rd.push)
+				records := ring.Drain(rd.drain)
+				if len(records) != rd.drained {
+					t.Fatalf("round %d: drained %d records, want %d", i, len(records), rd.drained)
+				}
+				for j, record := range records {
+					if record.BytesIn != uint64(rd.first+j) {
+						t.Fatalf("round %d: record %d is %d, want %d", i, j, record.BytesIn, rd.first+j)
+					}
+				}
+				if dropped := ring.dropped.Load(); dropped != rd.dropped {
+					t.Fatalf("round %d: dropped %d, want %d", i, dropped, rd.dropped)
+				}
+			}
+		})
+	}
+}
+
+func TestAccessRingConcurrent(t *testing.T) {
+	const writers, perWriter = 8, 2000
+	ring := newAccessRing(64)
+
+	var wg sync.WaitGroup
+	var pushed [writers]int
+	for w := 0; w < writers; w++ {
+		wg.Add(1)
+		go func(w int) {
+			defer wg.Done()
+			pushed[w] = pushRecords(ring, w*perWriter, perWriter)
+		}(w)
+	}
+
+	// Two readers drain while the writers push
+	done := make(chan struct{})
+	var mu sync.Mutex
+	var drained []AccessRecord
+	var readers sync.WaitGroup
+	for i := 0; i < 2; i++ {
+		readers.Add(1)
+		go func() {
+			defer readers.Done()
+			for {
+				select {
+				case <-done:
+					return
+				default:
+				}
+				if records := ring.Drain(16); len(records) > 0 {
+					mu.Lock()
+					drained = append(drained, records...)
+					mu.Unlock()
+				}
+			}
+		}()
+	}
+	wg.Wait()
+	close(done)
+	readers.Wait()
+	drained = append(drained, ring.Drain(len(ring.slots))...)
+
+	seen := make(map[uint64]bool, len(drained))
+	for _, record := range drained {
+		if seen[record.BytesIn] {
+			t.Fatalf("record %d was drained twice", record.BytesIn)
+		}
+		seen[record.BytesIn] = true
+	}
+	total := 0
+	for _, n := range pushed {
+		total += n
+	}
+	if len(seen) != total {
+		t.Errorf("drained %d records, %d were pushed", len(seen), total)
+	}
+	if dropped := ring.dropped.Load(); uint64(total)+dropped != writers*perWriter {
+		t.Errorf("%d pushed and %d dropped out of %d", total, dropped, writers*perWriter)
+	}
+	if records := ring.Drain(1); len(records) != 0 {
+		t.Error("ring should be empty")
+	}
+}
+
+// goproxy hijacks the client connection for plain HTTP WebSockets
+func TestAccessWriterHijack(t *testing.T) {
+	log := newAccessLog(&ProxySetup{AccessLog: true})
+	server := httptest.NewServer(log.Handler(http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		conn, rw, err := w.(http.Hijacker).Hijack()
+		if err != nil {
+			t.Error(err)
+			return
+		}
+		defer conn.Close()
+		rw.WriteString("HTTP/1.1 101 Switching Protocols\r\n\r\n")
+		rw.Flush()
+	})))
+	defer server.Close()
+
+	conn, err := net.Dial("tcp", server.Listener.Addr().String())
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer conn.Close()
+	io.WriteString(conn, "GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n\r\n")
+	resp, err := http.ReadResponse(bufio.NewReader(conn), nil)
+	if err != nil {
+		t.Fatal(err)
+	}
+	if resp.StatusCode != http.StatusSwitchingProtocols {
+		t.Fatalf("status = %d", resp.StatusCode)
+	}
+
+	// The record is pushed once the handler returns
+	var records []AccessRecord
+	for i := 0; i < 1000 && len(records) == 0; i++ {
+		time.Sleep(time.Millisecond)
+		records = log.Drain(1).Records
+	}
+	if len(records) == 0 {
+		t.Fatal("request wasn't recorded")
+	}
+	if records[0].Status != http.StatusSwitchingProtocols {
+		t.Errorf("recorded status %d, want 101", records[0].Status)
+	}
+}
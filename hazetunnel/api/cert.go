@@ -3,9 +3,12 @@ package api
 import (
 	"crypto/tls"
 	"crypto/x509"
+	"fmt"
 	"log"
 	"os"
+	"path/filepath"
 	"sync"
+	"time"
 
 	"github.com/elazarl/goproxy"
 
@@ -18,28 +21,35 @@ var (
 	caLoadMux sync.Mutex
 )
 
+// Locks older than this were left behind by a process that died while generating
+const caLockTimeout = 30 * time.Second
+
 func fileExists(filename string) bool {
 	_, err := os.Stat(filename)
 	return !os.IsNotExist(err)
 }
 
-func setGoproxyCA(tlsCert tls.Certificate) {
+func setGoproxyCA(tlsCert tls.Certificate) error {
 	var err error
 	if tlsCert.Leaf, err = x509.ParseCertificate(tlsCert.Certificate[0]); err != nil {
-		log.Fatal("Unable to parse ca", err)
+		return fmt.Errorf("unable to parse CA: %w", err)
 	}
 
+	// Leaf certificates signed by a previous CA are no longer valid
+	resetLeafCertCache(&tlsCert)
+
 	goproxy.GoproxyCa = tlsCert
-	goproxy.OkConnect = &goproxy.ConnectAction{Action: goproxy.ConnectAccept, TLSConfig: goproxy.TLSConfigFromCA(&tlsCert)}
-	goproxy.MitmConnect = &goproxy.ConnectAction{Action: goproxy.ConnectMitm, TLSConfig: goproxy.TLSConfigFromCA(&tlsCert)}
-	goproxy.HTTPMitmConnect = &goproxy.ConnectAction{Action: goproxy.ConnectHTTPMitm, TLSConfig: goproxy.TLSConfigFromCA(&tlsCert)}
-	goproxy.RejectConnect = &goproxy.ConnectAction{Action: goproxy.ConnectReject, TLSConfig: goproxy.TLSConfigFromCA(&tlsCert)}
+	goproxy.OkConnect = &goproxy.ConnectAction{Action: goproxy.ConnectAccept, TLSConfig: mitmTLSConfig}
+	goproxy.MitmConnect = &goproxy.ConnectAction{Action: goproxy.ConnectMitm, TLSConfig: mitmTLSConfig}
+	goproxy.HTTPMitmConnect = &goproxy.ConnectAction{Action: goproxy.ConnectHTTPMitm, TLSConfig: mitmTLSConfig}
+	goproxy.RejectConnect = &goproxy.ConnectAction{Action: goproxy.ConnectReject, TLSConfig: mitmTLSConfig}
 	caLoaded = true
+	return nil
 }
 
-func loadCA() {
+func loadCA() error {
 	if caLoaded {
-		return // Skip if cert already loaded
+		return nil // Skip if cert already loaded
 	}
 	caLoadMux.Lock()
 	defer caLoadMux.Unlock()
@@ -56,32 +66,83 @@ func loadCA() {
 	if fileExists(Config.Cert) && fileExists(Config.Key) {
 		tlsCert, err := tls.LoadX509KeyPair(Config.Cert, Config.Key)
 		if err != nil {
-			log.Fatal("Unable to load CA certificate and key", err)
+			return fmt.Errorf("unable to load CA certificate and key: %w", err)
 		}
-		setGoproxyCA(tlsCert)
-		return
+		return setGoproxyCA(tlsCert)
 	}
 
-	// If only only file exists, warn the user
-	if fileExists(Config.Cert) {
-		log.Fatalf("CA certificate exists, but found no corresponding key at %s", Config.Key)
-	} else if fileExists(Config.Key) {
-		log.Fatalf("CA key exists, but found no corresponding certificate at %s", Config.Cert)
+	// If only only file exists, warn the user, unless another process is still writing them
+	if !fileExists(caLockPath()) {
+		if fileExists(Config.Cert) {
+			return fmt.Errorf("CA certificate exists, but found no corresponding key at %s", Config.Key)
+		} else if fileExists(Config.Key) {
+			return fmt.Errorf("CA key exists, but found no corresponding certificate at %s", Config.Cert)
+		}
 	}
 
-	// Generate new CA files
-	log.Println("No CA found, generating certificate and key")
-	tlsCert, err := generateCA()
+	// Generate new CA files, or wait for another process to
+	tlsCert, err := createCA()
 	if err != nil {
-		log.Fatal("Unable to generate CA certificate and key", err)
+		return fmt.Errorf("unable to generate CA certificate and key: %w", err)
+	}
+	return setGoproxyCA(tlsCert)
+}
+
+func caLockPath() string {
+	return Config.Cert + ".lock"
+}
+
+// Generates and persists a CA once. Processes sharing the same key pair paths
+// wait for whichever one holds the lock file, then load its CA.
+func createCA() (tls.Certificate, error) {
+	lockPath := caLockPath()
+	for {
+		lock, err := os.OpenFile(lockPath, os.O_WRONLY|os.O_CREATE|os.O_EXCL, 0600)
+		if err == nil {
+			defer os.Remove(lockPath)
+			lock.Close()
+			// Another process may have finished while this one was waiting
+			if fileExists(Config.Cert) && fileExists(Config.Key) {
+				return tls.LoadX509KeyPair(Config.Cert, Config.Key)
+			}
+			log.Println("No CA found, generating certificate and key")
+			return generateCA()
+		}
+		if !os.IsExist(err) {
+			return tls.Certificate{}, err
+		}
+		if info, err := os.Stat(lockPath); err == nil && time.Since(info.ModTime()) > caLockTimeout {
+			os.Remove(lockPath)
+			continue
+		}
+		time.Sleep(50 * time.Millisecond)
+	}
+}
+
+// Key request for a new CA, cfssl's default (ECDSA P-256) unless configured
+func caKeyRequest() (*cfsr.KeyRequest, error) {
+	request := cfsr.NewKeyRequest()
+	switch Config.CAKeyType {
+	case "", "ecdsa":
+	case "rsa":
+		request = &cfsr.KeyRequest{A: "rsa", S: 2048}
+	default:
+		return nil, fmt.Errorf("unknown CA key type: %s", Config.CAKeyType)
 	}
-	setGoproxyCA(tlsCert)
+	if Config.CAKeySize != 0 {
+		request.S = Config.CAKeySize
+	}
+	return request, nil
 }
 
 func generateCA() (tls.Certificate, error) {
+	keyRequest, err := caKeyRequest()
+	if err != nil {
+		return tls.Certificate{}, err
+	}
 	csr := cfsr.CertificateRequest{
 		CN:         "tlsproxy CA",
-		KeyRequest: cfsr.NewKeyRequest(),
+		KeyRequest: keyRequest,
 	}
 
 	certPEM, _, keyPEM, err := initca.New(&csr)
@@ -89,26 +150,34 @@ func generateCA() (tls.Certificate, error) {
 		return tls.Certificate{}, err
 	}
 
-	caOut, err := os.Create(Config.Cert)
-	if err != nil {
+	// The key is written first, the pair is only loaded once both exist
+	if err := writeFileAtomic(Config.Key, keyPEM, 0600); err != nil {
 		return tls.Certificate{}, err
 	}
-	defer caOut.Close()
-	_, err = caOut.Write(certPEM)
-	if err != nil {
+	if err := writeFileAtomic(Config.Cert, certPEM, 0644); err != nil {
 		return tls.Certificate{}, err
 	}
 
-	keyOut, err := os.OpenFile(Config.Key, os.O_WRONLY|os.O_CREATE|os.O_TRUNC, 0600)
-	if err != nil {
-		return tls.Certificate{}, err
-	}
-	defer keyOut.Close()
+	return tls.X509KeyPair(certPEM, keyPEM)
+}
 
-	_, err = keyOut.Write(keyPEM)
+// Writes to a temporary file and renames it, so readers never see a partial file
+func writeFileAtomic(path string, data []byte, perm os.FileMode) error {
+	tmp, err := os.CreateTemp(filepath.Dir(path), filepath.Base(path)+".*.tmp")
 	if err != nil {
-		return tls.Certificate{}, err
+		return err
 	}
-
-	return tls.X509KeyPair(certPEM, keyPEM)
+	defer os.Remove(tmp.Name())
+	if _, err := tmp.Write(data); err != nil {
+		tmp.Close()
+		return err
+	}
+	if err := tmp.Chmod(perm); err != nil {
+		tmp.Close()
+		return err
+	}
+	if err := tmp.Close(); err != nil {
+		return err
+	}
+	return os.Rename(tmp.Name(), path)
 }
@@ -0,0 +1,329 @@
+package api
+
+import (
+	"crypto"
+	"crypto/ecdsa"
+	"crypto/elliptic"
+	"crypto/rand"
+	"crypto/rsa"
+	"crypto/tls"
+	"crypto/x509"
+	"crypto/x509/pkix"
+	"fmt"
+	"log"
+	"math/big"
+	"net"
+	"sync"
+	"sync/atomic"
+	"time"
+
+	"github.com/elazarl/goproxy"
+)
+
+/*
+MITM leaf certificate cache.
+Leaf certificates are signed once per hostname and kept in a process-wide LRU.
+Leaf keys are generated ahead of time by a background pool.
+*/
+
+const (
+	defaultCertCacheSize = 1024
+	leafKeyPoolSize      = 16
+)
+
+type CertCacheStats struct {
+	Hits     uint64 `json:"hits"`
+	Misses   uint64 `json:"misses"`
+	Size     int    `json:"size"`
+	Capacity int    `json:"capacity"`
+	KeyType  string `json:"key_type"`
+}
+
+type leafCertCache struct {
+	ca       *tls.Certificate
+	capacity int
+	certs    *lruCache[string, *tls.Certificate]
+	keys     *leafKeyPool
+	hits     atomic.Uint64
+	misses   atomic.Uint64
+
+	// Hostnames being signed, so concurrent misses share one certificate
+	mu      sync.Mutex
+	signing map[string]*pendingLeaf
+}
+
+type pendingLeaf struct {
+	done chan struct{}
+	cert *tls.Certificate
+	err  error
+}
+
+var (
+	leafCerts    *leafCertCache
+	leafCertsMux sync.RWMutex
+)
+
+func newLeafCertCache(ca *tls.Certificate, capacity int, keyType string) *leafCertCache {
+	if capacity <= 0 {
+		capacity = defaultCertCacheSize
+	}
+	return &leafCertCache{
+		ca:       ca,
+		capacity: capacity,
+		certs:    newLRUCache[string, *tls.Certificate](int64(capacity), nil, nil),
+		keys:     newLeafKeyPool(keyType),
+		signing:  make(map[string]*pendingLeaf),
+	}
+}
+
+// Rebuilds the process-wide leaf cache for the current CA and config
+func resetLeafCertCache(ca *tls.Certificate) {
+	leafCertsMux.Lock()
+	defer leafCertsMux.Unlock()
+	if leafCerts != nil {
+		leafCerts.keys.Close()
+	}
+	leafCerts = newLeafCertCache(ca, Config.CertCacheSize, Config.LeafKeyType)
+}
+
+func getLeafCertCache() *leafCertCache {
+	leafCertsMux.RLock()
+	defer leafCertsMux.RUnlock()
+	return leafCerts
+}
+
+// Fetch returns the leaf certificate for hostname, signing one on a miss
+func (c *leafCertCache) Fetch(hostname string) (*tls.Certificate, error) {
+	if cert, ok := c.certs.Get(hostname); ok && time.Now().Before(cert.Leaf.NotAfter) {
+		c.hits.Add(1)
+		return cert, nil
+	}
+	c.misses.Add(1)
+
+	// Browsers open several connections to a host at once
+	c.mu.Lock()
+	if pending, ok := c.signing[hostname]; ok {
+		c.mu.Unlock()
+		<-pending.done
+		return pending.cert, pending.err
+	}
+	pending := &pendingLeaf{done: make(chan struct{})}
+	c.signing[hostname] = pending
+	c.mu.Unlock()
+
+	key, err := c.keys.Get()
+	if err == nil {
+		pending.cert, err = signLeaf(c.ca, hostname, key)
+	}
+	pending.err = err
+	if err == nil {
+		c.certs.Add(hostname, pending.cert)
+	}
+	c.mu.Lock()
+	delete(c.signing, hostname)
+	c.mu.Unlock()
+	close(pending.done)
+	return pending.cert, pending.err
+}
+
+func (c *leafCertCache) Stats() CertCacheStats {
+	return CertCacheStats{
+		Hits:     c.hits.Load(),
+		Misses:   c.misses.Load(),
+		Size:     c.certs.Len(),
+		Capacity: c.capacity,
+		KeyType:  c.keys.keyType,
+	}
+}
+
+// Builds the client-facing TLS config for an intercepted CONNECT.
+// Certificates are picked per SNI, falling back to the CONNECT host.
+func mitmTLSConfig(host string, ctx *goproxy.ProxyCtx) (*tls.Config, error) {
+	cache := getLeafCertCache()
+	if cache == nil {
+		return nil, fmt.Errorf("CA is not loaded")
+	}
+	hostname := host
+	if h, _, err := net.SplitHostPort(host); err == nil {
+		hostname = h
+	}
+	config := &tls.Config{
+		InsecureSkipVerify: true,
+		GetCertificate: func(hello *tls.ClientHelloInfo) (*tls.Certificate, error) {
+			if hello.ServerName != "" {
+				return cache.Fetch(hello.ServerName)
+			}
+			return cache.Fetch(hostname)
+		},
+		CurvePreferences: mitmCurves,
+		CipherSuites:     mitmCipherSuites,
+	}
+	// Share the ticket keys so clients can resume sessions from earlier connections
+	if keys := mitmTicketKeys.Keys(); len(keys) > 0 {
+		config.SetSessionTicketKeys(keys)
+	}
+	return config, nil
+}
+
+// Key exchanges that are cheapest for the proxy, in order of preference
+var mitmCurves = []tls.CurveID{tls.X25519, tls.CurveP256, tls.CurveP384}
+
+// TLS 1.2 suites with forward secrecy, AEADs first. TLS 1.3 suites aren't configurable.
+var mitmCipherSuites = []uint16{
+	tls.TLS_ECDHE_ECDSA_WITH_AES_128_GCM_SHA256,
+	tls.TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256,
+	tls.TLS_ECDHE_ECDSA_WITH_CHACHA20_POLY1305_SHA256,
+	tls.TLS_ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256,
+	tls.TLS_ECDHE_ECDSA_WITH_AES_256_GCM_SHA384,
+	tls.TLS_ECDHE_RSA_WITH_AES_256_GCM_SHA384,
+	tls.TLS_ECDHE_ECDSA_WITH_AES_128_CBC_SHA,
+	tls.TLS_ECDHE_RSA_WITH_AES_128_CBC_SHA,
+	tls.TLS_ECDHE_ECDSA_WITH_AES_256_CBC_SHA,
+	tls.TLS_ECDHE_RSA_WITH_AES_256_CBC_SHA,
+}
+
+/*
+Client-facing session ticket keys.
+Keys only live in memory. A new key is used for new tickets every rotation
+interval, and older keys are kept to decrypt tickets until they age out.
+*/
+
+const (
+	ticketKeyRotation = time.Hour
+	// Tickets stay valid for up to this many rotations
+	ticketKeyCount = 4
+)
+
+var mitmTicketKeys ticketKeyRing
+
+type ticketKeyRing struct {
+	mu      sync.Mutex
+	keys    [][32]byte
+	rotated time.Time
+}
+
+// Keys returns the current keys, newest first, rotating them if they are due.
+// The current keys are kept if a new one can't be generated, and there are
+// none if that happens before the first rotation.
+func (r *ticketKeyRing) Keys() [][32]byte {
+	r.mu.Lock()
+	defer r.mu.Unlock()
+	if len(r.keys) == 0 || time.Since(r.rotated) >= ticketKeyRotation {
+		var key [32]byte
+		if _, err := rand.Read(key[:]); err != nil {
+			log.Printf("Unable to generate session ticket key: %v", err)
+			return r.keys
+		}
+		keys := make([][32]byte, 0, ticketKeyCount)
+		keys = append(keys, key)
+		keys = append(keys, r.keys[:min(len(r.keys), ticketKeyCount-1)]...)
+		r.keys, r.rotated = keys, time.Now()
+	}
+	return r.keys
+}
+
+func signLeaf(ca *tls.Certificate, hostname string, key crypto.Signer) (*tls.Certificate, error) {
+	serial, err := rand.Int(rand.Reader, new(big.Int).Lsh(big.NewInt(1), 128))
+	if err != nil {
+		return nil, err
+	}
+	now := time.Now()
+	template := &x509.Certificate{
+		SerialNumber: serial,
+		Issuer:       ca.Leaf.Subject,
+		Subject: pkix.Name{
+			CommonName:   hostname,
+			Organization: []string{"Hazetunnel MITM proxy"},
+		},
+		NotBefore:             now.Add(-30 * 24 * time.Hour),
+		NotAfter:              now.Add(365 * 24 * time.Hour),
+		KeyUsage:              x509.KeyUsageDigitalSignature | x509.KeyUsageKeyEncipherment,
+		ExtKeyUsage:           []x509.ExtKeyUsage{x509.ExtKeyUsageServerAuth},
+		BasicConstraintsValid: true,
+	}
+	if ip := net.ParseIP(hostname); ip != nil {
+		template.IPAddresses = []net.IP{ip}
+	} else {
+		template.DNSNames = []string{hostname}
+	}
+
+	der, err := x509.CreateCertificate(rand.Reader, template, ca.Leaf, key.Public(), ca.PrivateKey)
+	if err != nil {
+		return nil, err
+	}
+	leaf, err := x509.ParseCertificate(der)
+	if err != nil {
+		return nil, err
+	}
+	return &tls.Certificate{
+		Certificate: [][]byte{der, ca.Certificate[0]},
+		PrivateKey:  key,
+		Leaf:        leaf,
+	}, nil
+}
+
+/*
+Background pool of pre-generated leaf keys
+*/
+
+type leafKeyPool struct {
+	keyType string
+	keys    chan crypto.Signer
+	done    chan struct{}
+	once    sync.Once
+}
+
+func newLeafKeyPool(keyType string) *leafKeyPool {
+	if keyType != "ecdsa" {
+		keyType = "rsa"
+	}
+	pool := &leafKeyPool{
+		keyType: keyType,
+		keys:    make(chan crypto.Signer, leafKeyPoolSize),
+		done:    make(chan struct{}),
+	}
+	go pool.fill()
+	return pool
+}
+
+// Get returns a pre-generated key, or generates one if the pool is drained
+func (p *leafKeyPool) Get() (crypto.Signer, error) {
+	select {
+	case key := <-p.keys:
+		return key, nil
+	default:
+		return p.generate()
+	}
+}
+
+func (p *leafKeyPool) Close() {
+	p.once.Do(func() { close(p.done) })
+}
+
+func (p *leafKeyPool) fill() {
+	for {
+		key, err := p.generate()
+		if err != nil {
+			// Get generates keys itself in the meantime
+			log.Printf("Unable to generate leaf key: %v", err)
+			select {
+			case <-time.After(time.Second):
+				continue
+			case <-p.done:
+				return
+			}
+		}
+		select {
+		case p.keys <- key:
+		case <-p.done:
+			return
+		}
+	}
+}
+
+func (p *leafKeyPool) generate() (crypto.Signer, error) {
+	if p.keyType == "ecdsa" {
+		return ecdsa.GenerateKey(elliptic.P256(), rand.Reader)
+	}
+	return rsa.GenerateKey(rand.Reader, 2048)
+}
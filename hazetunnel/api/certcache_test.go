@@ -0,0 +1,201 @@
+package api
+
+import (
+	"crypto/ecdsa"
+	"crypto/elliptic"
+	"crypto/rand"
+	"crypto/tls"
+	"crypto/x509"
+	"crypto/x509/pkix"
+	"fmt"
+	"math/big"
+	"net"
+	"runtime"
+	"sync"
+	"testing"
+	"time"
+)
+
+// Self-signed CA for tests and benchmarks, without touching the configured key pair
+func benchCA(b testing.TB) *tls.Certificate {
+	key, err := ecdsa.GenerateKey(elliptic.P256(), rand.Reader)
+	if err != nil {
+		b.Fatal(err)
+	}
+	template := &x509.Certificate{
+		SerialNumber:          big.NewInt(1),
+		Subject:               pkix.Name{CommonName: "hazetunnel bench CA"},
+		NotBefore:             time.Now().Add(-time.Hour),
+		NotAfter:              time.Now().Add(24 * time.Hour),
+		KeyUsage:              x509.KeyUsageCertSign | x509.KeyUsageDigitalSignature,
+		BasicConstraintsValid: true,
+		IsCA:                  true,
+	}
+	der, err := x509.CreateCertificate(rand.Reader, template, template, key.Public(), key)
+	if err != nil {
+		b.Fatal(err)
+	}
+	leaf, err := x509.ParseCertificate(der)
+	if err != nil {
+		b.Fatal(err)
+	}
+	return &tls.Certificate{Certificate: [][]byte{der}, PrivateKey: key, Leaf: leaf}
+}
+
+// Concurrent misses for a hostname share a single signed certificate
+func TestLeafCertCacheFetchConcurrent(t *testing.T) {
+	cache := newLeafCertCache(benchCA(t), defaultCertCacheSize, "ecdsa")
+	defer cache.keys.Close()
+	certs := make([]*tls.Certificate, 8)
+	var wg sync.WaitGroup
+	for i := range certs {
+		wg.Add(1)
+		go func(i int) {
+			defer wg.Done()
+			cert, err := cache.Fetch("example.com")
+			if err != nil {
+				t.Error(err)
+			}
+			certs[i] = cert
+		}(i)
+	}
+	wg.Wait()
+	for _, cert := range certs {
+		if cert == nil || cert != certs[0] {
+			t.Fatal("concurrent fetches signed separate certificates")
+		}
+	}
+	if cert, _ := cache.Fetch("example.com"); cert != certs[0] {
+		t.Fatal("signed certificate wasn't cached")
+	}
+}
+
+func BenchmarkSignLeaf(b *testing.B) {
+	ca := benchCA(b)
+	for _, keyType := range []string{"rsa", "ecdsa"} {
+		b.Run(keyType, func(b *testing.B) {
+			keys := newLeafKeyPool(keyType)
+			defer keys.Close()
+			key, err := keys.Get()
+			if err != nil {
+				b.Fatal(err)
+			}
+			b.ReportAllocs()
+			b.ResetTimer()
+			for i := 0; i < b.N; i++ {
+				if _, err := signLeaf(ca, "example.com", key); err != nil {
+					b.Fatal(err)
+				}
+			}
+		})
+	}
+}
+
+// Issuance including key generation, as on a cold key pool
+func BenchmarkIssueLeaf(b *testing.B) {
+	ca := benchCA(b)
+	for _, keyType := range []string{"rsa", "ecdsa"} {
+		b.Run(keyType, func(b *testing.B) {
+			keys := &leafKeyPool{keyType: keyType}
+			b.ReportAllocs()
+			for i := 0; i < b.N; i++ {
+				key, err := keys.generate()
+				if err != nil {
+					b.Fatal(err)
+				}
+				if _, err := signLeaf(ca, "example.com", key); err != nil {
+					b.Fatal(err)
+				}
+			}
+		})
+	}
+}
+
+func BenchmarkLeafCertCacheFetch(b *testing.B) {
+	cache := newLeafCertCache(benchCA(b), defaultCertCacheSize, "ecdsa")
+	defer cache.keys.Close()
+	hosts := make([]string, 64)
+	for i := range hosts {
+		hosts[i] = fmt.Sprintf("host%d.example.com", i)
+		if _, err := cache.Fetch(hosts[i]); err != nil {
+			b.Fatal(err)
+		}
+	}
+	b.ReportAllocs()
+	b.ResetTimer()
+	b.RunParallel(func(pb *testing.PB) {
+		i := 0
+		for pb.Next() {
+			if _, err := cache.Fetch(hosts[i%len(hosts)]); err != nil {
+				b.Fatal(err)
+			}
+			i++
+		}
+	})
+}
+
+// Client-facing handshakes with the MITM TLS config, reported per core
+func BenchmarkMITMHandshake(b *testing.B) {
+	for _, keyType := range []string{"rsa", "ecdsa"} {
+		for _, mode := range []string{"full", "resumed"} {
+			b.Run(keyType+"/"+mode, func(b *testing.B) {
+				leafCertsMux.Lock()
+				previous := leafCerts
+				leafCerts = newLeafCertCache(benchCA(b), defaultCertCacheSize, keyType)
+				leafCertsMux.Unlock()
+				defer func() {
+					leafCertsMux.Lock()
+					leafCerts.keys.Close()
+					leafCerts = previous
+					leafCertsMux.Unlock()
+				}()
+
+				b.ReportAllocs()
+				b.ResetTimer()
+				b.RunParallel(func(pb *testing.PB) {
+					clientConfig := &tls.Config{InsecureSkipVerify: true, ServerName: "example.com"}
+					if mode == "resumed" {
+						clientConfig.ClientSessionCache = tls.NewLRUClientSessionCache(1)
+					}
+					for pb.Next() {
+						if err := benchHandshake(clientConfig); err != nil {
+							b.Fatal(err)
+						}
+					}
+				})
+				perCore := float64(b.N) / b.Elapsed().Seconds() / float64(runtime.GOMAXPROCS(0))
+				b.ReportMetric(perCore, "handshakes/s/core")
+			})
+		}
+	}
+}
+
+// Runs one handshake over an in-memory pipe. The server sends a byte afterwards
+// so that the client processes any TLS 1.3 session ticket.
+func benchHandshake(clientConfig *tls.Config) error {
+	clientConn, serverConn := net.Pipe()
+	defer clientConn.Close()
+	errs := make(chan error, 1)
+	go func() {
+		defer serverConn.Close()
+		config, err := mitmTLSConfig("example.com:443", nil)
+		if err != nil {
+			errs <- err
+			return
+		}
+		server := tls.Server(serverConn, config)
+		if err = server.Handshake(); err == nil {
+			_, err = server.Write([]byte{0})
+		}
+		errs <- err
+	}()
+
+	client := tls.Client(clientConn, clientConfig)
+	if err := client.Handshake(); err != nil {
+		return err
+	}
+	if _, err := client.Read(make([]byte, 1)); err != nil {
+		return err
+	}
+	return <-errs
+}
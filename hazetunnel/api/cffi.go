@@ -2,17 +2,25 @@ package api
 
 /*
 #include <stdlib.h>
+
+typedef void (*completion_callback)(unsigned long long handle, char *result);
+
+// cgo can't call C function pointers directly
+static inline void call_completion(completion_callback callback, unsigned long long handle, char *result) {
+	callback(handle, result);
+}
 */
+import "C"
 
 import (
-	"C"
+	"fmt"
 	"log"
+	"time"
+	"unsafe"
 
+	"github.com/elazarl/goproxy"
 	json "github.com/goccy/go-json"
 )
-import (
-	"context"
-)
 
 /*
 CFFI exposed methods
@@ -20,7 +28,7 @@ CFFI exposed methods
 
 //export StartServer
 func StartServer(data string) {
-	// Launch server from cffi
+	// Launch server from cffi without waiting for it
 	var Flags ProxySetup
 	err := json.Unmarshal([]byte(data), &Flags)
 	if err != nil {
@@ -28,7 +36,55 @@ func StartServer(data string) {
 		return
 	}
 	UpdateVerbosity()
-	go Launch(&Flags)
+	go func() {
+		if _, err := Start(&Flags); err != nil {
+			log.Printf("Error: Failed to start %v: %v", Flags.Id, err)
+		}
+	}()
+}
+
+//export StartServerSync
+func StartServerSync(data string) *C.char {
+	// Launch server from cffi and report the bound address or the error
+	var result StartResult
+	var Flags ProxySetup
+	if err := json.Unmarshal([]byte(data), &Flags); err != nil {
+		result.Error = err.Error()
+		return marshalResult(result)
+	}
+	UpdateVerbosity()
+	addr, err := Start(&Flags)
+	if err != nil {
+		result.Error = err.Error()
+	} else {
+		result.Addr = addr.IP.String()
+		result.Port = addr.Port
+	}
+	return marshalResult(result)
+}
+
+//export StartServerAsync
+func StartServerAsync(data string, handle C.ulonglong, callback C.completion_callback) {
+	// Launch server from cffi without blocking, reporting the bound address or
+	// the error through the callback once it is listening
+	var result StartResult
+	var Flags ProxySetup
+	if err := json.Unmarshal([]byte(data), &Flags); err != nil {
+		result.Error = err.Error()
+		go complete(callback, handle, result)
+		return
+	}
+	UpdateVerbosity()
+	go func() {
+		addr, err := Start(&Flags)
+		if err != nil {
+			result.Error = err.Error()
+		} else {
+			result.Addr = addr.IP.String()
+			result.Port = addr.Port
+		}
+		complete(callback, handle, result)
+	}()
 }
 
 //export SetVerbose
@@ -57,38 +113,270 @@ func SetKeyPair(data string) {
 	// Update the x509 key pair paths
 	Config.Cert = keypair.Cert
 	Config.Key = keypair.Key
-	// Flag as unloaded
+	// Only used if the key pair has to be generated
+	Config.CAKeyType = keypair.KeyType
+	Config.CAKeySize = keypair.KeySize
+	// Flag as unloaded, the CA is loaded by the next launch or PrewarmCA
+	caLoadMux.Lock()
 	caLoaded = false
-	loadCA()
+	caLoadMux.Unlock()
+}
+
+//export PrewarmCA
+func PrewarmCA() *C.char {
+	// Load the CA, generating and saving it if needed, ahead of the first launch
+	var result ErrorResult
+	if err := loadCA(); err != nil {
+		result.Error = err.Error()
+	}
+	return marshalResult(result)
+}
+
+//export SetCertCache
+func SetCertCache(data string) {
+	// Set the leaf certificate cache options from cffi
+	var setting CertCacheSetting
+	err := json.Unmarshal([]byte(data), &setting)
+	if err != nil {
+		log.Fatal(err)
+		return
+	}
+	Config.CertCacheSize = setting.Size
+	Config.LeafKeyType = setting.KeyType
+	// Rebuild the cache if a CA is already loaded
+	caLoadMux.Lock()
+	defer caLoadMux.Unlock()
+	if caLoaded {
+		resetLeafCertCache(&goproxy.GoproxyCa)
+	}
+}
+
+//export SetDialer
+func SetDialer(data string) {
+	// Set the upstream dialer and DNS cache options from cffi
+	var setting DialerSetting
+	err := json.Unmarshal([]byte(data), &setting)
+	if err != nil {
+		log.Fatal(err)
+		return
+	}
+	Config.DNSCacheTTL = setting.DNSCacheTTL
+	Config.DNSNegativeTTL = setting.DNSNegativeTTL
+	Config.DNSPrefetch = setting.DNSPrefetch
+	Config.FallbackDelay = setting.FallbackDelay
+	Config.ConnectTimeout = setting.ConnectTimeout
+	Config.KeepAlive = setting.KeepAlive
+	Config.Nagle = setting.Nagle
+	resetUpstreamDialer()
+}
+
+//export SetMemoryBudget
+func SetMemoryBudget(data string) {
+	// Set the memory budget for bodies buffered for injection from cffi
+	var setting MemoryBudgetSetting
+	err := json.Unmarshal([]byte(data), &setting)
+	if err != nil {
+		log.Fatal(err)
+		return
+	}
+	Config.BodyBudget = setting.Budget
+	Config.BodyQueueLength = setting.QueueLength
+	Config.BodyQueueTimeout = setting.QueueTimeout
+	resetMemoryBudget()
+}
+
+//export SetResponseCache
+func SetResponseCache(data string) {
+	// Set the shared response cache options from cffi
+	var setting ResponseCacheSetting
+	err := json.Unmarshal([]byte(data), &setting)
+	if err != nil {
+		log.Fatal(err)
+		return
+	}
+	Config.ResponseCacheSize = setting.Size
+	Config.ResponseCacheDir = setting.Dir
+	Config.ResponseCacheDiskSize = setting.DiskSize
+	resetResponseCache()
+}
+
+//export SetRuntime
+func SetRuntime(data string) {
+	// Set GOMAXPROCS and the GC targets from cffi
+	var setting RuntimeSetting
+	err := json.Unmarshal([]byte(data), &setting)
+	if err != nil {
+		log.Fatal(err)
+		return
+	}
+	Config.MaxProcs = setting.MaxProcs
+	Config.GCPercent = setting.GCPercent
+	Config.MemoryLimit = setting.MemoryLimit
+	UpdateRuntime()
+}
+
+//export UpdateSessions
+func UpdateSessions(data string) *C.char {
+	// Replace the named sessions of a running instance
+	var result ErrorResult
+	var setting SessionsSetting
+	if err := json.Unmarshal([]byte(data), &setting); err != nil {
+		result.Error = err.Error()
+		return marshalResult(result)
+	}
+	serverMux.Lock()
+	instance, ok := proxyInstanceMap[setting.Id]
+	serverMux.Unlock()
+	if !ok {
+		result.Error = fmt.Sprintf("%v is not a running instance", setting.Id)
+	} else if err := instance.Sessions.Update(setting.Sessions); err != nil {
+		result.Error = err.Error()
+	}
+	return marshalResult(result)
+}
+
+//export LoadProfiles
+func LoadProfiles(data string) *C.char {
+	// Replace the fingerprint profile registry used by every instance
+	var result ErrorResult
+	var setting ProfilesSetting
+	if err := json.Unmarshal([]byte(data), &setting); err != nil {
+		result.Error = err.Error()
+		return marshalResult(result)
+	}
+	if err := loadProfiles(&setting); err != nil {
+		result.Error = err.Error()
+	}
+	return marshalResult(result)
+}
+
+//export GetStats
+func GetStats(id string) *C.char {
+	// Return the runtime metrics of an instance as JSON
+	serverMux.Lock()
+	instance, ok := proxyInstanceMap[id]
+	serverMux.Unlock()
+	if !ok {
+		return marshalResult(ErrorResult{Error: fmt.Sprintf("%v is not a running instance", id)})
+	}
+	stats := instance.Metrics.Stats()
+	stats.Upstreams = instance.Upstreams.Stats()
+	return marshalResult(stats)
+}
+
+//export DrainAccessLog
+func DrainAccessLog(data string) *C.char {
+	// Remove up to max records from an instance's access log and return them as JSON
+	var setting AccessLogSetting
+	if err := json.Unmarshal([]byte(data), &setting); err != nil {
+		return marshalResult(AccessLogBatch{Error: err.Error()})
+	}
+	serverMux.Lock()
+	instance, ok := proxyInstanceMap[setting.Id]
+	serverMux.Unlock()
+	if !ok {
+		return marshalResult(AccessLogBatch{Error: fmt.Sprintf("%v is not a running instance", setting.Id)})
+	}
+	if instance.AccessLog == nil {
+		return marshalResult(AccessLogBatch{Error: fmt.Sprintf("%v does not have an access log", setting.Id)})
+	}
+	// A max of 0 only reports the dropped count
+	return marshalResult(instance.AccessLog.Drain(setting.Max))
+}
+
+//export GetCertCacheStats
+func GetCertCacheStats() *C.char {
+	// Return the leaf certificate cache counters as JSON
+	var stats CertCacheStats
+	if cache := getLeafCertCache(); cache != nil {
+		stats = cache.Stats()
+	}
+	return marshalResult(stats)
+}
+
+// Passes a result to a cffi completion callback, which must release it with FreeMemory
+func complete(callback C.completion_callback, handle C.ulonglong, v interface{}) {
+	C.call_completion(callback, handle, marshalResult(v))
+}
+
+// Encodes a result as a C string, which must be released with FreeMemory
+func marshalResult(v interface{}) *C.char {
+	out, err := json.Marshal(v)
+	if err != nil {
+		log.Printf("Failed to encode result: %v", err)
+		return nil
+	}
+	return C.CString(string(out))
+}
+
+//export FreeMemory
+func FreeMemory(ptr *C.char) {
+	// Free strings returned to cffi
+	C.free(unsafe.Pointer(ptr))
 }
 
 //export ShutdownServer
 func ShutdownServer(id string) {
-	// Kill server from cffi
+	// Kill server from cffi, closing its connections right away
+	if _, err := shutdownServer(id, 0); err != nil {
+		log.Printf("Error: %v", err)
+	}
+}
+
+//export DrainServer
+func DrainServer(data string) *C.char {
+	// Kill server from cffi, letting open connections finish until the timeout
+	var setting ShutdownSetting
+	if err := json.Unmarshal([]byte(data), &setting); err != nil {
+		return marshalResult(ShutdownResult{Error: err.Error()})
+	}
+	return marshalResult(drainServer(setting))
+}
+
+//export ShutdownServerAsync
+func ShutdownServerAsync(data string, handle C.ulonglong, callback C.completion_callback) {
+	// Kill server from cffi without blocking, reporting through the callback once it is closed
+	var setting ShutdownSetting
+	if err := json.Unmarshal([]byte(data), &setting); err != nil {
+		go complete(callback, handle, ShutdownResult{Error: err.Error()})
+		return
+	}
+	go func() {
+		complete(callback, handle, drainServer(setting))
+	}()
+}
+
+func drainServer(setting ShutdownSetting) ShutdownResult {
+	var result ShutdownResult
+	closed, err := shutdownServer(setting.Id, time.Duration(setting.Timeout*float64(time.Second)))
+	if err != nil {
+		result.Error = err.Error()
+	}
+	result.Closed = closed
+	return result
+}
+
+// Shuts down an instance, returning the number of connections that were still
+// open after the timeout and had to be closed
+func shutdownServer(id string, timeout time.Duration) (int, error) {
+	// Unregister the instance first so that draining doesn't hold up other instances
 	serverMux.Lock()
-	defer serverMux.Unlock()
+	instance, ok := proxyInstanceMap[id]
+	delete(proxyInstanceMap, id)
+	serverMux.Unlock()
 
 	// Check if id is in proxyInstanceMap
-	if _, ok := proxyInstanceMap[id]; !ok {
+	if !ok {
 		// say id wasnt found
-		log.Printf("Error: %v is not a running instance", id)
-		return
+		return 0, fmt.Errorf("%v is not a running instance", id)
 	}
-
-	if proxyInstanceMap[id].Server == nil {
-		log.Println("Error: Server not found")
-		delete(proxyInstanceMap, id)
-		return
+	if instance.Server == nil {
+		return 0, fmt.Errorf("server not found")
 	}
 
 	// Announce server shutdown to verbose logs
 	if Config.Verbose {
 		log.Println("Shutting down the server...")
 	}
-	proxyInstanceMap[id].Cancel() // Cancel the context, which should trigger graceful shutdown
-
-	if err := proxyInstanceMap[id].Server.Shutdown(context.Background()); err != nil {
-		log.Printf("Failed to shutdown the server gracefully: %v", err)
-	}
-	delete(proxyInstanceMap, id)
+	return instance.Shutdown(timeout), nil
 }
@@ -11,6 +11,36 @@ type ConfigFlags struct {
 	Cert    string `json:"cert,omitempty"`
 	Key     string `json:"key,omitempty"`
 	Verbose bool   `json:"verbose,omitempty"`
+	// MITM leaf certificates
+	CertCacheSize int    `json:"cert_cache_size,omitempty"`
+	LeafKeyType   string `json:"leaf_key_type,omitempty"`
+	// Key for newly generated CAs: ecdsa (P-256 or P-384) or rsa (2048 bits and up)
+	CAKeyType string `json:"ca_key_type,omitempty"`
+	CAKeySize int    `json:"ca_key_size,omitempty"`
+	// Upstream dialing, in seconds unless noted. 0 selects the default and -1 disables.
+	DNSCacheTTL    int  `json:"dns_cache_ttl,omitempty"`
+	DNSNegativeTTL int  `json:"dns_negative_ttl,omitempty"`
+	DNSPrefetch    bool `json:"dns_prefetch,omitempty"`
+	// Happy eyeballs delay in milliseconds
+	FallbackDelay  int  `json:"fallback_delay,omitempty"`
+	ConnectTimeout int  `json:"connect_timeout,omitempty"`
+	KeepAlive      int  `json:"keep_alive,omitempty"`
+	Nagle          bool `json:"nagle,omitempty"`
+	// Memory budget for bodies buffered for injection in bytes, 0 for the default and -1 for no limit
+	BodyBudget int64 `json:"body_budget,omitempty"`
+	// Bodies waiting for room, and how long they wait in milliseconds (-1 to stream right away)
+	BodyQueueLength  int `json:"body_queue_length,omitempty"`
+	BodyQueueTimeout int `json:"body_queue_timeout,omitempty"`
+	// Shared response cache. Sizes are in bytes, 0 for the default and -1 to
+	// disable a tier. The disk tier is only used when a directory is set.
+	ResponseCacheSize     int64  `json:"response_cache_size,omitempty"`
+	ResponseCacheDir      string `json:"response_cache_dir,omitempty"`
+	ResponseCacheDiskSize int64  `json:"response_cache_disk_size,omitempty"`
+	// Go runtime, 0 leaves a setting unchanged. A GC percent of -1 disables the
+	// collector, and a memory limit of -1 removes the limit.
+	MaxProcs    int   `json:"max_procs,omitempty"`
+	GCPercent   int   `json:"gc_percent,omitempty"`
+	MemoryLimit int64 `json:"memory_limit,omitempty"`
 }
 
 type ProxySetup struct {
@@ -19,21 +49,151 @@ type ProxySetup struct {
 	Port          string `json:"port"`
 	UserAgent     string `json:"user_agent,omitempty"`
 	Payload       string `json:"payload,omitempty"`
-	UpstreamProxy string `json:"upstreamproxy,omitempty"`
+	UpstreamProxy string `json:"upstream_proxy,omitempty"`
 	Id            string `json:"id"`
+	// Listeners sharing the port with SO_REUSEPORT, each with its own accept loop (Linux only)
+	Listeners int `json:"listeners,omitempty"`
+	// Named sessions, selected by proxy credentials or the x-mitm-session header
+	Sessions map[string]SessionSettings `json:"sessions,omitempty"`
+	// Upstream proxies to spread requests across, along with UpstreamProxy
+	UpstreamProxies []string `json:"upstream_proxies,omitempty"`
+	// round_robin (default), least_latency, sticky_host or sticky_session
+	UpstreamPolicy string `json:"upstream_policy,omitempty"`
+	// Health checks are disabled unless a target URL is set
+	HealthCheckUrl      string `json:"health_check_url,omitempty"`
+	HealthCheckInterval int    `json:"health_check_interval,omitempty"`
+	// Host patterns to intercept (all when empty) and to tunnel without interception
+	Intercept   []string `json:"intercept,omitempty"`
+	Passthrough []string `json:"passthrough,omitempty"`
+	// Rewrite response bodies while streaming them to the client
+	StreamInjection bool `json:"stream_injection,omitempty"`
+	// Injection result cache size in bytes, 0 for the default and -1 to disable
+	InjectCacheSize int64 `json:"inject_cache_size,omitempty"`
+	// Compression level for re-encoded responses, 0 for each encoding's default
+	CompressionLevel int `json:"compression_level,omitempty"`
+	// Upstream connection pool
+	IdleTimeout    int `json:"idle_timeout,omitempty"`
+	MaxIdlePerHost int `json:"max_idle_per_host,omitempty"`
+	// Upstream connections per origin and fingerprint, 0 for no limit
+	MaxConnsPerHost int `json:"max_conns_per_host,omitempty"`
+	// Concurrent upstream requests, 0 for no limit. Requests over the limit wait
+	// for QueueTimeout seconds (0 for the default, -1 to refuse right away).
+	MaxRequests  int `json:"max_requests,omitempty"`
+	QueueTimeout int `json:"queue_timeout,omitempty"`
+	// Serve Prometheus metrics at /metrics on the proxy listener
+	MetricsEndpoint bool `json:"metrics_endpoint,omitempty"`
+	// Record requests in a ring drained over CFFI. Size is rounded up to a power
+	// of two, and sample is the fraction of requests recorded (all when 0).
+	AccessLog       bool    `json:"access_log,omitempty"`
+	AccessLogSize   int     `json:"access_log_size,omitempty"`
+	AccessLogSample float64 `json:"access_log_sample,omitempty"`
+	// Serve cacheable responses from the shared response cache
+	ResponseCache bool `json:"response_cache,omitempty"`
 }
 
 var (
 	Config ConfigFlags
 )
 
+type StartResult struct {
+	Addr  string `json:"addr,omitempty"`
+	Port  int    `json:"port,omitempty"`
+	Error string `json:"error,omitempty"`
+}
+
 type VerbositySetting struct {
 	Verbose bool `json:"verbose"`
 }
 
 type KeyPairSetting struct {
-	Cert string `json:"cert"`
-	Key  string `json:"key"`
+	Cert    string `json:"cert"`
+	Key     string `json:"key"`
+	KeyType string `json:"key_type"`
+	KeySize int    `json:"key_size"`
+}
+
+type DialerSetting struct {
+	DNSCacheTTL    int  `json:"dns_cache_ttl"`
+	DNSNegativeTTL int  `json:"dns_negative_ttl"`
+	DNSPrefetch    bool `json:"dns_prefetch"`
+	FallbackDelay  int  `json:"fallback_delay"`
+	ConnectTimeout int  `json:"connect_timeout"`
+	KeepAlive      int  `json:"keep_alive"`
+	Nagle          bool `json:"nagle"`
+}
+
+type SessionsSetting struct {
+	Id       string                     `json:"id"`
+	Sessions map[string]SessionSettings `json:"sessions"`
+}
+
+type AccessLogSetting struct {
+	Id  string `json:"id"`
+	Max int    `json:"max"`
+}
+
+type MemoryBudgetSetting struct {
+	Budget       int64 `json:"budget"`
+	QueueLength  int   `json:"queue_length"`
+	QueueTimeout int   `json:"queue_timeout"`
+}
+
+type ResponseCacheSetting struct {
+	Size     int64  `json:"size"`
+	Dir      string `json:"dir"`
+	DiskSize int64  `json:"disk_size"`
+}
+
+type ProfilesSetting struct {
+	// JSON file to load the rest from
+	Path     string                    `json:"path"`
+	Profiles map[string]ProfileSetting `json:"profiles"`
+	// Profile names by browser and the minimum major version they apply to
+	Browsers map[string]map[string]string `json:"browsers"`
+	// Profile names by exact User-Agent
+	UserAgents map[string]string `json:"user_agents"`
+	Default    string            `json:"default"`
+}
+
+// A ClientHelloID built into utls, or a custom spec from a JA3 string and/or explicit fields
+type ProfileSetting struct {
+	Client              string   `json:"client"`
+	Version             string   `json:"version"`
+	JA3                 string   `json:"ja3"`
+	CipherSuites        []uint16 `json:"cipher_suites"`
+	Extensions          []uint16 `json:"extensions"`
+	Curves              []uint16 `json:"curves"`
+	PointFormats        []uint8  `json:"point_formats"`
+	SignatureAlgorithms []uint16 `json:"signature_algorithms"`
+	ALPN                []string `json:"alpn"`
+	Grease              bool     `json:"grease"`
+}
+
+type RuntimeSetting struct {
+	MaxProcs    int   `json:"max_procs"`
+	GCPercent   int   `json:"gc_percent"`
+	MemoryLimit int64 `json:"memory_limit"`
+}
+
+type ShutdownSetting struct {
+	Id string `json:"id"`
+	// Seconds to let open connections finish before they are closed
+	Timeout float64 `json:"timeout"`
+}
+
+type ShutdownResult struct {
+	// Connections that were still open after the timeout
+	Closed int    `json:"closed"`
+	Error  string `json:"error,omitempty"`
+}
+
+type ErrorResult struct {
+	Error string `json:"error,omitempty"`
+}
+
+type CertCacheSetting struct {
+	Size    int    `json:"size"`
+	KeyType string `json:"key_type"`
 }
 
 func UpdateVerbosity() {
@@ -46,17 +206,9 @@ func UpdateVerbosity() {
 }
 
 func getClientHelloID(uagent string, ctx *goproxy.ProxyCtx) (utls.ClientHelloID, error) {
-	browser, version, err := uagentToUtls(uagent)
-	ctx.Logf("Client: %s, UTLS Version: %s", browser, version)
-
-	if err != nil {
-		return utls.ClientHelloID{}, err
+	clientHelloId, err := resolveClientHelloID(uagent)
+	if err == nil {
+		ctx.Logf("Client: %s, UTLS Version: %s", clientHelloId.Client, clientHelloId.Version)
 	}
-
-	return utls.ClientHelloID{
-		Client:  browser,
-		Version: version,
-		Seed:    nil,
-		Weights: nil,
-	}, nil
+	return clientHelloId, err
 }
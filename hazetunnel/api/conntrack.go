@@ -0,0 +1,171 @@
+package api
+
+import (
+	"context"
+	"net"
+	"net/http"
+	"sync"
+	"sync/atomic"
+	"time"
+)
+
+/*
+Per-instance connection tracking.
+http.Server forgets connections once goproxy hijacks them for a CONNECT, so
+client connections are tracked from the listener, along with every upstream
+connection the instance dials. On shutdown, the instance waits for them to
+finish until a deadline and then closes whatever is left.
+*/
+
+// How often a draining instance checks whether its connections have finished
+const drainPollInterval = 50 * time.Millisecond
+
+type connKind int
+
+const (
+	connClient connKind = iota
+	connUpstream
+)
+
+type connTracker struct {
+	metrics *Metrics
+	mu      sync.Mutex
+	conns   map[*trackedConn]struct{}
+	// Set once the instance is closed, new connections are closed right away
+	closed bool
+}
+
+func newConnTracker(metrics *Metrics) *connTracker {
+	return &connTracker{metrics: metrics, conns: make(map[*trackedConn]struct{})}
+}
+
+// Track returns conn wrapped so that it is untracked once closed
+func (t *connTracker) Track(conn net.Conn, kind connKind) net.Conn {
+	tracked := &trackedConn{Conn: conn, tracker: t, kind: kind}
+	t.mu.Lock()
+	if t.closed {
+		t.mu.Unlock()
+		conn.Close()
+		return tracked
+	}
+	t.conns[tracked] = struct{}{}
+	t.gauge(kind).Add(1)
+	t.mu.Unlock()
+	return tracked
+}
+
+func (t *connTracker) untrack(conn *trackedConn) {
+	t.mu.Lock()
+	if _, ok := t.conns[conn]; ok {
+		delete(t.conns, conn)
+		t.gauge(conn.kind).Add(-1)
+	}
+	t.mu.Unlock()
+}
+
+func (t *connTracker) gauge(kind connKind) *atomic.Int64 {
+	if kind == connClient {
+		return &t.metrics.clientConns
+	}
+	return &t.metrics.upstreamConns
+}
+
+// Listener tracks the client connections accepted by l
+func (t *connTracker) Listener(l net.Listener) net.Listener {
+	return &trackedListener{Listener: l, tracker: t}
+}
+
+// DialContext tracks the connections opened by dial
+func (t *connTracker) DialContext(dial func(ctx context.Context, network, addr string) (net.Conn, error)) func(ctx context.Context, network, addr string) (net.Conn, error) {
+	return func(ctx context.Context, network, addr string) (net.Conn, error) {
+		conn, err := dial(ctx, network, addr)
+		if err != nil {
+			return nil, err
+		}
+		return t.Track(conn, connUpstream), nil
+	}
+}
+
+// Handler counts the requests being handled by next. Tunnels relayed after
+// the CONNECT handler returns are counted by their connections instead.
+func (t *connTracker) Handler(next http.Handler) http.Handler {
+	return http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		t.metrics.activeRequests.Add(1)
+		defer t.metrics.activeRequests.Add(-1)
+		next.ServeHTTP(w, r)
+	})
+}
+
+// Wait blocks until every client connection is closed or ctx is done
+func (t *connTracker) Wait(ctx context.Context) error {
+	ticker := time.NewTicker(drainPollInterval)
+	defer ticker.Stop()
+	for t.metrics.clientConns.Load() > 0 {
+		select {
+		case <-ctx.Done():
+			return ctx.Err()
+		case <-ticker.C:
+		}
+	}
+	return nil
+}
+
+// Close closes every tracked connection and any opened afterwards.
+// Returns the number of connections that were still open.
+func (t *connTracker) Close() int {
+	t.mu.Lock()
+	t.closed = true
+	conns := make([]*trackedConn, 0, len(t.conns))
+	for conn := range t.conns {
+		conns = append(conns, conn)
+	}
+	t.mu.Unlock()
+	for _, conn := range conns {
+		conn.Close()
+	}
+	return len(conns)
+}
+
+type trackedConn struct {
+	net.Conn
+	tracker *connTracker
+	kind    connKind
+	once    sync.Once
+	err     error
+}
+
+func (c *trackedConn) Close() error {
+	c.once.Do(func() {
+		c.err = c.Conn.Close()
+		c.tracker.untrack(c)
+	})
+	return c.err
+}
+
+func (c *trackedConn) CloseWrite() error {
+	if cw, ok := c.Conn.(interface{ CloseWrite() error }); ok {
+		return cw.CloseWrite()
+	}
+	return c.Close()
+}
+
+// Returns the connection under a tracked one, so io.Copy can splice between TCP connections
+func unwrapConn(conn net.Conn) net.Conn {
+	if tracked, ok := conn.(*trackedConn); ok {
+		return tracked.Conn
+	}
+	return conn
+}
+
+type trackedListener struct {
+	net.Listener
+	tracker *connTracker
+}
+
+func (l *trackedListener) Accept() (net.Conn, error) {
+	conn, err := l.Listener.Accept()
+	if err != nil {
+		return nil, err
+	}
+	return l.tracker.Track(conn, connClient), nil
+}
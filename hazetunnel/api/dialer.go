@@ -0,0 +1,388 @@
+package api
+
+import (
+	"context"
+	"errors"
+	"net"
+	"sync"
+	"sync/atomic"
+	"time"
+)
+
+/*
+Upstream dialer and DNS cache.
+Names are resolved through a process-wide cache shared by every instance, so
+cold connections don't wait on the system resolver. Names that don't exist
+are cached briefly, and with prefetching enabled, names that are still in use
+shortly before they expire are refreshed in the background. Dual-stack hosts
+are dialed happy-eyeballs style, racing the other address family after a
+short delay.
+*/
+
+const (
+	defaultDNSCacheTTL    = 60 * time.Second
+	defaultDNSNegativeTTL = 5 * time.Second
+	defaultFallbackDelay  = 300 * time.Millisecond
+	defaultConnectTimeout = 30 * time.Second
+	defaultKeepAlive      = 30 * time.Second
+	dnsCacheSize          = 4096
+	// Lookups not shared by a cached entry give up after this long
+	dnsLookupTimeout = 10 * time.Second
+)
+
+type dnsEntry struct {
+	// Closed once the lookup has finished
+	ready   chan struct{}
+	ips     []net.IP
+	err     error
+	expires time.Time
+	// Set while a prefetch for this entry is running
+	refreshing atomic.Bool
+}
+
+type ResolverStats struct {
+	Lookups      uint64 `json:"lookups"`
+	Hits         uint64 `json:"hits"`
+	NegativeHits uint64 `json:"negative_hits"`
+	Misses       uint64 `json:"misses"`
+	Prefetches   uint64 `json:"prefetches"`
+	Failures     uint64 `json:"failures"`
+	Size         int    `json:"size"`
+	// Time spent in the system resolver, in seconds
+	Latency HistogramStats `json:"latency"`
+}
+
+type dnsCache struct {
+	resolver *net.Resolver
+	// Negative values disable caching
+	ttl         time.Duration
+	negativeTTL time.Duration
+	prefetch    bool
+	entries     *lruCache[string, *dnsEntry]
+
+	lookups      atomic.Uint64
+	hits         atomic.Uint64
+	negativeHits atomic.Uint64
+	misses       atomic.Uint64
+	prefetches   atomic.Uint64
+	failures     atomic.Uint64
+	latency      histogram
+}
+
+func newDNSCache(ttl, negativeTTL time.Duration, prefetch bool) *dnsCache {
+	return &dnsCache{
+		resolver:    net.DefaultResolver,
+		ttl:         ttl,
+		negativeTTL: negativeTTL,
+		prefetch:    prefetch,
+		entries:     newLRUCache[string, *dnsEntry](dnsCacheSize, nil, nil),
+	}
+}
+
+// Lookup returns the addresses of host, resolving it if it isn't cached.
+// Concurrent lookups of the same name share a single query.
+func (c *dnsCache) Lookup(ctx context.Context, host string) ([]net.IP, error) {
+	c.lookups.Add(1)
+	if c.ttl < 0 {
+		c.misses.Add(1)
+		entry := &dnsEntry{ready: make(chan struct{})}
+		c.resolve(ctx, host, entry)
+		return entry.ips, entry.err
+	}
+
+	for {
+		created := false
+		entry := c.entries.GetOrAdd(host, func() *dnsEntry {
+			created = true
+			return &dnsEntry{ready: make(chan struct{})}
+		})
+		if created {
+			c.misses.Add(1)
+			// Detached from the caller so that a cancelled request doesn't fail
+			// everyone else waiting on the same name
+			go func() {
+				ctx, cancel := context.WithTimeout(context.Background(), dnsLookupTimeout)
+				defer cancel()
+				c.resolve(ctx, host, entry)
+			}()
+		}
+		select {
+		case <-entry.ready:
+		case <-ctx.Done():
+			return nil, ctx.Err()
+		}
+
+		if created {
+			return entry.ips, entry.err
+		}
+		remaining := time.Until(entry.expires)
+		if remaining <= 0 {
+			// Another lookup may have stored a fresh entry already
+			c.entries.RemoveIf(host, func(current *dnsEntry) bool { return current == entry })
+			continue
+		}
+		if entry.err != nil {
+			c.negativeHits.Add(1)
+			return nil, entry.err
+		}
+		c.hits.Add(1)
+		if c.prefetch && remaining < c.ttl/5 && entry.refreshing.CompareAndSwap(false, true) {
+			go c.refresh(host)
+		}
+		return entry.ips, nil
+	}
+}
+
+func (c *dnsCache) resolve(ctx context.Context, host string, entry *dnsEntry) {
+	start := time.Now()
+	entry.ips, entry.err = c.resolver.LookupIP(ctx, "ip", host)
+	c.latency.Observe(time.Since(start))
+
+	entry.expires = time.Now().Add(c.ttl)
+	if entry.err != nil {
+		c.failures.Add(1)
+		// Only missing names are cached, transient failures are retried
+		var dnsErr *net.DNSError
+		if c.negativeTTL > 0 && errors.As(entry.err, &dnsErr) && dnsErr.IsNotFound {
+			entry.expires = time.Now().Add(c.negativeTTL)
+		} else {
+			entry.expires = time.Time{}
+		}
+	}
+	close(entry.ready)
+}
+
+// Resolves host again, replacing its entry if the lookup succeeds.
+// Until then the current entry keeps being served.
+func (c *dnsCache) refresh(host string) {
+	c.prefetches.Add(1)
+	ctx, cancel := context.WithTimeout(context.Background(), dnsLookupTimeout)
+	defer cancel()
+	entry := &dnsEntry{ready: make(chan struct{})}
+	c.resolve(ctx, host, entry)
+	if entry.err == nil {
+		c.entries.Add(host, entry)
+	}
+}
+
+func (c *dnsCache) Stats() ResolverStats {
+	return ResolverStats{
+		Lookups:      c.lookups.Load(),
+		Hits:         c.hits.Load(),
+		NegativeHits: c.negativeHits.Load(),
+		Misses:       c.misses.Load(),
+		Prefetches:   c.prefetches.Load(),
+		Failures:     c.failures.Load(),
+		Size:         c.entries.Len(),
+		Latency:      c.latency.Stats(),
+	}
+}
+
+/*
+Dialer
+*/
+
+type upstreamDialer struct {
+	dialer   net.Dialer
+	resolver *dnsCache
+	// Delay before racing the other address family, negative to dial serially
+	fallbackDelay time.Duration
+	timeout       time.Duration
+	// Leave Nagle's algorithm enabled instead of setting TCP_NODELAY
+	nagle bool
+}
+
+var (
+	dialerMux     sync.RWMutex
+	currentDialer *upstreamDialer
+)
+
+// Builds a dialer from the process-wide config
+func newUpstreamDialer() *upstreamDialer {
+	d := &upstreamDialer{
+		fallbackDelay: durationSetting(Config.FallbackDelay, time.Millisecond, defaultFallbackDelay),
+		timeout:       durationSetting(Config.ConnectTimeout, time.Second, defaultConnectTimeout),
+		nagle:         Config.Nagle,
+	}
+	d.dialer.KeepAlive = durationSetting(Config.KeepAlive, time.Second, defaultKeepAlive)
+	d.resolver = newDNSCache(
+		durationSetting(Config.DNSCacheTTL, time.Second, defaultDNSCacheTTL),
+		durationSetting(Config.DNSNegativeTTL, time.Second, defaultDNSNegativeTTL),
+		Config.DNSPrefetch,
+	)
+	return d
+}
+
+// Converts a config value, where 0 selects the default and negative values disable the setting
+func durationSetting(value int, unit time.Duration, fallback time.Duration) time.Duration {
+	switch {
+	case value == 0:
+		return fallback
+	case value < 0:
+		return -1
+	}
+	return time.Duration(value) * unit
+}
+
+// Rebuilds the process-wide dialer and DNS cache for the current config
+func resetUpstreamDialer() {
+	dialerMux.Lock()
+	defer dialerMux.Unlock()
+	currentDialer = newUpstreamDialer()
+}
+
+func getUpstreamDialer() *upstreamDialer {
+	dialerMux.RLock()
+	d := currentDialer
+	dialerMux.RUnlock()
+	if d != nil {
+		return d
+	}
+
+	dialerMux.Lock()
+	defer dialerMux.Unlock()
+	if currentDialer == nil {
+		currentDialer = newUpstreamDialer()
+	}
+	return currentDialer
+}
+
+// Opens a direct TCP connection with the process-wide dialer
+func dialDirect(ctx context.Context, network string, addr string) (net.Conn, error) {
+	return getUpstreamDialer().DialContext(ctx, network, addr)
+}
+
+func (d *upstreamDialer) Dial(network string, addr string) (net.Conn, error) {
+	return d.DialContext(context.Background(), network, addr)
+}
+
+func (d *upstreamDialer) DialContext(ctx context.Context, network string, addr string) (net.Conn, error) {
+	if d.timeout > 0 {
+		var cancel context.CancelFunc
+		ctx, cancel = context.WithTimeout(ctx, d.timeout)
+		defer cancel()
+	}
+	host, port, err := net.SplitHostPort(addr)
+	if err != nil {
+		return nil, err
+	}
+	// Literal addresses and pinned address families skip the cache
+	if network != "tcp" || net.ParseIP(host) != nil {
+		return d.dial(ctx, network, addr)
+	}
+
+	ips, err := d.resolver.Lookup(ctx, host)
+	if err != nil {
+		return nil, err
+	}
+	primaries, fallbacks := splitByFamily(ips)
+	if len(fallbacks) == 0 || d.fallbackDelay < 0 {
+		return d.dialSerial(ctx, network, append(primaries, fallbacks...), port)
+	}
+	return d.dialParallel(ctx, network, primaries, fallbacks, port)
+}
+
+func (d *upstreamDialer) dial(ctx context.Context, network string, addr string) (net.Conn, error) {
+	conn, err := d.dialer.DialContext(ctx, network, addr)
+	if err != nil {
+		return nil, err
+	}
+	// Go sets TCP_NODELAY on every TCP connection by default
+	if tcpConn, ok := conn.(*net.TCPConn); ok && d.nagle {
+		tcpConn.SetNoDelay(false)
+	}
+	return conn, nil
+}
+
+// Tries each address in order, returning the first error if all of them fail
+func (d *upstreamDialer) dialSerial(ctx context.Context, network string, ips []net.IP, port string) (net.Conn, error) {
+	var firstErr error
+	for _, ip := range ips {
+		conn, err := d.dial(ctx, network, net.JoinHostPort(ip.String(), port))
+		if err == nil {
+			return conn, nil
+		}
+		if firstErr == nil {
+			firstErr = err
+		}
+		if ctx.Err() != nil {
+			break
+		}
+	}
+	if firstErr == nil {
+		firstErr = errors.New("no addresses to dial")
+	}
+	return nil, firstErr
+}
+
+// Dials the primary addresses, starting on the fallbacks once the primaries
+// fail or the fallback delay passes, whichever comes first
+func (d *upstreamDialer) dialParallel(ctx context.Context, network string, primaries, fallbacks []net.IP, port string) (net.Conn, error) {
+	type dialResult struct {
+		conn net.Conn
+		err  error
+	}
+	ctx, cancel := context.WithCancel(ctx)
+	defer cancel()
+
+	results := make(chan dialResult)
+	race := func(ips []net.IP) {
+		conn, err := d.dialSerial(ctx, network, ips, port)
+		results <- dialResult{conn, err}
+	}
+	go race(primaries)
+	timer := time.NewTimer(d.fallbackDelay)
+	defer timer.Stop()
+
+	var firstErr error
+	pending, fallbackStarted := 1, false
+	for {
+		select {
+		case <-timer.C:
+			if !fallbackStarted {
+				fallbackStarted = true
+				pending++
+				go race(fallbacks)
+			}
+		case res := <-results:
+			pending--
+			if res.err == nil {
+				if pending > 0 {
+					// Close the losing connection if it still succeeds
+					go func() {
+						if res := <-results; res.conn != nil {
+							res.conn.Close()
+						}
+					}()
+				}
+				return res.conn, nil
+			}
+			if firstErr == nil {
+				firstErr = res.err
+			}
+			if !fallbackStarted {
+				fallbackStarted = true
+				pending++
+				go race(fallbacks)
+			} else if pending == 0 {
+				return nil, firstErr
+			}
+		}
+	}
+}
+
+// Splits addresses into those of the first address's family and the rest
+func splitByFamily(ips []net.IP) (primaries, fallbacks []net.IP) {
+	if len(ips) == 0 {
+		return nil, nil
+	}
+	isIPv4 := ips[0].To4() != nil
+	for _, ip := range ips {
+		if (ip.To4() != nil) == isIPv4 {
+			primaries = append(primaries, ip)
+		} else {
+			fallbacks = append(fallbacks, ip)
+		}
+	}
+	return primaries, fallbacks
+}
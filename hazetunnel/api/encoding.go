@@ -0,0 +1,252 @@
+package api
+
+import (
+	"bytes"
+	"fmt"
+	"io"
+	"net/http"
+	"strings"
+	"sync"
+
+	"github.com/andybalholm/brotli"
+	"github.com/klauspost/compress/gzip"
+	"github.com/klauspost/compress/zlib"
+	"github.com/klauspost/compress/zstd"
+)
+
+/*
+Content-Encoding support for payload injection.
+Bodies are decoded before injection and re-encoded with their original
+encoding. Compressors and decompressors are pooled per instance.
+*/
+
+type decompressor interface {
+	io.Reader
+	Reset(r io.Reader) error
+}
+
+type compressor interface {
+	io.Writer
+	Reset(w io.Writer)
+	Flush() error
+	Close() error
+}
+
+type codecPool struct {
+	// Output compression level, 0 uses each encoding's default
+	level   int
+	readers map[string]*sync.Pool
+	writers map[string]*sync.Pool
+}
+
+func newCodecPool(level int) *codecPool {
+	p := &codecPool{
+		level:   level,
+		readers: make(map[string]*sync.Pool),
+		writers: make(map[string]*sync.Pool),
+	}
+	for _, encoding := range []string{"gzip", "deflate", "br", "zstd"} {
+		p.readers[encoding] = &sync.Pool{}
+		p.writers[encoding] = &sync.Pool{}
+	}
+	return p
+}
+
+// Returns the normalized Content-Encoding of a response, "" for identity
+func contentEncoding(header http.Header) string {
+	encoding := strings.ToLower(strings.TrimSpace(header.Get("Content-Encoding")))
+	switch encoding {
+	case "identity":
+		return ""
+	case "x-gzip":
+		return "gzip"
+	}
+	return encoding
+}
+
+func supportedEncoding(encoding string) bool {
+	switch encoding {
+	case "", "gzip", "deflate", "br", "zstd":
+		return true
+	}
+	return false
+}
+
+// Encode compresses a whole body
+func (p *codecPool) Encode(encoding string, data string) (string, error) {
+	if encoding == "" {
+		return data, nil
+	}
+	var buf bytes.Buffer
+	writer, err := p.getWriter(encoding, &buf)
+	if err != nil {
+		return "", err
+	}
+	if _, err := io.WriteString(writer, data); err != nil {
+		return "", err
+	}
+	if err := writer.Close(); err != nil {
+		return "", err
+	}
+	p.writers[encoding].Put(writer)
+	return buf.String(), nil
+}
+
+// NewReader wraps src in a pooled decompressor.
+// Closing the reader closes src and returns the decompressor to the pool.
+func (p *codecPool) NewReader(encoding string, src io.ReadCloser) io.ReadCloser {
+	if encoding == "" {
+		return src
+	}
+	return &decodingReader{pool: p, encoding: encoding, src: src}
+}
+
+// NewEncodingReader compresses src as it is read, flushing after every chunk
+// so that the client receives data as soon as it arrives.
+// upstream is the original response body, closed to abort a pending read.
+func (p *codecPool) NewEncodingReader(encoding string, src io.ReadCloser, upstream io.Closer) (io.ReadCloser, error) {
+	if encoding == "" {
+		return src, nil
+	}
+	pr, pw := io.Pipe()
+	writer, err := p.getWriter(encoding, pw)
+	if err != nil {
+		return nil, err
+	}
+
+	go func() {
+		defer src.Close()
+		buf := make([]byte, streamChunkSize)
+		for {
+			n, err := src.Read(buf)
+			if n > 0 {
+				if _, werr := writer.Write(buf[:n]); werr != nil {
+					pw.CloseWithError(werr)
+					return
+				}
+				if werr := writer.Flush(); werr != nil {
+					pw.CloseWithError(werr)
+					return
+				}
+			}
+			if err == io.EOF {
+				break
+			} else if err != nil {
+				pw.CloseWithError(err)
+				return
+			}
+		}
+		if err := writer.Close(); err != nil {
+			pw.CloseWithError(err)
+			return
+		}
+		p.writers[encoding].Put(writer)
+		pw.Close()
+	}()
+	return &encodingReader{PipeReader: pr, upstream: upstream}, nil
+}
+
+func (p *codecPool) getReader(encoding string, src io.Reader) (decompressor, error) {
+	if reader, ok := p.readers[encoding].Get().(decompressor); ok {
+		if err := reader.Reset(src); err != nil {
+			return nil, err
+		}
+		return reader, nil
+	}
+	switch encoding {
+	case "gzip":
+		return gzip.NewReader(src)
+	case "deflate":
+		reader, err := zlib.NewReader(src)
+		if err != nil {
+			return nil, err
+		}
+		return &zlibReader{reader}, nil
+	case "br":
+		return brotli.NewReader(src), nil
+	case "zstd":
+		return zstd.NewReader(src, zstd.WithDecoderConcurrency(1))
+	}
+	return nil, fmt.Errorf("unsupported content encoding: %s", encoding)
+}
+
+func (p *codecPool) getWriter(encoding string, dst io.Writer) (compressor, error) {
+	if writer, ok := p.writers[encoding].Get().(compressor); ok {
+		writer.Reset(dst)
+		return writer, nil
+	}
+	switch encoding {
+	case "gzip":
+		return gzip.NewWriterLevel(dst, p.deflateLevel())
+	case "deflate":
+		return zlib.NewWriterLevel(dst, p.deflateLevel())
+	case "br":
+		level := brotli.DefaultCompression
+		if p.level > 0 {
+			level = min(p.level, brotli.BestCompression)
+		}
+		return brotli.NewWriterLevel(dst, level), nil
+	case "zstd":
+		level := zstd.SpeedDefault
+		if p.level > 0 {
+			level = zstd.EncoderLevelFromZstd(p.level)
+		}
+		return zstd.NewWriter(dst, zstd.WithEncoderLevel(level), zstd.WithEncoderConcurrency(1))
+	}
+	return nil, fmt.Errorf("unsupported content encoding: %s", encoding)
+}
+
+func (p *codecPool) deflateLevel() int {
+	if p.level <= 0 {
+		return gzip.DefaultCompression
+	}
+	return min(p.level, gzip.BestCompression)
+}
+
+// Decompresses src, taking a decompressor from the pool on first read
+type decodingReader struct {
+	pool     *codecPool
+	encoding string
+	src      io.ReadCloser
+	reader   decompressor
+	err      error
+}
+
+func (r *decodingReader) Read(p []byte) (int, error) {
+	if r.reader == nil && r.err == nil {
+		r.reader, r.err = r.pool.getReader(r.encoding, r.src)
+	}
+	if r.err != nil {
+		return 0, r.err
+	}
+	return r.reader.Read(p)
+}
+
+func (r *decodingReader) Close() error {
+	if r.reader != nil && r.err == nil {
+		r.pool.readers[r.encoding].Put(r.reader)
+		r.reader = nil
+	}
+	return r.src.Close()
+}
+
+type encodingReader struct {
+	*io.PipeReader
+	upstream io.Closer
+}
+
+func (r *encodingReader) Close() error {
+	// Unblock the encoding goroutine whether it is reading or writing.
+	// The goroutine closes the rest of the reader chain itself.
+	r.PipeReader.Close()
+	return r.upstream.Close()
+}
+
+// Adapts zlib's Resetter to the decompressor interface
+type zlibReader struct {
+	io.ReadCloser
+}
+
+func (r *zlibReader) Reset(src io.Reader) error {
+	return r.ReadCloser.(zlib.Resetter).Reset(src, nil)
+}
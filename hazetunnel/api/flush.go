@@ -0,0 +1,91 @@
+package api
+
+import (
+	"bufio"
+	"context"
+	"net"
+	"net/http"
+	"strings"
+	"sync/atomic"
+)
+
+/*
+Streaming responses.
+goproxy copies response bodies to the client without flushing, so the server
+holds what it writes until its buffer fills or the response ends. Responses
+without a known length, such as server-sent events and long polling, are
+flushed after every write instead so they reach the client as they arrive.
+Injection rewrites the headers sent to the client, so the upstream round
+tripper records whether a response streams in the request's context.
+*/
+
+const streamKey contextKey = "stream"
+
+// Wraps the writers of proxied requests so streaming responses are flushed
+func flushStreams(next http.Handler) http.Handler {
+	return http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		// CONNECTs hijack the original writer
+		if r.Method == http.MethodConnect {
+			next.ServeHTTP(w, r)
+			return
+		}
+		upstream := new(atomic.Bool)
+		next.ServeHTTP(
+			&flushWriter{ResponseWriter: w, upstream: upstream},
+			r.WithContext(context.WithValue(r.Context(), streamKey, upstream)),
+		)
+	})
+}
+
+type flushWriter struct {
+	http.ResponseWriter
+	// Set by the round tripper when the upstream response streams
+	upstream    *atomic.Bool
+	wroteHeader bool
+	stream      bool
+}
+
+func (w *flushWriter) WriteHeader(status int) {
+	if !w.wroteHeader && status >= http.StatusOK {
+		w.wroteHeader = true
+		w.stream = w.upstream.Load()
+	}
+	w.ResponseWriter.WriteHeader(status)
+}
+
+func (w *flushWriter) Write(p []byte) (int, error) {
+	if !w.wroteHeader {
+		w.WriteHeader(http.StatusOK)
+	}
+	n, err := w.ResponseWriter.Write(p)
+	if w.stream && err == nil {
+		http.NewResponseController(w.ResponseWriter).Flush()
+	}
+	return n, err
+}
+
+func (w *flushWriter) Flush() {
+	http.NewResponseController(w.ResponseWriter).Flush()
+}
+
+// Hijack hands the connection over for WebSocket upgrades goproxy relays itself
+func (w *flushWriter) Hijack() (net.Conn, *bufio.ReadWriter, error) {
+	return http.NewResponseController(w.ResponseWriter).Hijack()
+}
+
+func (w *flushWriter) Unwrap() http.ResponseWriter {
+	return w.ResponseWriter
+}
+
+// Records whether an upstream response streams for the writer of its request
+func markStreaming(ctx context.Context, resp *http.Response) {
+	if upstream, ok := ctx.Value(streamKey).(*atomic.Bool); ok {
+		upstream.Store(isStreamingResponse(resp))
+	}
+}
+
+// Reports whether a response is sent as it is produced rather than in one piece
+func isStreamingResponse(resp *http.Response) bool {
+	return resp.ContentLength < 0 ||
+		strings.HasPrefix(resp.Header.Get("Content-Type"), "text/event-stream")
+}
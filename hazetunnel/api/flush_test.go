@@ -0,0 +1,80 @@
+package api
+
+import (
+	"bufio"
+	"io"
+	"net"
+	"net/http"
+	"net/http/httptest"
+	"strings"
+	"testing"
+)
+
+func TestFlushStreams(t *testing.T) {
+	tests := []struct {
+		name          string
+		contentLength int64
+		contentType   string
+		want          bool
+	}{
+		{"known length", 5, "text/html", false},
+		{"unknown length", -1, "text/html", true},
+		{"event stream", 5, "text/event-stream; charset=utf-8", true},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			handler := flushStreams(http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+				markStreaming(r.Context(), &http.Response{
+					ContentLength: tt.contentLength,
+					Header:        http.Header{"Content-Type": {tt.contentType}},
+				})
+				// Injection drops the upstream length either way
+				w.Header().Set("Content-Type", tt.contentType)
+				io.WriteString(w, "hello")
+			}))
+			rec := httptest.NewRecorder()
+			handler.ServeHTTP(rec, httptest.NewRequest(http.MethodGet, "http://example.com/", nil))
+			if rec.Flushed != tt.want {
+				t.Errorf("flushed = %v, want %v", rec.Flushed, tt.want)
+			}
+			if !strings.HasPrefix(rec.Body.String(), "hello") {
+				t.Errorf("body = %q", rec.Body.String())
+			}
+		})
+	}
+}
+
+// goproxy hijacks the client connection for plain HTTP WebSockets
+func TestFlushWriterHijack(t *testing.T) {
+	server := httptest.NewServer(flushStreams(http.HandlerFunc(func(w http.ResponseWriter, r *http.Request) {
+		hijacker, ok := w.(http.Hijacker)
+		if !ok {
+			t.Error("writer can't be hijacked")
+			http.Error(w, "not hijackable", http.StatusInternalServerError)
+			return
+		}
+		conn, rw, err := hijacker.Hijack()
+		if err != nil {
+			t.Error(err)
+			return
+		}
+		defer conn.Close()
+		rw.WriteString("HTTP/1.1 101 Switching Protocols\r\n\r\n")
+		rw.Flush()
+	})))
+	defer server.Close()
+
+	conn, err := net.Dial("tcp", server.Listener.Addr().String())
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer conn.Close()
+	io.WriteString(conn, "GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n\r\n")
+	resp, err := http.ReadResponse(bufio.NewReader(conn), nil)
+	if err != nil {
+		t.Fatal(err)
+	}
+	if resp.StatusCode != http.StatusSwitchingProtocols {
+		t.Errorf("status = %d", resp.StatusCode)
+	}
+}
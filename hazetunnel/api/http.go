@@ -23,3 +23,33 @@ func missingParameterResponse(
 	ctx.Warnf("CRITICAL: Missing header: %s", header)
 	return goproxy.NewResponse(req, goproxy.ContentTypeText, http.StatusBadRequest, "HAZETUNNEL ERROR: Missing header: "+header)
 }
+
+func unknownSessionResponse(
+	req *http.Request,
+	ctx *goproxy.ProxyCtx,
+	name string,
+) *http.Response {
+	ctx.Warnf("CRITICAL: Client specified unknown session: %s", name)
+	resp := goproxy.NewResponse(req, goproxy.ContentTypeText, http.StatusProxyAuthRequired, "HAZETUNNEL ERROR: Unknown session: "+name)
+	resp.Header.Set("Proxy-Authenticate", `Basic realm="hazetunnel"`)
+	return resp
+}
+
+func upstreamBodyErrorResponse(
+	req *http.Request,
+	ctx *goproxy.ProxyCtx,
+	err error,
+) *http.Response {
+	ctx.Warnf("Failed to read response body: %v", err)
+	return goproxy.NewResponse(req, goproxy.ContentTypeText, http.StatusBadGateway, "HAZETUNNEL ERROR: Failed to read the upstream response: "+err.Error())
+}
+
+func overloadedResponse(
+	req *http.Request,
+	ctx *goproxy.ProxyCtx,
+) *http.Response {
+	ctx.Warnf("Every upstream request slot is taken, refusing %s", req.URL.Host)
+	resp := goproxy.NewResponse(req, goproxy.ContentTypeText, http.StatusServiceUnavailable, "HAZETUNNEL ERROR: Too many concurrent requests")
+	resp.Header.Set("Retry-After", "1")
+	return resp
+}
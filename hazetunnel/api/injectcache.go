@@ -0,0 +1,118 @@
+package api
+
+import (
+	"crypto/sha256"
+	"sync/atomic"
+)
+
+/*
+Injection result cache.
+Maps a digest of (payload, content kind, input) to the rewritten output, so
+repeated scripts and pages are only rewritten once.
+*/
+
+const defaultInjectCacheSize = 64 * 1024 * 1024
+
+type injectKind string
+
+const (
+	injectJS             injectKind = "js"
+	injectHTML           injectKind = "html"
+	injectEmbeddedScript injectKind = "script"
+)
+
+// Distinguishes results for the same input under a Content-Encoding
+func (k injectKind) encoded(encoding string) injectKind {
+	if encoding == "" {
+		return k
+	}
+	return k + ":" + injectKind(encoding)
+}
+
+type injectionCache struct {
+	entries *lruCache[[sha256.Size]byte, string]
+	hits    atomic.Uint64
+	misses  atomic.Uint64
+}
+
+type InjectCacheStats struct {
+	Hits    uint64 `json:"hits"`
+	Misses  uint64 `json:"misses"`
+	Entries int    `json:"entries"`
+	Bytes   int64  `json:"bytes"`
+}
+
+func newInjectionCache(maxBytes int64) *injectionCache {
+	return &injectionCache{
+		entries: newLRUCache[[sha256.Size]byte, string](maxBytes,
+			func(value string) int64 { return int64(len(value)) }, nil),
+	}
+}
+
+// Stats is empty when the cache is disabled
+func (c *injectionCache) Stats() InjectCacheStats {
+	if c == nil {
+		return InjectCacheStats{}
+	}
+	return InjectCacheStats{
+		Hits:    c.hits.Load(),
+		Misses:  c.misses.Load(),
+		Entries: c.entries.Len(),
+		Bytes:   c.entries.Cost(),
+	}
+}
+
+// Returns the cached output for (payload, kind, input), or computes and stores it
+func cachedInjection[T string | []byte](c *injectionCache, payload *preparedPayload, kind injectKind, input T, compute func() string) string {
+	if c == nil {
+		return compute()
+	}
+	key := injectionKey(payload, kind, input)
+	if out, ok := c.Get(key); ok {
+		return out
+	}
+	out := compute()
+	c.Add(key, out)
+	return out
+}
+
+// Get returns a cached output, counting the hit or miss
+func (c *injectionCache) Get(key [sha256.Size]byte) (string, bool) {
+	if c == nil {
+		return "", false
+	}
+	out, ok := c.entries.Get(key)
+	if ok {
+		c.hits.Add(1)
+	} else {
+		c.misses.Add(1)
+	}
+	return out, ok
+}
+
+func (c *injectionCache) Add(key [sha256.Size]byte, out string) {
+	if c != nil {
+		c.entries.Add(key, out)
+	}
+}
+
+// Payload code along with its digest, computed once per payload
+type preparedPayload struct {
+	code   string
+	digest [sha256.Size]byte
+}
+
+func preparePayload(code string) *preparedPayload {
+	return &preparedPayload{code: code, digest: sha256.Sum256([]byte(code))}
+}
+
+func injectionKey[T string | []byte](payload *preparedPayload, kind injectKind, input T) [sha256.Size]byte {
+	h := sha256.New()
+	h.Write(payload.digest[:])
+	h.Write([]byte(kind))
+	h.Write([]byte{0})
+	h.Write([]byte(input))
+	var key [sha256.Size]byte
+	h.Sum(key[:0])
+	return key
+}
@@ -1,28 +1,62 @@
 package api
 
 import (
+	"bytes"
 	"io"
 	"net/http"
 	"regexp"
+	"strconv"
 	"strings"
+	"time"
 
 	"github.com/cristalhq/base64"
 
 	"github.com/elazarl/goproxy"
 )
 
-func PayloadInjector(resp *http.Response, ctx *goproxy.ProxyCtx) *http.Response {
-	if resp == nil || resp.Body == nil {
+type PayloadInjector struct {
+	// Rewrite bodies as they are read instead of buffering them
+	stream bool
+	// Previously injected results, nil when disabled
+	cache *injectionCache
+	// Pooled compressors for encoded responses
+	codecs *codecPool
+	// Instance metrics
+	metrics *Metrics
+}
+
+func NewPayloadInjector(Flags *ProxySetup, metrics *Metrics) *PayloadInjector {
+	pi := &PayloadInjector{
+		stream:  Flags.StreamInjection,
+		codecs:  newCodecPool(Flags.CompressionLevel),
+		metrics: metrics,
+	}
+	switch {
+	case Flags.InjectCacheSize == 0:
+		pi.cache = newInjectionCache(defaultInjectCacheSize)
+	case Flags.InjectCacheSize > 0:
+		pi.cache = newInjectionCache(Flags.InjectCacheSize)
+	}
+	metrics.injectCache = pi.cache
+	return pi
+}
+
+func (pi *PayloadInjector) Inject(resp *http.Response, ctx *goproxy.ProxyCtx) *http.Response {
+	if resp == nil || resp.Body == nil || resp.Body == http.NoBody {
+		return resp
+	}
+	// Cached bodies were injected before they were stored
+	if _, ok := resp.Body.(*cachedBody); ok {
 		return resp
 	}
 
-	// Retrieve the payload code from the request's context
-	payload, ok := ctx.Req.Context().Value(payloadKey).(string)
+	// Retrieve the session's payload from the request's context
+	payload, ok := ctx.Req.Context().Value(payloadKey).(*preparedPayload)
 	if !ok {
 		ctx.Warnf("Error was returned. Skipping payload injection...")
 		return resp
 	}
-	if payload == "" {
+	if payload.code == "" {
 		ctx.Logf("No payload was passed")
 		return resp
 	}
@@ -30,52 +64,184 @@ func PayloadInjector(resp *http.Response, ctx *goproxy.ProxyCtx) *http.Response
 	contentType := resp.Header.Get("Content-Type")
 	ctx.Logf("Content-Type: %s", contentType)
 
-	if strings.HasPrefix(contentType, "text/html") {
-		// Inject into base64 encoded parts
-		body, err := io.ReadAll(resp.Body)
-		if err != nil {
-			ctx.Warnf("Failed to read response body: %v", err)
-			return resp
-		}
+	kind, ok := injectKindFor(contentType)
+	if !ok {
+		// Passed through untouched, compressed or not
+		return resp
+	}
+	encoding := contentEncoding(resp.Header)
+	if !supportedEncoding(encoding) {
+		ctx.Warnf("Unsupported Content-Encoding %q. Skipping payload injection...", encoding)
+		return resp
+	}
+
+	pi.metrics.injections.Add(1)
+	if record := accessRecordFrom(ctx.Req.Context()); record != nil {
+		record.Injected = true
+	}
+	// Bodies without a known length may be streamed or long-polled, so they
+	// are never held back until they end
+	if pi.stream || resp.ContentLength < 0 {
+		pi.injectStream(resp, kind, encoding, payload, ctx)
+		return resp
+	}
+	start := time.Now()
+
+	// Bodies that don't fit the memory budget are injected while streaming instead
+	budget := getMemoryBudget()
+	raw, reserved, ok, err := budget.ReadBody(ctx.Req.Context(), resp)
+	if err != nil {
+		// Part of the body has been consumed, so it can't be passed on
+		budget.Release(reserved)
 		resp.Body.Close()
+		pi.metrics.Error(errUpstream)
+		return upstreamBodyErrorResponse(ctx.Req, ctx, err)
+	}
+	if !ok {
+		ctx.Logf("Response body is over the memory budget, streaming it instead")
+		pi.injectStream(resp, kind, encoding, payload, ctx)
+		return resp
+	}
+	resp.Body.Close()
 
-		html := string(body)
-		html = injectPayloadIntoHTML(html, payload, ctx)
+	out, ok := pi.injectBuffered(raw, kind, encoding, payload, budget, ctx)
+	if !ok {
+		ctx.Logf("Decoded response body is over the memory budget, streaming it instead")
+		resp.Body = io.NopCloser(bytes.NewReader(raw))
+		pi.injectStream(resp, kind, encoding, payload, ctx)
+		releaseOnClose(resp, func() { budget.Release(reserved) })
+		return resp
+	}
+	pi.metrics.injectionTime.Observe(time.Since(start))
+	setBufferedBody(resp, out)
+	// The reservation is held until the rewritten body has been sent
+	releaseOnClose(resp, func() { budget.Release(reserved) })
+	return resp
+}
 
-		resp.Body = io.NopCloser(strings.NewReader(html))
-	} else if strings.HasPrefix(contentType, "application/javascript") || strings.HasPrefix(contentType, "text/javascript") {
-		body, err := io.ReadAll(resp.Body)
+// Injects into a whole body. Decoding is charged to the budget as it goes,
+// since compressed bodies can expand many times over, and ok is false if the
+// decoded body doesn't fit.
+func (pi *PayloadInjector) injectBuffered(raw []byte, kind injectKind, encoding string, payload *preparedPayload, budget *memoryBudget, ctx *goproxy.ProxyCtx) (out string, ok bool) {
+	key := injectionKey(payload, kind.encoded(encoding), raw)
+	if out, ok := pi.cache.Get(key); ok {
+		return out, true
+	}
+
+	body := raw
+	if encoding != "" {
+		reader := pi.codecs.NewReader(encoding, io.NopCloser(bytes.NewReader(raw)))
+		decoded, reserved, ok, err := budget.ReadDecoded(reader)
+		reader.Close()
 		if err != nil {
-			ctx.Warnf("Failed to read response body: %v", err)
-			return resp
+			ctx.Warnf("Failed to decode %s response body: %v", encoding, err)
+			pi.metrics.Error(errInject)
+			return string(raw), true
 		}
-		resp.Body.Close()
+		if !ok {
+			return "", false
+		}
+		defer budget.Release(reserved)
+		body = decoded
+	}
 
-		script := payload + string(body)
-		resp.Body = io.NopCloser(strings.NewReader(script))
+	var injected string
+	if kind == injectHTML {
+		// Inject into base64 encoded parts
+		injected = injectPayloadIntoHTML(string(body), payload, pi.cache, ctx)
+	} else {
+		injected = payload.code + string(body)
 	}
+	out, err := pi.codecs.Encode(encoding, injected)
+	if err != nil {
+		ctx.Warnf("Failed to encode %s response body: %v", encoding, err)
+		pi.metrics.Error(errInject)
+		return string(raw), true
+	}
+	pi.cache.Add(key, out)
+	return out, true
+}
 
-	return resp
+// Rewrites the body while it is being read
+func (pi *PayloadInjector) injectStream(resp *http.Response, kind injectKind, encoding string, payload *preparedPayload, ctx *goproxy.ProxyCtx) {
+	upstream := resp.Body
+	body := pi.codecs.NewReader(encoding, upstream)
+
+	var injected io.ReadCloser
+	if kind == injectHTML {
+		injected = newHTMLInjectReader(body, payload, pi.cache, ctx)
+	} else {
+		// Send the payload first, then stream the original script behind it
+		injected = &readCloser{
+			Reader: io.MultiReader(strings.NewReader(payload.code), body),
+			Closer: body,
+		}
+	}
+
+	encoded, err := pi.codecs.NewEncodingReader(encoding, injected, upstream)
+	if err != nil {
+		// Nothing has been read yet, so the original body is still intact
+		ctx.Warnf("Failed to encode %s response body: %v", encoding, err)
+		pi.metrics.Error(errInject)
+		return
+	}
+	setStreamedBody(resp, encoded)
 }
 
-func injectPayloadIntoHTML(html string, payload string, ctx *goproxy.ProxyCtx) string {
+func injectKindFor(contentType string) (injectKind, bool) {
+	if strings.HasPrefix(contentType, "text/html") {
+		return injectHTML, true
+	} else if strings.HasPrefix(contentType, "application/javascript") || strings.HasPrefix(contentType, "text/javascript") {
+		return injectJS, true
+	}
+	return "", false
+}
+
+func setBufferedBody(resp *http.Response, body string) {
+	resp.Body = io.NopCloser(strings.NewReader(body))
+	resp.ContentLength = int64(len(body))
+	resp.Header.Set("Content-Length", strconv.Itoa(len(body)))
+}
+
+func setStreamedBody(resp *http.Response, body io.ReadCloser) {
+	// The rewritten length is unknown until the body has been read
+	resp.Body = body
+	resp.ContentLength = -1
+	resp.Header.Del("Content-Length")
+}
+
+type readCloser struct {
+	io.Reader
+	io.Closer
+}
+
+var embeddedScriptPattern = regexp.MustCompile(`data:(?:application|text)/javascript;base64,([\w+/=]+)`)
+
+func injectPayloadIntoHTML(html string, payload *preparedPayload, cache *injectionCache, ctx *goproxy.ProxyCtx) string {
 	// Inject the payload code into embedded base64 scripts within the page
-	pattern := regexp.MustCompile(`data:(?:application|text)/javascript;base64,([\w+/=]+)`)
 	ctx.Logf("Scanning for embedded scripts")
-	return pattern.ReplaceAllStringFunc(html, func(match string) string {
+	return embeddedScriptPattern.ReplaceAllStringFunc(html, func(match string) string {
 		ctx.Logf("Match found!")
 		prefix := match[:strings.Index(match, "base64,")+len("base64,")]
 		encodedScript := match[len(prefix):] // Extract the base64 encoded script
-		decodedScript, err := base64.StdEncoding.DecodeString(encodedScript)
-		if err != nil {
-			ctx.Warnf("Failed to decode base64 script: %v", err)
-			return match // Return the original match if there's an error in decoding
-		}
-		// Prepend the payload code to the decoded script
-		decodedScript = []byte(payload + string(decodedScript))
-		// Re-encode the modified script to base64
-		encodedScript = base64.StdEncoding.EncodeToString(decodedScript)
-		// Return the modified script
-		return prefix + encodedScript
+		return prefix + injectPayloadIntoBase64(encodedScript, payload, cache, ctx)
+	})
+}
+
+func injectPayloadIntoBase64(encodedScript string, payload *preparedPayload, cache *injectionCache, ctx *goproxy.ProxyCtx) string {
+	return cachedInjection(cache, payload, injectEmbeddedScript, encodedScript, func() string {
+		return rewriteBase64Script(encodedScript, payload.code, ctx)
 	})
 }
+
+func rewriteBase64Script(encodedScript string, payload string, ctx *goproxy.ProxyCtx) string {
+	decodedScript, err := base64.StdEncoding.DecodeString(encodedScript)
+	if err != nil {
+		ctx.Warnf("Failed to decode base64 script: %v", err)
+		return encodedScript // Return the original script if there's an error in decoding
+	}
+	// Prepend the payload code to the decoded script
+	decodedScript = []byte(payload + string(decodedScript))
+	// Re-encode the modified script to base64
+	return base64.StdEncoding.EncodeToString(decodedScript)
+}
@@ -0,0 +1,67 @@
+package api
+
+import (
+	"strings"
+	"testing"
+
+	"github.com/cristalhq/base64"
+
+	"github.com/elazarl/goproxy"
+)
+
+const benchPayload = `alert("Hello world!");`
+
+// HTML page of roughly size bytes with an embedded base64 script every 4KB
+func benchHTML(size int) string {
+	script := base64.StdEncoding.EncodeToString([]byte(`console.log("Original JavaScript executed.");`))
+	filler := strings.Repeat("<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n", 64)
+	var b strings.Builder
+	b.WriteString("<!DOCTYPE html><html><head><title>Testing Page</title></head><body>\n")
+	for b.Len() < size {
+		b.WriteString(`<script src="data:application/javascript;base64,` + script + `"></script>` + "\n")
+		b.WriteString(filler)
+	}
+	b.WriteString("</body></html>\n")
+	return b.String()
+}
+
+func benchCtx() *goproxy.ProxyCtx {
+	return &goproxy.ProxyCtx{Proxy: goproxy.NewProxyHttpServer()}
+}
+
+func BenchmarkInjectPayloadIntoHTML(b *testing.B) {
+	html := benchHTML(256 * 1024)
+	payload := preparePayload(benchPayload)
+	ctx := benchCtx()
+
+	b.Run("uncached", func(b *testing.B) {
+		b.SetBytes(int64(len(html)))
+		b.ReportAllocs()
+		for i := 0; i < b.N; i++ {
+			injectPayloadIntoHTML(html, payload, nil, ctx)
+		}
+	})
+	b.Run("cached", func(b *testing.B) {
+		cache := newInjectionCache(defaultInjectCacheSize)
+		b.SetBytes(int64(len(html)))
+		b.ReportAllocs()
+		for i := 0; i < b.N; i++ {
+			injectPayloadIntoHTML(html, payload, cache, ctx)
+		}
+	})
+}
+
+func TestInjectionCacheStats(t *testing.T) {
+	if stats := (*injectionCache)(nil).Stats(); stats != (InjectCacheStats{}) {
+		t.Errorf("disabled cache reported %+v", stats)
+	}
+	cache := newInjectionCache(defaultInjectCacheSize)
+	payload := preparePayload(benchPayload)
+	for _, input := range []string{"a", "b", "a", "a"} {
+		cachedInjection(cache, payload, injectJS, input, func() string { return payload.code + input })
+	}
+	want := InjectCacheStats{Hits: 2, Misses: 2, Entries: 2, Bytes: int64(2 * (len(benchPayload) + 1))}
+	if stats := cache.Stats(); stats != want {
+		t.Errorf("stats = %+v, want %+v", stats, want)
+	}
+}
@@ -0,0 +1,317 @@
+package api
+
+import (
+	"bytes"
+	"context"
+	"io"
+	"net/http"
+	"sync"
+	"sync/atomic"
+	"time"
+)
+
+/*
+Concurrency limits and the body memory budget.
+Each instance may cap its concurrent upstream requests. Requests over the cap
+wait for a slot until the queue timeout and are then refused with a 503.
+Bodies buffered for injection share a process-wide budget. A body that doesn't
+fit waits in a bounded queue, and if it still doesn't fit, it is injected
+while streaming instead, which only holds a small window in memory.
+*/
+
+const (
+	defaultQueueTimeout     = 10 * time.Second
+	defaultBodyBudget       = 256 << 20
+	defaultBodyQueueLength  = 64
+	defaultBodyQueueTimeout = 2 * time.Second
+	// Charged at a time while decoding a body
+	bodyBudgetChunk = 64 << 10
+)
+
+/*
+Request limiter
+*/
+
+type requestLimiter struct {
+	// nil when requests aren't limited
+	slots chan struct{}
+	// Negative to refuse requests right away when every slot is taken
+	timeout time.Duration
+	metrics *Metrics
+}
+
+func newRequestLimiter(Flags *ProxySetup, metrics *Metrics) *requestLimiter {
+	l := &requestLimiter{
+		timeout: durationSetting(Flags.QueueTimeout, time.Second, defaultQueueTimeout),
+		metrics: metrics,
+	}
+	if Flags.MaxRequests > 0 {
+		l.slots = make(chan struct{}, Flags.MaxRequests)
+	}
+	return l
+}
+
+// Acquire takes a slot for an upstream request, waiting until the queue timeout.
+// The returned function releases it, and is nil if no slot was free.
+func (l *requestLimiter) Acquire(ctx context.Context) func() {
+	if l.slots == nil {
+		return func() {}
+	}
+	select {
+	case l.slots <- struct{}{}:
+		return l.release
+	default:
+	}
+	if l.timeout < 0 {
+		l.metrics.rejections.Add(1)
+		return nil
+	}
+
+	start := time.Now()
+	timer := time.NewTimer(l.timeout)
+	defer timer.Stop()
+	select {
+	case l.slots <- struct{}{}:
+		l.metrics.queueWait.Observe(time.Since(start))
+		return l.release
+	case <-timer.C:
+	case <-ctx.Done():
+	}
+	l.metrics.queueWait.Observe(time.Since(start))
+	l.metrics.rejections.Add(1)
+	return nil
+}
+
+func (l *requestLimiter) release() {
+	<-l.slots
+}
+
+// Releases the request's slot once its body is closed
+func releaseOnClose(resp *http.Response, release func()) {
+	if resp.Body == nil || resp.Body == http.NoBody {
+		release()
+		return
+	}
+	resp.Body = &releasingBody{ReadCloser: resp.Body, release: release}
+}
+
+type releasingBody struct {
+	io.ReadCloser
+	release func()
+	once    sync.Once
+}
+
+func (b *releasingBody) Close() error {
+	err := b.ReadCloser.Close()
+	b.once.Do(b.release)
+	return err
+}
+
+/*
+Body memory budget
+*/
+
+type BudgetStats struct {
+	// Bytes, -1 when unlimited
+	Capacity int64 `json:"capacity"`
+	Used     int64 `json:"used"`
+	Queued   int   `json:"queued"`
+	// Bodies that waited for room, and those streamed because none was left
+	Waits      uint64 `json:"waits"`
+	Rejections uint64 `json:"rejections"`
+	// Time spent waiting in seconds
+	WaitTime HistogramStats `json:"wait_time"`
+}
+
+type budgetWaiter struct {
+	n     int64
+	ready chan struct{}
+}
+
+type memoryBudget struct {
+	// Negative when unlimited
+	capacity int64
+	maxQueue int
+	// Negative to stream right away instead of waiting
+	timeout time.Duration
+
+	mu      sync.Mutex
+	used    int64
+	waiters []*budgetWaiter
+
+	waits      atomic.Uint64
+	rejections atomic.Uint64
+	waitTime   histogram
+}
+
+var (
+	budgetMux     sync.RWMutex
+	currentBudget *memoryBudget
+)
+
+// Builds a budget from the process-wide config
+func newMemoryBudget() *memoryBudget {
+	b := &memoryBudget{
+		capacity: Config.BodyBudget,
+		maxQueue: Config.BodyQueueLength,
+		timeout:  durationSetting(Config.BodyQueueTimeout, time.Millisecond, defaultBodyQueueTimeout),
+	}
+	if b.capacity == 0 {
+		b.capacity = defaultBodyBudget
+	}
+	if b.maxQueue == 0 {
+		b.maxQueue = defaultBodyQueueLength
+	}
+	return b
+}
+
+// Replaces the process-wide budget for the current config.
+// Bodies holding the previous budget release into it.
+func resetMemoryBudget() {
+	budgetMux.Lock()
+	defer budgetMux.Unlock()
+	currentBudget = newMemoryBudget()
+}
+
+func getMemoryBudget() *memoryBudget {
+	budgetMux.RLock()
+	b := currentBudget
+	budgetMux.RUnlock()
+	if b != nil {
+		return b
+	}
+
+	budgetMux.Lock()
+	defer budgetMux.Unlock()
+	if currentBudget == nil {
+		currentBudget = newMemoryBudget()
+	}
+	return currentBudget
+}
+
+// TryAcquire reserves n bytes if they fit right away
+func (b *memoryBudget) TryAcquire(n int64) bool {
+	if b.capacity < 0 {
+		return true
+	}
+	b.mu.Lock()
+	defer b.mu.Unlock()
+	// Queued bodies go first
+	if len(b.waiters) == 0 && b.used+n <= b.capacity {
+		b.used += n
+		return true
+	}
+	return false
+}
+
+// Acquire reserves n bytes, waiting in the queue until they fit or the queue timeout passes
+func (b *memoryBudget) Acquire(ctx context.Context, n int64) bool {
+	if b.TryAcquire(n) {
+		return true
+	}
+	b.mu.Lock()
+	if n > b.capacity || b.timeout < 0 || len(b.waiters) >= b.maxQueue {
+		b.mu.Unlock()
+		b.rejections.Add(1)
+		return false
+	}
+	waiter := &budgetWaiter{n: n, ready: make(chan struct{})}
+	b.waiters = append(b.waiters, waiter)
+	b.mu.Unlock()
+
+	b.waits.Add(1)
+	start := time.Now()
+	timer := time.NewTimer(b.timeout)
+	defer timer.Stop()
+	select {
+	case <-waiter.ready:
+		b.waitTime.Observe(time.Since(start))
+		return true
+	case <-timer.C:
+	case <-ctx.Done():
+	}
+	b.waitTime.Observe(time.Since(start))
+
+	b.mu.Lock()
+	for i, w := range b.waiters {
+		if w == waiter {
+			b.waiters = append(b.waiters[:i], b.waiters[i+1:]...)
+			b.mu.Unlock()
+			b.rejections.Add(1)
+			return false
+		}
+	}
+	b.mu.Unlock()
+	// Granted while timing out
+	return true
+}
+
+// Release returns n bytes and hands them to queued bodies in order
+func (b *memoryBudget) Release(n int64) {
+	if b.capacity < 0 || n == 0 {
+		return
+	}
+	b.mu.Lock()
+	defer b.mu.Unlock()
+	b.used -= n
+	for len(b.waiters) > 0 && b.used+b.waiters[0].n <= b.capacity {
+		b.used += b.waiters[0].n
+		close(b.waiters[0].ready)
+		b.waiters = b.waiters[1:]
+	}
+}
+
+func (b *memoryBudget) Stats() BudgetStats {
+	b.mu.Lock()
+	used, queued := b.used, len(b.waiters)
+	b.mu.Unlock()
+	return BudgetStats{
+		Capacity:   b.capacity,
+		Used:       used,
+		Queued:     queued,
+		Waits:      b.waits.Load(),
+		Rejections: b.rejections.Load(),
+		WaitTime:   b.waitTime.Stats(),
+	}
+}
+
+// Reads a response body of known length into memory within the budget,
+// returning the reserved bytes. ok is false if the budget runs out, leaving
+// the body unread. Bodies of unknown length are streamed instead.
+func (b *memoryBudget) ReadBody(ctx context.Context, resp *http.Response) (raw []byte, reserved int64, ok bool, err error) {
+	reserved = resp.ContentLength
+	if !b.Acquire(ctx, reserved) {
+		return nil, 0, false, nil
+	}
+	// The transport enforces the length, so the body fits the reservation
+	var buf bytes.Buffer
+	buf.Grow(int(reserved))
+	_, err = buf.ReadFrom(resp.Body)
+	return buf.Bytes(), reserved, err == nil, err
+}
+
+// Reads a decoded body into memory, charging it to the budget as it grows
+// without waiting in the queue. ok is false if the budget runs out, in which
+// case nothing stays reserved.
+func (b *memoryBudget) ReadDecoded(r io.Reader) (body []byte, reserved int64, ok bool, err error) {
+	var buf bytes.Buffer
+	for {
+		if int64(buf.Len()) == reserved {
+			if !b.TryAcquire(bodyBudgetChunk) {
+				b.Release(reserved)
+				b.rejections.Add(1)
+				return nil, 0, false, nil
+			}
+			reserved += bodyBudgetChunk
+		}
+		if _, err = buf.ReadFrom(io.LimitReader(r, reserved-int64(buf.Len()))); err != nil {
+			b.Release(reserved)
+			return nil, 0, false, err
+		}
+		if int64(buf.Len()) < reserved {
+			// Reached the end of the body
+			b.Release(reserved - int64(buf.Len()))
+			return buf.Bytes(), int64(buf.Len()), true, nil
+		}
+	}
+}
@@ -0,0 +1,215 @@
+package api
+
+import (
+	"bytes"
+	"context"
+	"testing"
+	"time"
+)
+
+func TestRequestLimiter(t *testing.T) {
+	tests := []struct {
+		name    string
+		timeout time.Duration
+		cancel  bool
+		// Whether a slot is freed while the second request waits
+		release bool
+		want    bool
+	}{
+		{"handed off", time.Second, false, true, true},
+		{"timed out", 10 * time.Millisecond, false, false, false},
+		{"cancelled", time.Second, true, false, false},
+		{"no queue", -1, false, false, false},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			metrics := &Metrics{}
+			l := &requestLimiter{slots: make(chan struct{}, 1), timeout: tt.timeout, metrics: metrics}
+			first := l.Acquire(context.Background())
+			if first == nil {
+				t.Fatal("first request was refused")
+			}
+
+			ctx, cancel := context.WithCancel(context.Background())
+			defer cancel()
+			switch {
+			case tt.release:
+				time.AfterFunc(10*time.Millisecond, first)
+			case tt.cancel:
+				time.AfterFunc(10*time.Millisecond, cancel)
+			}
+			second := l.Acquire(ctx)
+			if (second != nil) != tt.want {
+				t.Fatalf("second request granted = %v, want %v", second != nil, tt.want)
+			}
+
+			var rejections uint64
+			if !tt.want {
+				rejections = 1
+			}
+			if got := metrics.rejections.Load(); got != rejections {
+				t.Errorf("rejections = %d, want %d", got, rejections)
+			}
+			if tt.timeout >= 0 && metrics.queueWait.count.Load() != 1 {
+				t.Error("queue wait wasn't observed")
+			}
+		})
+	}
+}
+
+// Waits until n bodies are queued on the budget
+func waitForWaiters(t *testing.T, b *memoryBudget, n int) {
+	t.Helper()
+	for i := 0; i < 1000; i++ {
+		b.mu.Lock()
+		queued := len(b.waiters)
+		b.mu.Unlock()
+		if queued == n {
+			return
+		}
+		time.Sleep(time.Millisecond)
+	}
+	t.Fatalf("%d bodies never queued", n)
+}
+
+func TestMemoryBudgetHandOff(t *testing.T) {
+	b := &memoryBudget{capacity: 100, maxQueue: 4, timeout: time.Second}
+	if !b.TryAcquire(100) {
+		t.Fatal("budget should start empty")
+	}
+
+	// Queue a large body ahead of a small one
+	granted := make(chan int64, 2)
+	for i, n := range []int64{80, 10} {
+		go func(n int64) {
+			if b.Acquire(context.Background(), n) {
+				granted <- n
+			}
+		}(n)
+		waitForWaiters(t, b, i+1)
+	}
+	if b.TryAcquire(1) {
+		t.Error("TryAcquire jumped the queue")
+	}
+
+	// Enough for the small body but not the large one at the front
+	b.Release(20)
+	select {
+	case n := <-granted:
+		t.Fatalf("%d bytes were granted out of order", n)
+	case <-time.After(20 * time.Millisecond):
+	}
+	if stats := b.Stats(); stats.Used != 80 || stats.Queued != 2 {
+		t.Errorf("stats = %+v", stats)
+	}
+
+	// Both fit once the large body's bytes are back
+	b.Release(80)
+	if total := <-granted + <-granted; total != 90 {
+		t.Errorf("granted %d bytes, want 90", total)
+	}
+	if stats := b.Stats(); stats.Used != 90 || stats.Queued != 0 || stats.Waits != 2 {
+		t.Errorf("stats = %+v", stats)
+	}
+}
+
+func TestMemoryBudgetRejections(t *testing.T) {
+	tests := []struct {
+		name     string
+		maxQueue int
+		timeout  time.Duration
+		n        int64
+	}{
+		{"larger than capacity", 4, time.Second, 200},
+		{"no queue", 4, -1, 10},
+		{"queue full", 0, time.Second, 10},
+		{"timed out", 4, 10 * time.Millisecond, 10},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			b := &memoryBudget{capacity: 100, maxQueue: tt.maxQueue, timeout: tt.timeout}
+			b.TryAcquire(100)
+			if b.Acquire(context.Background(), tt.n) {
+				t.Fatal("body was granted")
+			}
+			if stats := b.Stats(); stats.Rejections != 1 || stats.Queued != 0 || stats.Used != 100 {
+				t.Errorf("stats = %+v", stats)
+			}
+		})
+	}
+}
+
+func TestMemoryBudgetGrantedWhileTimingOut(t *testing.T) {
+	b := &memoryBudget{capacity: 100, maxQueue: 4, timeout: time.Second}
+	b.TryAcquire(100)
+	ctx, cancel := context.WithCancel(context.Background())
+	granted := make(chan bool)
+	go func() { granted <- b.Acquire(ctx, 10) }()
+	waitForWaiters(t, b, 1)
+
+	// Hand the bytes over after the waiter has given up but before it
+	// gets the lock back to leave the queue
+	b.mu.Lock()
+	cancel()
+	time.Sleep(10 * time.Millisecond)
+	b.used -= 100
+	b.used += b.waiters[0].n
+	close(b.waiters[0].ready)
+	b.waiters = b.waiters[1:]
+	b.mu.Unlock()
+
+	if !<-granted {
+		t.Error("bytes handed to the waiter were dropped")
+	}
+	if stats := b.Stats(); stats.Used != 10 || stats.Rejections != 0 {
+		t.Errorf("stats = %+v", stats)
+	}
+}
+
+func TestMemoryBudgetReadDecoded(t *testing.T) {
+	tests := []struct {
+		name     string
+		capacity int64
+		size     int
+		want     bool
+	}{
+		{"empty", bodyBudgetChunk, 0, true},
+		{"one chunk", bodyBudgetChunk, bodyBudgetChunk - 1, true},
+		{"exact chunk", 2 * bodyBudgetChunk, bodyBudgetChunk, true},
+		{"several chunks", 4 * bodyBudgetChunk, 3*bodyBudgetChunk + 5, true},
+		{"over budget", 2 * bodyBudgetChunk, 2*bodyBudgetChunk + 1, false},
+		{"unlimited", -1, 3 * bodyBudgetChunk, true},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			b := &memoryBudget{capacity: tt.capacity, timeout: time.Second}
+			input := bytes.Repeat([]byte("a"), tt.size)
+			body, reserved, ok, err := b.ReadDecoded(bytes.NewReader(input))
+			if err != nil {
+				t.Fatal(err)
+			}
+			if ok != tt.want {
+				t.Fatalf("ok = %v, want %v", ok, tt.want)
+			}
+
+			var used, rejections int64
+			if ok {
+				if !bytes.Equal(body, input) {
+					t.Errorf("read %d bytes, want %d", len(body), len(input))
+				}
+				if reserved != int64(tt.size) {
+					t.Errorf("reserved %d, want %d", reserved, tt.size)
+				}
+				used = reserved
+			} else {
+				rejections = 1
+			}
+			if tt.capacity < 0 {
+				used = 0
+			}
+			if stats := b.Stats(); stats.Used != used || int64(stats.Rejections) != rejections {
+				t.Errorf("stats = %+v", stats)
+			}
+		})
+	}
+}
@@ -0,0 +1,41 @@
+package api
+
+import (
+	"context"
+	"net"
+	"strconv"
+)
+
+/*
+Listener sharding.
+An instance may bind several listeners to the same port with SO_REUSEPORT,
+each with its own accept loop. The kernel spreads new connections across
+them, so accepting and TLS handshakes aren't funnelled through one goroutine.
+*/
+
+// Binds n listeners to the address. The first one resolves port 0 and the
+// others share its port.
+func listen(host, port string, n int) ([]net.Listener, error) {
+	if n <= 1 {
+		listener, err := net.Listen("tcp", net.JoinHostPort(host, port))
+		if err != nil {
+			return nil, err
+		}
+		return []net.Listener{listener}, nil
+	}
+
+	config := net.ListenConfig{Control: reusePort}
+	listeners := make([]net.Listener, 0, n)
+	for len(listeners) < n {
+		listener, err := config.Listen(context.Background(), "tcp", net.JoinHostPort(host, port))
+		if err != nil {
+			for _, l := range listeners {
+				l.Close()
+			}
+			return nil, err
+		}
+		port = strconv.Itoa(listener.Addr().(*net.TCPAddr).Port)
+		listeners = append(listeners, listener)
+	}
+	return listeners, nil
+}
@@ -0,0 +1,182 @@
+package api
+
+import (
+	"container/list"
+	"sync"
+)
+
+// Thread-safe LRU cache bounded by total cost.
+// When sizeOf is nil, every entry costs 1 and maxCost is an entry count.
+type lruCache[K comparable, V any] struct {
+	mu      sync.Mutex
+	maxCost int64
+	cost    int64
+	ll      *list.List
+	items   map[K]*list.Element
+	sizeOf  func(V) int64
+	onEvict func(K, V)
+}
+
+type lruEntry[K comparable, V any] struct {
+	key   K
+	value V
+	cost  int64
+}
+
+func newLRUCache[K comparable, V any](maxCost int64, sizeOf func(V) int64, onEvict func(K, V)) *lruCache[K, V] {
+	return &lruCache[K, V]{
+		maxCost: maxCost,
+		ll:      list.New(),
+		items:   make(map[K]*list.Element),
+		sizeOf:  sizeOf,
+		onEvict: onEvict,
+	}
+}
+
+func (c *lruCache[K, V]) entryCost(value V) int64 {
+	if c.sizeOf == nil {
+		return 1
+	}
+	return c.sizeOf(value)
+}
+
+// Get returns the value for key and marks it as recently used
+func (c *lruCache[K, V]) Get(key K) (V, bool) {
+	c.mu.Lock()
+	defer c.mu.Unlock()
+	if elem, ok := c.items[key]; ok {
+		c.ll.MoveToFront(elem)
+		return elem.Value.(*lruEntry[K, V]).value, true
+	}
+	var zero V
+	return zero, false
+}
+
+// GetOrAdd returns the value for key, storing the result of create if it is missing
+func (c *lruCache[K, V]) GetOrAdd(key K, create func() V) V {
+	c.mu.Lock()
+	if elem, ok := c.items[key]; ok {
+		c.ll.MoveToFront(elem)
+		c.mu.Unlock()
+		return elem.Value.(*lruEntry[K, V]).value
+	}
+	value := create()
+	cost := c.entryCost(value)
+	c.items[key] = c.ll.PushFront(&lruEntry[K, V]{key: key, value: value, cost: cost})
+	c.cost += cost
+	var evicted []*lruEntry[K, V]
+	for c.maxCost > 0 && c.cost > c.maxCost && c.ll.Len() > 1 {
+		evicted = append(evicted, c.removeElement(c.ll.Back()))
+	}
+	c.mu.Unlock()
+
+	c.notify(evicted)
+	return value
+}
+
+// Add inserts or replaces the value for key, evicting the least recently used
+// entries until the cache fits in maxCost again.
+// Values that are larger than the whole cache are not stored.
+func (c *lruCache[K, V]) Add(key K, value V) bool {
+	cost := c.entryCost(value)
+	if c.maxCost > 0 && cost > c.maxCost {
+		return false
+	}
+
+	c.mu.Lock()
+	var evicted []*lruEntry[K, V]
+	if elem, ok := c.items[key]; ok {
+		entry := elem.Value.(*lruEntry[K, V])
+		c.cost += cost - entry.cost
+		entry.value, entry.cost = value, cost
+		c.ll.MoveToFront(elem)
+	} else {
+		c.items[key] = c.ll.PushFront(&lruEntry[K, V]{key: key, value: value, cost: cost})
+		c.cost += cost
+	}
+	for c.maxCost > 0 && c.cost > c.maxCost {
+		evicted = append(evicted, c.removeElement(c.ll.Back()))
+	}
+	c.mu.Unlock()
+
+	c.notify(evicted)
+	return true
+}
+
+// Remove deletes key from the cache
+func (c *lruCache[K, V]) Remove(key K) {
+	c.mu.Lock()
+	var evicted []*lruEntry[K, V]
+	if elem, ok := c.items[key]; ok {
+		evicted = append(evicted, c.removeElement(elem))
+	}
+	c.mu.Unlock()
+
+	c.notify(evicted)
+}
+
+// RemoveIf deletes key if its current value matches, so a value replaced
+// concurrently isn't removed in its place
+func (c *lruCache[K, V]) RemoveIf(key K, match func(V) bool) bool {
+	c.mu.Lock()
+	var evicted []*lruEntry[K, V]
+	if elem, ok := c.items[key]; ok && match(elem.Value.(*lruEntry[K, V]).value) {
+		evicted = append(evicted, c.removeElement(elem))
+	}
+	c.mu.Unlock()
+
+	c.notify(evicted)
+	return len(evicted) > 0
+}
+
+// EvictOldest removes entries from the least recently used end for as long as
+// stale reports true
+func (c *lruCache[K, V]) EvictOldest(stale func(K, V) bool) int {
+	c.mu.Lock()
+	var evicted []*lruEntry[K, V]
+	for elem := c.ll.Back(); elem != nil; elem = c.ll.Back() {
+		entry := elem.Value.(*lruEntry[K, V])
+		if !stale(entry.key, entry.value) {
+			break
+		}
+		evicted = append(evicted, c.removeElement(elem))
+	}
+	c.mu.Unlock()
+
+	c.notify(evicted)
+	return len(evicted)
+}
+
+// Purge removes every entry
+func (c *lruCache[K, V]) Purge() {
+	c.EvictOldest(func(K, V) bool { return true })
+}
+
+func (c *lruCache[K, V]) Len() int {
+	c.mu.Lock()
+	defer c.mu.Unlock()
+	return c.ll.Len()
+}
+
+func (c *lruCache[K, V]) Cost() int64 {
+	c.mu.Lock()
+	defer c.mu.Unlock()
+	return c.cost
+}
+
+func (c *lruCache[K, V]) removeElement(elem *list.Element) *lruEntry[K, V] {
+	entry := c.ll.Remove(elem).(*lruEntry[K, V])
+	delete(c.items, entry.key)
+	c.cost -= entry.cost
+	return entry
+}
+
+func (c *lruCache[K, V]) notify(evicted []*lruEntry[K, V]) {
+	// Eviction callbacks run outside of the lock
+	if c.onEvict == nil {
+		return
+	}
+	for _, entry := range evicted {
+		c.onEvict(entry.key, entry.value)
+	}
+}
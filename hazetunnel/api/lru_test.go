@@ -0,0 +1,24 @@
+package api
+
+import "testing"
+
+func TestLRUCacheRemoveIf(t *testing.T) {
+	stale, fresh := new(int), new(int)
+	cache := newLRUCache[string, *int](16, nil, nil)
+	cache.Add("host", stale)
+	// A concurrent lookup replaced the entry that was read
+	cache.Add("host", fresh)
+
+	if cache.RemoveIf("host", func(v *int) bool { return v == stale }) {
+		t.Error("removed an entry that was replaced")
+	}
+	if v, ok := cache.Get("host"); !ok || v != fresh {
+		t.Fatal("replacement was lost")
+	}
+	if !cache.RemoveIf("host", func(v *int) bool { return v == fresh }) {
+		t.Error("matching entry wasn't removed")
+	}
+	if cache.Len() != 0 || cache.RemoveIf("host", func(*int) bool { return true }) {
+		t.Error("missing key was removed")
+	}
+}
@@ -0,0 +1,286 @@
+package api
+
+import (
+	"fmt"
+	"io"
+	"net/http"
+	"strings"
+	"sync/atomic"
+	"time"
+)
+
+/*
+Per-instance runtime metrics.
+Counters and histogram buckets are plain atomics, so recording never takes a
+lock. Snapshots are read without stopping writers and may be slightly skewed
+between fields.
+*/
+
+const metricsPath = "/metrics"
+
+type errorKind int
+
+const (
+	errSession errorKind = iota
+	errUserAgent
+	errHandshake
+	errUpstream
+	errInject
+	numErrorKinds
+)
+
+var errorKindNames = [numErrorKinds]string{
+	errSession:   "session",
+	errUserAgent: "user_agent",
+	errHandshake: "handshake",
+	errUpstream:  "upstream",
+	errInject:    "inject",
+}
+
+// Upper bounds in seconds, matching the Prometheus client defaults
+var latencyBuckets = []float64{0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10}
+
+type histogram struct {
+	// One counter per bucket in latencyBuckets, plus one for values above the last bound
+	counts [14]atomic.Uint64
+	count  atomic.Uint64
+	sumNs  atomic.Uint64
+}
+
+func (h *histogram) Observe(d time.Duration) {
+	seconds := d.Seconds()
+	i := 0
+	for i < len(latencyBuckets) && seconds > latencyBuckets[i] {
+		i++
+	}
+	h.counts[i].Add(1)
+	h.count.Add(1)
+	h.sumNs.Add(uint64(max(d, 0)))
+}
+
+type HistogramStats struct {
+	Count uint64  `json:"count"`
+	Sum   float64 `json:"sum"`
+	// Cumulative count per upper bound, keyed like Prometheus' "le" label
+	Buckets map[string]uint64 `json:"buckets"`
+}
+
+func (h *histogram) Stats() HistogramStats {
+	stats := HistogramStats{
+		Count:   h.count.Load(),
+		Sum:     time.Duration(h.sumNs.Load()).Seconds(),
+		Buckets: make(map[string]uint64, len(h.counts)),
+	}
+	var cumulative uint64
+	for i := range h.counts {
+		cumulative += h.counts[i].Load()
+		stats.Buckets[bucketLabel(i)] = cumulative
+	}
+	return stats
+}
+
+func bucketLabel(i int) string {
+	if i == len(latencyBuckets) {
+		return "+Inf"
+	}
+	return fmt.Sprint(latencyBuckets[i])
+}
+
+type Metrics struct {
+	requests   atomic.Uint64
+	connects   atomic.Uint64
+	tunnels    atomic.Uint64
+	bytesIn    atomic.Uint64
+	bytesOut   atomic.Uint64
+	injections atomic.Uint64
+	// Upstream handshakes that resumed a cached TLS session
+	resumptions atomic.Uint64
+	errors      [numErrorKinds]atomic.Uint64
+	// Open connections and requests being handled, kept by the connection tracker
+	clientConns    atomic.Int64
+	upstreamConns  atomic.Int64
+	activeRequests atomic.Int64
+	// Open WebSocket relays
+	websockets atomic.Int64
+	// Requests refused because every upstream request slot was taken
+	rejections atomic.Uint64
+	// The instance's injection results, set by its payload injector
+	injectCache *injectionCache
+
+	handshake     histogram
+	firstByte     histogram
+	injectionTime histogram
+	queueWait     histogram
+}
+
+type MetricsStats struct {
+	Requests    uint64            `json:"requests"`
+	Connects    uint64            `json:"connects"`
+	Tunnels     uint64            `json:"tunnels"`
+	BytesIn     uint64            `json:"bytes_in"`
+	BytesOut    uint64            `json:"bytes_out"`
+	Injections  uint64            `json:"injections"`
+	Resumptions uint64            `json:"resumptions"`
+	Errors      map[string]uint64 `json:"errors"`
+	// Currently open
+	ClientConns    int64  `json:"client_connections"`
+	UpstreamConns  int64  `json:"upstream_connections"`
+	ActiveRequests int64  `json:"active_requests"`
+	WebSockets     int64  `json:"websockets"`
+	Rejections     uint64 `json:"rejections"`
+	// Latencies in seconds
+	Handshake     HistogramStats   `json:"handshake"`
+	FirstByte     HistogramStats   `json:"first_byte"`
+	InjectionTime HistogramStats   `json:"injection_time"`
+	QueueWait     HistogramStats   `json:"queue_wait"`
+	InjectCache   InjectCacheStats `json:"inject_cache"`
+	// DNS cache, body memory budget and response cache shared by every instance in the process
+	DNS        ResolverStats `json:"dns"`
+	BodyBudget BudgetStats   `json:"body_budget"`
+	// Left out until the response cache is first used
+	ResponseCache *ResponseCacheStats `json:"response_cache,omitempty"`
+	// Upstream proxy health, filled in by the instance
+	Upstreams []UpstreamStats `json:"upstreams,omitempty"`
+}
+
+func (m *Metrics) Error(kind errorKind) {
+	m.errors[kind].Add(1)
+}
+
+func (m *Metrics) Stats() MetricsStats {
+	stats := MetricsStats{
+		Requests:       m.requests.Load(),
+		Connects:       m.connects.Load(),
+		Tunnels:        m.tunnels.Load(),
+		BytesIn:        m.bytesIn.Load(),
+		BytesOut:       m.bytesOut.Load(),
+		Injections:     m.injections.Load(),
+		Resumptions:    m.resumptions.Load(),
+		Errors:         make(map[string]uint64, numErrorKinds),
+		ClientConns:    m.clientConns.Load(),
+		UpstreamConns:  m.upstreamConns.Load(),
+		ActiveRequests: m.activeRequests.Load(),
+		WebSockets:     m.websockets.Load(),
+		Rejections:     m.rejections.Load(),
+		Handshake:      m.handshake.Stats(),
+		FirstByte:      m.firstByte.Stats(),
+		InjectionTime:  m.injectionTime.Stats(),
+		QueueWait:      m.queueWait.Stats(),
+		InjectCache:    m.injectCache.Stats(),
+		DNS:            getUpstreamDialer().resolver.Stats(),
+		BodyBudget:     getMemoryBudget().Stats(),
+		ResponseCache:  responseCacheStats(),
+	}
+	for kind, name := range errorKindNames {
+		stats.Errors[name] = m.errors[kind].Load()
+	}
+	return stats
+}
+
+// Counts the bytes of a response body as they are read
+func countBody(resp *http.Response, counter *atomic.Uint64) {
+	if resp == nil || resp.Body == nil || resp.Body == http.NoBody {
+		return
+	}
+	resp.Body = &countingReader{ReadCloser: resp.Body, counter: counter}
+}
+
+type countingReader struct {
+	io.ReadCloser
+	counter *atomic.Uint64
+}
+
+func (r *countingReader) Read(p []byte) (int, error) {
+	n, err := r.ReadCloser.Read(p)
+	r.counter.Add(uint64(n))
+	return n, err
+}
+
+/*
+Prometheus text exposition
+*/
+
+// Serves the metrics on the proxy listener for requests that aren't proxied
+func (m *Metrics) Handler(next http.Handler) http.Handler {
+	return http.HandlerFunc(func(w http.ResponseWriter, req *http.Request) {
+		if req.URL.Path != metricsPath {
+			next.ServeHTTP(w, req)
+			return
+		}
+		w.Header().Set("Content-Type", "text/plain; version=0.0.4")
+		io.WriteString(w, m.Prometheus())
+	})
+}
+
+func (m *Metrics) Prometheus() string {
+	stats := m.Stats()
+	var b strings.Builder
+	writeCounter(&b, "hazetunnel_requests_total", "Proxied requests", stats.Requests)
+	writeCounter(&b, "hazetunnel_connects_total", "CONNECT requests", stats.Connects)
+	writeCounter(&b, "hazetunnel_tunnels_total", "CONNECTs tunneled without interception", stats.Tunnels)
+	writeCounter(&b, "hazetunnel_bytes_in_total", "Response body bytes received from upstream", stats.BytesIn)
+	writeCounter(&b, "hazetunnel_bytes_out_total", "Response body bytes sent to clients", stats.BytesOut)
+	writeCounter(&b, "hazetunnel_injections_total", "Responses with an injected payload", stats.Injections)
+	writeCounter(&b, "hazetunnel_resumptions_total", "Upstream TLS handshakes that resumed a session", stats.Resumptions)
+	writeGauge(&b, "hazetunnel_client_connections", "Open client connections", stats.ClientConns)
+	writeGauge(&b, "hazetunnel_upstream_connections", "Open upstream connections", stats.UpstreamConns)
+	writeGauge(&b, "hazetunnel_active_requests", "Requests and CONNECTs being handled", stats.ActiveRequests)
+	writeGauge(&b, "hazetunnel_websockets", "Open WebSocket relays", stats.WebSockets)
+	writeCounter(&b, "hazetunnel_rejections_total", "Requests refused because every upstream request slot was taken", stats.Rejections)
+
+	fmt.Fprintf(&b, "# HELP hazetunnel_errors_total Errors by kind\n# TYPE hazetunnel_errors_total counter\n")
+	for _, name := range errorKindNames {
+		fmt.Fprintf(&b, "hazetunnel_errors_total{kind=%q} %d\n", name, stats.Errors[name])
+	}
+
+	writeHistogram(&b, "hazetunnel_handshake_seconds", "Upstream TLS handshake time", stats.Handshake)
+	writeHistogram(&b, "hazetunnel_first_byte_seconds", "Time to the upstream response headers", stats.FirstByte)
+	writeHistogram(&b, "hazetunnel_injection_seconds", "Time spent injecting buffered responses", stats.InjectionTime)
+	writeHistogram(&b, "hazetunnel_queue_wait_seconds", "Time requests waited for an upstream request slot", stats.QueueWait)
+
+	writeCounter(&b, "hazetunnel_inject_cache_hits_total", "Injections answered from the injection cache", stats.InjectCache.Hits)
+	writeCounter(&b, "hazetunnel_inject_cache_misses_total", "Injections computed and stored in the injection cache", stats.InjectCache.Misses)
+	writeGauge(&b, "hazetunnel_inject_cache_bytes", "Bytes of cached injection results", stats.InjectCache.Bytes)
+
+	writeCounter(&b, "hazetunnel_dns_lookups_total", "Upstream name lookups", stats.DNS.Lookups)
+	writeCounter(&b, "hazetunnel_dns_hits_total", "Lookups answered from the DNS cache", stats.DNS.Hits)
+	writeCounter(&b, "hazetunnel_dns_negative_hits_total", "Lookups answered from cached missing names", stats.DNS.NegativeHits)
+	writeCounter(&b, "hazetunnel_dns_misses_total", "Lookups sent to the system resolver", stats.DNS.Misses)
+	writeCounter(&b, "hazetunnel_dns_prefetches_total", "Cached names refreshed before they expired", stats.DNS.Prefetches)
+	writeCounter(&b, "hazetunnel_dns_failures_total", "Failed resolutions", stats.DNS.Failures)
+	writeHistogram(&b, "hazetunnel_dns_seconds", "Time spent in the system resolver", stats.DNS.Latency)
+
+	writeGauge(&b, "hazetunnel_body_budget_used_bytes", "Bytes of response bodies buffered for injection", stats.BodyBudget.Used)
+	writeCounter(&b, "hazetunnel_body_budget_waits_total", "Bodies that waited for room in the memory budget", stats.BodyBudget.Waits)
+	writeCounter(&b, "hazetunnel_body_budget_rejections_total", "Bodies streamed because the memory budget was full", stats.BodyBudget.Rejections)
+	writeHistogram(&b, "hazetunnel_body_budget_wait_seconds", "Time bodies waited for room in the memory budget", stats.BodyBudget.WaitTime)
+
+	if stats.ResponseCache != nil {
+		writeCounter(&b, "hazetunnel_response_cache_hits_total", "Requests served from the response cache without contacting upstream", stats.ResponseCache.Hits)
+		writeCounter(&b, "hazetunnel_response_cache_revalidations_total", "Conditional requests sent for stale cached responses", stats.ResponseCache.Revalidations)
+		writeCounter(&b, "hazetunnel_response_cache_revalidated_total", "Stale cached responses confirmed with a 304", stats.ResponseCache.Revalidated)
+		writeCounter(&b, "hazetunnel_response_cache_misses_total", "Cacheable requests without a usable cached response", stats.ResponseCache.Misses)
+		writeCounter(&b, "hazetunnel_response_cache_stores_total", "Responses stored in the response cache", stats.ResponseCache.Stores)
+		writeCounter(&b, "hazetunnel_response_cache_evictions_total", "Responses dropped from the response cache", stats.ResponseCache.Evictions)
+		writeGauge(&b, "hazetunnel_response_cache_memory_bytes", "Bytes of cached responses held in memory", stats.ResponseCache.MemoryBytes)
+		writeGauge(&b, "hazetunnel_response_cache_disk_bytes", "Bytes of cached responses held on disk", stats.ResponseCache.DiskBytes)
+	}
+	return b.String()
+}
+
+func writeCounter(b *strings.Builder, name, help string, value uint64) {
+	fmt.Fprintf(b, "# HELP %s %s\n# TYPE %s counter\n%s %d\n", name, help, name, name, value)
+}
+
+func writeGauge(b *strings.Builder, name, help string, value int64) {
+	fmt.Fprintf(b, "# HELP %s %s\n# TYPE %s gauge\n%s %d\n", name, help, name, name, value)
+}
+
+func writeHistogram(b *strings.Builder, name, help string, stats HistogramStats) {
+	fmt.Fprintf(b, "# HELP %s %s\n# TYPE %s histogram\n", name, help, name)
+	for i := 0; i <= len(latencyBuckets); i++ {
+		label := bucketLabel(i)
+		fmt.Fprintf(b, "%s_bucket{le=%q} %d\n", name, label, stats.Buckets[label])
+	}
+	fmt.Fprintf(b, "%s_sum %v\n%s_count %d\n", name, stats.Sum, name, stats.Count)
+}
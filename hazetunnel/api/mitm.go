@@ -0,0 +1,175 @@
+package api
+
+import (
+	"context"
+	"crypto/tls"
+	"io"
+	"net"
+	"net/http"
+	"strings"
+	"time"
+
+	"github.com/elazarl/goproxy"
+	"golang.org/x/net/http2"
+)
+
+/*
+Client-facing MITM server.
+Intercepted CONNECTs are hijacked and served by an http.Server that speaks
+HTTP/2 when the client negotiates it over ALPN, falling back to HTTP/1.1.
+Each request is dispatched to the goproxy handlers on its own goroutine, so
+streams of a multiplexed connection are proxied concurrently.
+*/
+
+const (
+	mitmHandshakeTimeout = 30 * time.Second
+	mitmIdleTimeout      = 90 * time.Second
+)
+
+type mitmContextKey struct{}
+
+// State of an intercepted CONNECT, shared by every request on the connection
+type mitmConn struct {
+	host    string
+	session string
+}
+
+type mitmServer struct {
+	// Serves the decrypted requests with the goproxy handlers
+	handler http.Handler
+	// Relays WebSocket upgrades
+	websocket http.Handler
+	server    *http.Server
+	// Hijacks intercepted CONNECTs
+	connect *goproxy.ConnectAction
+}
+
+func newMITMServer(ctx context.Context, handler, websocket http.Handler) *mitmServer {
+	m := &mitmServer{handler: handler, websocket: websocket}
+	m.server = &http.Server{
+		Handler:     m,
+		IdleTimeout: mitmIdleTimeout,
+		BaseContext: func(l net.Listener) context.Context {
+			return context.WithValue(ctx, mitmContextKey{}, l.(*connListener).state)
+		},
+	}
+	// Registers the h2 handler for connections that negotiated it
+	http2.ConfigureServer(m.server, &http2.Server{IdleTimeout: mitmIdleTimeout})
+	m.connect = &goproxy.ConnectAction{Action: goproxy.ConnectHijack, Hijack: m.hijack}
+	return m
+}
+
+func (m *mitmServer) hijack(req *http.Request, client net.Conn, ctx *goproxy.ProxyCtx) {
+	if _, err := io.WriteString(client, "HTTP/1.0 200 OK\r\n\r\n"); err != nil {
+		client.Close()
+		return
+	}
+
+	config, err := mitmTLSConfig(req.URL.Host, ctx)
+	if err != nil {
+		ctx.Warnf("Cannot sign host certificate with provided CA: %s", err)
+		client.Close()
+		return
+	}
+	config.NextProtos = []string{http2.NextProtoTLS, "http/1.1"}
+
+	tlsConn := tls.Server(client, config)
+	tlsConn.SetDeadline(time.Now().Add(mitmHandshakeTimeout))
+	if err := tlsConn.Handshake(); err != nil {
+		ctx.Warnf("Cannot handshake client %v %v", req.Host, err)
+		tlsConn.Close()
+		return
+	}
+	tlsConn.SetDeadline(time.Time{})
+	ctx.Logf("Negotiated %q with the client", tlsConn.ConnectionState().NegotiatedProtocol)
+
+	session, _ := ctx.UserData.(string)
+	listener := &connListener{
+		conn:  tlsConn,
+		addr:  tlsConn.LocalAddr(),
+		state: &mitmConn{host: req.URL.Host, session: session},
+	}
+	// Returns once the connection is handed over, the server owns it from then on
+	m.server.Serve(listener)
+	if listener.conn != nil {
+		// The server is shutting down and never accepted it
+		tlsConn.Close()
+	}
+}
+
+func (m *mitmServer) ServeHTTP(w http.ResponseWriter, r *http.Request) {
+	state, _ := r.Context().Value(mitmContextKey{}).(*mitmConn)
+
+	// Requests within the tunnel only carry a path
+	r.URL.Scheme = "https"
+	r.URL.Host = r.Host
+	if r.URL.Host == "" {
+		r.URL.Host = state.host
+	}
+	// The CONNECT credentials select the session unless the request names one
+	if state.session != "" && r.Header.Get(sessionHeader) == "" {
+		r.Header.Set(sessionHeader, state.session)
+	}
+	// Avoid forwarding empty bodies as chunked
+	if r.ContentLength == 0 {
+		r.Body = http.NoBody
+	}
+
+	if isWebSocketRequest(r) {
+		m.websocket.ServeHTTP(w, r)
+		return
+	}
+	m.handler.ServeHTTP(w, r)
+}
+
+// Closes idle intercepted connections and waits for active ones until ctx is done.
+// HTTP/2 clients are told to stop opening streams.
+func (m *mitmServer) Shutdown(ctx context.Context) error {
+	return m.server.Shutdown(ctx)
+}
+
+// Closes every intercepted connection
+func (m *mitmServer) Close() error {
+	return m.server.Close()
+}
+
+func isWebSocketRequest(r *http.Request) bool {
+	return headerContains(r.Header, "Connection", "upgrade") &&
+		headerContains(r.Header, "Upgrade", "websocket")
+}
+
+func headerContains(header http.Header, name string, value string) bool {
+	for _, v := range header[name] {
+		for _, s := range strings.Split(v, ",") {
+			if strings.EqualFold(strings.TrimSpace(s), value) {
+				return true
+			}
+		}
+	}
+	return false
+}
+
+// Listener that accepts a single connection that is already established
+type connListener struct {
+	conn  net.Conn
+	addr  net.Addr
+	state *mitmConn
+}
+
+func (l *connListener) Accept() (net.Conn, error) {
+	if l.conn == nil {
+		return nil, io.EOF
+	}
+	conn := l.conn
+	l.conn = nil
+	return conn, nil
+}
+
+// Close leaves the connection open, it is owned by the server once accepted
+func (l *connListener) Close() error {
+	return nil
+}
+
+func (l *connListener) Addr() net.Addr {
+	return l.addr
+}
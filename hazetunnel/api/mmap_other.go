@@ -0,0 +1,14 @@
+//go:build !unix
+
+package api
+
+import "os"
+
+// Reads a file into memory where mapping isn't supported
+func mapFile(path string) (data []byte, unmap func() error, err error) {
+	data, err = os.ReadFile(path)
+	if err != nil {
+		return nil, nil, err
+	}
+	return data, func() error { return nil }, nil
+}
@@ -0,0 +1,31 @@
+//go:build unix
+
+package api
+
+import (
+	"os"
+	"syscall"
+)
+
+// Maps a file into memory read-only. The mapping stays valid after the file is
+// removed, until unmap is called.
+func mapFile(path string) (data []byte, unmap func() error, err error) {
+	file, err := os.Open(path)
+	if err != nil {
+		return nil, nil, err
+	}
+	defer file.Close()
+	info, err := file.Stat()
+	if err != nil {
+		return nil, nil, err
+	}
+	if info.Size() == 0 {
+		// Empty files can't be mapped
+		return nil, func() error { return nil }, nil
+	}
+	data, err = syscall.Mmap(int(file.Fd()), 0, int(info.Size()), syscall.PROT_READ, syscall.MAP_SHARED)
+	if err != nil {
+		return nil, nil, err
+	}
+	return data, func() error { return syscall.Munmap(data) }, nil
+}
@@ -0,0 +1,167 @@
+package api
+
+import (
+	"context"
+	"net"
+	"net/http"
+	"net/url"
+	"sync"
+	"sync/atomic"
+	"time"
+
+	utls "github.com/refraction-networking/utls"
+)
+
+/*
+Per-instance pool of upstream uTLS round trippers.
+Entries are keyed by origin, fingerprint, upstream proxy and session, and are closed
+once they have been idle for longer than the idle timeout. Plain HTTP requests
+have no fingerprint, and share one transport per upstream proxy.
+*/
+
+const (
+	defaultIdleTimeout    = 90 * time.Second
+	defaultMaxIdlePerHost = 8
+	defaultMaxPoolEntries = 1024
+)
+
+type poolOptions struct {
+	idleTimeout     time.Duration
+	maxIdlePerHost  int
+	maxConnsPerHost int
+	maxEntries      int
+}
+
+type upstreamKey struct {
+	host     string
+	client   string
+	version  string
+	upstream string
+	session  string
+}
+
+type upstreamEntry struct {
+	transport *utlsTransport
+	lastUsed  atomic.Int64
+}
+
+type UpstreamPool struct {
+	opts    poolOptions
+	metrics *Metrics
+	conns   *connTracker
+	entries *lruCache[upstreamKey, *upstreamEntry]
+	done    chan struct{}
+
+	plainMux sync.Mutex
+	// Plain HTTP transports by upstream proxy, "" when connecting directly
+	plain map[string]*http.Transport
+}
+
+func newUpstreamPool(Flags *ProxySetup, metrics *Metrics, conns *connTracker) *UpstreamPool {
+	opts := poolOptions{
+		idleTimeout:    defaultIdleTimeout,
+		maxIdlePerHost: defaultMaxIdlePerHost,
+		maxEntries:     defaultMaxPoolEntries,
+	}
+	if Flags.IdleTimeout > 0 {
+		opts.idleTimeout = time.Duration(Flags.IdleTimeout) * time.Second
+	}
+	if Flags.MaxIdlePerHost > 0 {
+		opts.maxIdlePerHost = Flags.MaxIdlePerHost
+	}
+	if Flags.MaxConnsPerHost > 0 {
+		opts.maxConnsPerHost = Flags.MaxConnsPerHost
+	}
+
+	pool := &UpstreamPool{
+		opts:    opts,
+		metrics: metrics,
+		conns:   conns,
+		entries: newLRUCache[upstreamKey, *upstreamEntry](int64(opts.maxEntries), nil,
+			func(_ upstreamKey, entry *upstreamEntry) {
+				entry.transport.CloseIdleConnections()
+			}),
+		done:  make(chan struct{}),
+		plain: make(map[string]*http.Transport),
+	}
+	go pool.evictIdle()
+	return pool
+}
+
+// Get returns the round tripper for the origin, creating it on first use
+func (p *UpstreamPool) Get(host string, helloID utls.ClientHelloID, upstream *url.URL, session string) *utlsTransport {
+	key := upstreamKey{
+		host:    host,
+		client:  helloID.Client,
+		version: helloID.Version,
+		session: session,
+	}
+	if upstream != nil {
+		key.upstream = upstream.String()
+	}
+
+	entry := p.entries.GetOrAdd(key, func() *upstreamEntry {
+		return &upstreamEntry{
+			transport: newUTLSTransport(helloID, &utls.Config{
+				InsecureSkipVerify: true,
+				OmitEmptyPsk:       true,
+				// Resume sessions with tickets issued to the same fingerprint, proxy and session
+				ClientSessionCache: newTicketCache(key),
+			}, upstream, &p.opts, p.metrics, p.conns),
+		}
+	})
+	entry.lastUsed.Store(time.Now().UnixNano())
+	return entry.transport
+}
+
+// Plain returns the transport for plain HTTP requests through the upstream
+// proxy, creating it on first use. Connections are only reused through the
+// proxy they were opened with.
+func (p *UpstreamPool) Plain(upstream *url.URL) *http.Transport {
+	var key string
+	if upstream != nil {
+		key = upstream.String()
+	}
+	p.plainMux.Lock()
+	defer p.plainMux.Unlock()
+	if transport, ok := p.plain[key]; ok {
+		return transport
+	}
+	transport := &http.Transport{
+		DialContext: p.conns.DialContext(func(ctx context.Context, _, addr string) (net.Conn, error) {
+			return dialUpstream(ctx, upstream, addr)
+		}),
+		MaxIdleConnsPerHost: p.opts.maxIdlePerHost,
+		MaxConnsPerHost:     p.opts.maxConnsPerHost,
+		IdleConnTimeout:     p.opts.idleTimeout,
+	}
+	p.plain[key] = transport
+	return transport
+}
+
+// Close stops the eviction loop and closes every pooled connection
+func (p *UpstreamPool) Close() {
+	close(p.done)
+	p.entries.Purge()
+	p.plainMux.Lock()
+	defer p.plainMux.Unlock()
+	for _, transport := range p.plain {
+		transport.CloseIdleConnections()
+	}
+}
+
+func (p *UpstreamPool) evictIdle() {
+	ticker := time.NewTicker(p.opts.idleTimeout / 2)
+	defer ticker.Stop()
+	for {
+		select {
+		case <-p.done:
+			return
+		case now := <-ticker.C:
+			cutoff := now.Add(-p.opts.idleTimeout).UnixNano()
+			p.entries.EvictOldest(func(_ upstreamKey, entry *upstreamEntry) bool {
+				return entry.lastUsed.Load() < cutoff
+			})
+		}
+	}
+}
@@ -2,10 +2,15 @@ package api
 
 import (
 	"fmt"
+	"os"
 	"strconv"
 	"strings"
+	"sync"
+	"sync/atomic"
 
+	json "github.com/goccy/go-json"
 	"github.com/mileusna/useragent"
+	utls "github.com/refraction-networking/utls"
 )
 
 // Predefined dictionary with browser versions and their corresponding utls values.
@@ -62,37 +67,263 @@ var utlsDict = map[string]map[int]string{
 	},
 }
 
-func uagentToUtls(uagent string) (string, string, error) {
-	ua := useragent.Parse(uagent)
-	utlsVersion, err := utlsVersion(ua.Name, ua.Version)
+/*
+Profile registry.
+Resolves User-Agents to fingerprints: exact User-Agent strings first, then the
+browser and major version parsed from them. utlsDict is always included, and a
+loaded registry adds named profiles, which may be custom specs, on top of it.
+Registries are compiled once and swapped in atomically, so running instances
+use them from their next request.
+*/
+
+const (
+	// Custom profiles resolve to ClientHelloIDs with this client and their name as version
+	customHelloClient = "Custom"
+	// Highest major version a browser rule may start from
+	maxProfileVersion = 10000
+)
+
+type profileRegistry struct {
+	browsers   map[string]*versionTable
+	userAgents map[string]utls.ClientHelloID
+	// Compiled custom specs by profile name
+	specs map[string]*helloSpec
+	// For User-Agents that don't match any profile
+	fallback utls.ClientHelloID
+}
+
+// A browser's profile for each major version, up to the last one a rule starts
+// from. Later versions use the last profile, and nil entries have none.
+type versionTable struct {
+	byVersion []*utls.ClientHelloID
+}
+
+var profiles atomic.Pointer[profileRegistry]
+
+func init() {
+	registry, err := newProfileRegistry(&ProfilesSetting{})
 	if err != nil {
-		return "", "", err
+		panic(err)
 	}
-	return ua.Name, utlsVersion, nil
+	profiles.Store(registry)
 }
 
-func utlsVersion(browserName, browserVersion string) (string, error) {
-	if versions, ok := utlsDict[browserName]; ok {
-		// Extract the major version number from the browser version string
-		majorVersionStr := strings.Split(browserVersion, ".")[0]
-		majorVersion, err := strconv.Atoi(majorVersionStr)
+func currentProfiles() *profileRegistry {
+	return profiles.Load()
+}
+
+func newProfileRegistry(setting *ProfilesSetting) (*profileRegistry, error) {
+	registry := &profileRegistry{
+		browsers:   make(map[string]*versionTable),
+		userAgents: make(map[string]utls.ClientHelloID, len(setting.UserAgents)),
+		specs:      make(map[string]*helloSpec),
+		fallback:   utls.HelloChrome_Auto,
+	}
+
+	// Named profiles
+	ids := make(map[string]utls.ClientHelloID, len(setting.Profiles))
+	for name, profile := range setting.Profiles {
+		if profile.Client != "" {
+			id := utls.ClientHelloID{Client: profile.Client, Version: profile.Version}
+			if _, err := utls.UTLSIdToSpec(id); err != nil {
+				return nil, fmt.Errorf("profile '%s': %v", name, err)
+			}
+			ids[name] = id
+			continue
+		}
+		spec, err := compileHelloSpec(profile)
 		if err != nil {
-			return "", fmt.Errorf("error parsing major version number from browser version: %v", err)
+			return nil, fmt.Errorf("profile '%s': %v", name, err)
 		}
+		registry.specs[name] = spec
+		ids[name] = utls.ClientHelloID{Client: customHelloClient, Version: name}
+	}
+	lookup := func(name string) (utls.ClientHelloID, error) {
+		if id, ok := ids[name]; ok {
+			return id, nil
+		}
+		return utls.ClientHelloID{}, fmt.Errorf("unknown profile '%s'", name)
+	}
 
-		// Find the highest version that is less than or equal to the browser version
-		var selectedVersion int = -1
-		for version := range versions {
-			if version <= majorVersion && version > selectedVersion {
-				selectedVersion = version
+	// Browser rules, merged over the built-in ones
+	rules := make(map[string]map[int]utls.ClientHelloID, len(utlsDict)+len(setting.Browsers))
+	for browser, versions := range utlsDict {
+		rules[browser] = make(map[int]utls.ClientHelloID, len(versions))
+		for version, utlsVersion := range versions {
+			rules[browser][version] = utls.ClientHelloID{Client: browser, Version: utlsVersion}
+		}
+	}
+	for browser, versions := range setting.Browsers {
+		if rules[browser] == nil {
+			rules[browser] = make(map[int]utls.ClientHelloID, len(versions))
+		}
+		for key, name := range versions {
+			version, err := strconv.Atoi(key)
+			if err != nil || version < -1 || version > maxProfileVersion {
+				return nil, fmt.Errorf("invalid version '%s' for browser '%s'", key, browser)
+			}
+			id, err := lookup(name)
+			if err != nil {
+				return nil, err
 			}
+			rules[browser][version] = id
+		}
+	}
+	for browser, versions := range rules {
+		registry.browsers[browser] = newVersionTable(versions)
+	}
+
+	for uagent, name := range setting.UserAgents {
+		id, err := lookup(name)
+		if err != nil {
+			return nil, err
 		}
+		registry.userAgents[uagent] = id
+	}
+	if setting.Default != "" {
+		id, err := lookup(setting.Default)
+		if err != nil {
+			return nil, err
+		}
+		registry.fallback = id
+	}
+	return registry, nil
+}
+
+// Expands rules keyed by the minimum major version they apply to, where -1
+// applies to versions below every other rule
+func newVersionTable(rules map[int]utls.ClientHelloID) *versionTable {
+	last := 0
+	for version := range rules {
+		last = max(last, version)
+	}
+	table := &versionTable{byVersion: make([]*utls.ClientHelloID, last+1)}
+	var current *utls.ClientHelloID
+	if id, ok := rules[-1]; ok {
+		current = &id
+	}
+	for version := range table.byVersion {
+		if id, ok := rules[version]; ok {
+			current = &id
+		}
+		table.byVersion[version] = current
+	}
+	return table
+}
+
+func uagentToUtls(uagent string) (utls.ClientHelloID, error) {
+	return currentProfiles().uagentHello(uagent)
+}
+
+func (r *profileRegistry) uagentHello(uagent string) (utls.ClientHelloID, error) {
+	ua := useragent.Parse(uagent)
+	return r.browserHello(ua.Name, ua.Version)
+}
+
+func (r *profileRegistry) browserHello(browserName, browserVersion string) (utls.ClientHelloID, error) {
+	table, ok := r.browsers[browserName]
+	if !ok {
+		return utls.ClientHelloID{}, fmt.Errorf("browser '%s' not found in UTLS dictionary", browserName)
+	}
+	// Extract the major version number from the browser version string
+	majorVersionStr, _, _ := strings.Cut(browserVersion, ".")
+	majorVersion, err := strconv.Atoi(majorVersionStr)
+	if err != nil {
+		return utls.ClientHelloID{}, fmt.Errorf("error parsing major version number from browser version: %v", err)
+	}
+	majorVersion = min(max(majorVersion, 0), len(table.byVersion)-1)
+	if id := table.byVersion[majorVersion]; id != nil {
+		return *id, nil
+	}
+	return utls.ClientHelloID{}, fmt.Errorf("no UTLS value found for browser '%s' with version '%s'", browserName, browserVersion)
+}
+
+// Returns a new spec for a custom profile, or nil for ClientHelloIDs built into utls
+func customHelloSpec(id utls.ClientHelloID) (*utls.ClientHelloSpec, error) {
+	if id.Client != customHelloClient {
+		return nil, nil
+	}
+	spec, ok := currentProfiles().specs[id.Version]
+	if !ok {
+		return nil, fmt.Errorf("fingerprint profile '%s' is no longer loaded", id.Version)
+	}
+	return spec.Build(), nil
+}
+
+// Compiles a registry and swaps it in. The current one is kept if it doesn't compile.
+func loadProfiles(setting *ProfilesSetting) error {
+	if setting.Path != "" {
+		data, err := os.ReadFile(setting.Path)
+		if err != nil {
+			return err
+		}
+		setting = &ProfilesSetting{}
+		if err := json.Unmarshal(data, setting); err != nil {
+			return fmt.Errorf("error parsing profiles: %v", err)
+		}
+	}
+	registry, err := newProfileRegistry(setting)
+	if err != nil {
+		return err
+	}
+	profiles.Store(registry)
+	// Forget User-Agents resolved with the previous registry
+	helloCache.Store(&sync.Map{})
+	helloCacheSize.Store(0)
+	return nil
+}
+
+// LoadProfileFile loads a fingerprint profile registry from a JSON file
+func LoadProfileFile(path string) error {
+	return loadProfiles(&ProfilesSetting{Path: path})
+}
+
+/*
+User-Agent to ClientHelloID cache.
+Fleets send few distinct User-Agents, so resolutions are memoized.
+The cache is cleared when it grows past maxCachedUserAgents.
+*/
+
+const maxCachedUserAgents = 4096
+
+type resolvedHello struct {
+	id  utls.ClientHelloID
+	err error
+}
+
+var (
+	helloCache     atomic.Pointer[sync.Map]
+	helloCacheSize atomic.Int64
+)
+
+func init() {
+	helloCache.Store(&sync.Map{})
+}
+
+// Resolves the ClientHelloID for a User-Agent.
+// Unrecognized User-Agents resolve to the registry's default profile along with the parse error.
+func resolveClientHelloID(uagent string) (utls.ClientHelloID, error) {
+	cache := helloCache.Load()
+	if cached, ok := cache.Load(uagent); ok {
+		resolved := cached.(*resolvedHello)
+		return resolved.id, resolved.err
+	}
+
+	resolved := &resolvedHello{}
+	registry := currentProfiles()
+	if id, ok := registry.userAgents[uagent]; ok {
+		resolved.id = id
+	} else if id, err := registry.uagentHello(uagent); err != nil {
+		resolved.id, resolved.err = registry.fallback, err
+	} else {
+		resolved.id = id
+	}
 
-		if utls, ok := versions[selectedVersion]; ok {
-			return utls, nil
-		} else {
-			return "", fmt.Errorf("no UTLS value found for browser '%s' with version '%s'", browserName, browserVersion)
+	if _, loaded := cache.LoadOrStore(uagent, resolved); !loaded {
+		if helloCacheSize.Add(1) > maxCachedUserAgents {
+			helloCache.Store(&sync.Map{})
+			helloCacheSize.Store(0)
 		}
 	}
-	return "", fmt.Errorf("browser '%s' not found in UTLS dictionary", browserName)
+	return resolved.id, resolved.err
 }
@@ -0,0 +1,201 @@
+package api
+
+import (
+	"fmt"
+	"testing"
+
+	utls "github.com/refraction-networking/utls"
+)
+
+var benchUserAgents = []string{
+	"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
+	"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36",
+	"Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0",
+	"Mozilla/5.0 (X11; Linux x86_64; rv:102.0) Gecko/20100101 Firefox/102.0",
+	"Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1",
+	"Mozilla/5.0 (compatible; UnknownBot/1.0)",
+}
+
+func BenchmarkUagentToUtls(b *testing.B) {
+	b.ReportAllocs()
+	for i := 0; i < b.N; i++ {
+		uagentToUtls(benchUserAgents[i%len(benchUserAgents)])
+	}
+}
+
+func BenchmarkBrowserHello(b *testing.B) {
+	registry := currentProfiles()
+	b.ReportAllocs()
+	for i := 0; i < b.N; i++ {
+		registry.browserHello("Chrome", "121.0.0.0")
+	}
+}
+
+func BenchmarkResolveClientHelloID(b *testing.B) {
+	b.ReportAllocs()
+	for i := 0; i < b.N; i++ {
+		resolveClientHelloID(benchUserAgents[i%len(benchUserAgents)])
+	}
+}
+
+func BenchmarkResolveClientHelloIDParallel(b *testing.B) {
+	b.ReportAllocs()
+	b.RunParallel(func(pb *testing.PB) {
+		i := 0
+		for pb.Next() {
+			resolveClientHelloID(benchUserAgents[i%len(benchUserAgents)])
+			i++
+		}
+	})
+}
+
+func TestParseJA3(t *testing.T) {
+	tests := []struct {
+		name         string
+		ja3          string
+		version      uint16
+		ciphers      []uint16
+		extensions   []uint16
+		curves       []uint16
+		pointFormats []uint8
+		grease       bool
+		wantErr      bool
+	}{
+		{
+			name:         "chrome with GREASE",
+			ja3:          "771,2570-4865-4866-49195,2570-0-23-65281-10-11-35-16-5-13-18-51-45-43-27-17513-56026-21,2570-29-23-24,0",
+			version:      771,
+			ciphers:      []uint16{4865, 4866, 49195},
+			extensions:   []uint16{0, 23, 65281, 10, 11, 35, 16, 5, 13, 18, 51, 45, 43, 27, 17513, 21},
+			curves:       []uint16{29, 23, 24},
+			pointFormats: []uint8{0},
+			grease:       true,
+		},
+		{
+			name:         "firefox",
+			ja3:          "771,4865-4867-4866,0-23-65281-10-11,29-23-24-25,0",
+			version:      771,
+			ciphers:      []uint16{4865, 4867, 4866},
+			extensions:   []uint16{0, 23, 65281, 10, 11},
+			curves:       []uint16{29, 23, 24, 25},
+			pointFormats: []uint8{0},
+		},
+		{
+			name:    "empty fields",
+			ja3:     "771,4865,,,",
+			version: 771,
+			ciphers: []uint16{4865},
+		},
+		{name: "too few fields", ja3: "771,4865,0,29", wantErr: true},
+		{name: "too many fields", ja3: "771,4865,0,29,0,0", wantErr: true},
+		{name: "empty version", ja3: ",4865,0,29,0", wantErr: true},
+		{name: "version out of range", ja3: "65536,4865,0,29,0", wantErr: true},
+		{name: "invalid cipher", ja3: "771,4865-TLS_AES,0,29,0", wantErr: true},
+		{name: "negative extension", ja3: "771,4865,-1,29,0", wantErr: true},
+		{name: "empty value", ja3: "771,4865-,0,29,0", wantErr: true},
+		{name: "curve out of range", ja3: "771,4865,0,65536,0", wantErr: true},
+		{name: "point format out of range", ja3: "771,4865,0,29,256", wantErr: true},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			spec := &helloSpec{}
+			err := spec.parseJA3(tt.ja3)
+			if tt.wantErr {
+				if err == nil {
+					t.Fatal("expected an error")
+				}
+				return
+			}
+			if err != nil {
+				t.Fatal(err)
+			}
+			// nil and empty lists are the same here
+			if spec.version != tt.version ||
+				fmt.Sprint(spec.ciphers) != fmt.Sprint(tt.ciphers) ||
+				fmt.Sprint(spec.extensions) != fmt.Sprint(tt.extensions) ||
+				fmt.Sprint(spec.curves) != fmt.Sprint(tt.curves) ||
+				fmt.Sprint(spec.pointFormats) != fmt.Sprint(tt.pointFormats) ||
+				spec.grease != tt.grease {
+				t.Errorf("parsed %+v", *spec)
+			}
+		})
+	}
+}
+
+func TestIsGREASE(t *testing.T) {
+	for i := uint16(0); i < 16; i++ {
+		if v := 0x0a0a + i*0x1010; !isGREASE(v) {
+			t.Errorf("%#04x should be GREASE", v)
+		}
+	}
+	for _, v := range []uint16{0, 0x0a0b, 0x1a0a, 0x0a1a, 4865, 65281} {
+		if isGREASE(v) {
+			t.Errorf("%#04x shouldn't be GREASE", v)
+		}
+	}
+}
+
+func TestCompileHelloSpecErrors(t *testing.T) {
+	tests := []struct {
+		name    string
+		setting ProfileSetting
+	}{
+		{"no cipher suites", ProfileSetting{JA3: "771,,0,29,0"}},
+		{"only GREASE cipher suites", ProfileSetting{CipherSuites: []uint16{0x0a0a}}},
+		{"invalid JA3", ProfileSetting{JA3: "771,4865"}},
+		{"pre_shared_key", ProfileSetting{JA3: "771,4865,0-41,29,0"}},
+		{"supported_groups without curves", ProfileSetting{JA3: "771,4865,0-10,,0"}},
+		{"key_share without curves", ProfileSetting{CipherSuites: []uint16{4865}, Extensions: []uint16{51}}},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			if _, err := compileHelloSpec(tt.setting); err == nil {
+				t.Error("expected an error")
+			}
+		})
+	}
+}
+
+// Reloading the registry forgets User-Agents resolved with the previous one
+func TestLoadProfilesClearsHelloCache(t *testing.T) {
+	const uagent = "hazetunnel-test/1.0"
+	t.Cleanup(func() {
+		if err := loadProfiles(&ProfilesSetting{}); err != nil {
+			t.Error(err)
+		}
+	})
+	load := func(client, version string) utls.ClientHelloID {
+		t.Helper()
+		err := loadProfiles(&ProfilesSetting{
+			Profiles:   map[string]ProfileSetting{"test": {Client: client, Version: version}},
+			UserAgents: map[string]string{uagent: "test"},
+		})
+		if err != nil {
+			t.Fatal(err)
+		}
+		if helloCacheSize.Load() != 0 {
+			t.Fatal("hello cache wasn't cleared")
+		}
+		return utls.ClientHelloID{Client: client, Version: version}
+	}
+
+	for _, client := range []string{"Firefox", "Chrome"} {
+		want := load(client, "120")
+		for i := 0; i < 2; i++ {
+			if id, err := resolveClientHelloID(uagent); err != nil || id != want {
+				t.Fatalf("resolved %v, %v, want %v", id, err, want)
+			}
+		}
+		if _, ok := helloCache.Load().Load(uagent); !ok {
+			t.Fatal("resolution wasn't cached")
+		}
+	}
+
+	// A registry that doesn't compile keeps the current one and its cache
+	if err := loadProfiles(&ProfilesSetting{Default: "missing"}); err == nil {
+		t.Fatal("expected an error")
+	}
+	if _, ok := helloCache.Load().Load(uagent); !ok {
+		t.Error("failed reload cleared the hello cache")
+	}
+}
@@ -2,14 +2,15 @@ package api
 
 import (
 	"context"
+	"fmt"
 	"log"
+	"net"
 	"net/http"
-	"net/url"
 	"sync"
+	"time"
 
 	"github.com/elazarl/goproxy"
 	utls "github.com/refraction-networking/utls"
-	sf "gitlab.torproject.org/tpo/anti-censorship/pluggable-transports/snowflake/v2/common/utls"
 )
 
 type contextKey string
@@ -17,8 +18,15 @@ type contextKey string
 const payloadKey contextKey = "payload"
 
 type ProxyInstance struct {
-	Server *http.Server
-	Cancel context.CancelFunc
+	Server    *http.Server
+	Cancel    context.CancelFunc
+	Pool      *UpstreamPool
+	Sessions  *sessionTable
+	Metrics   *Metrics
+	MITM      *mitmServer
+	Upstreams *upstreamSet
+	AccessLog *accessLog
+	Conns     *connTracker
 }
 
 // Globals
@@ -27,92 +35,269 @@ var (
 	proxyInstanceMap = make(map[string]*ProxyInstance)
 )
 
-func initServer(Flags *ProxySetup) *http.Server {
+// Binds the listeners and registers the instance.
+// The server does not accept connections until it is served.
+func initServer(Flags *ProxySetup) (*http.Server, []net.Listener, error) {
 	serverMux.Lock()
 	defer serverMux.Unlock()
 
+	if _, ok := proxyInstanceMap[Flags.Id]; ok {
+		return nil, nil, fmt.Errorf("%v is already a running instance", Flags.Id)
+	}
+
 	// Load CA if not already loaded
-	loadCA()
+	if err := loadCA(); err != nil {
+		return nil, nil, err
+	}
+
+	// Compile the session settings and intercept rules before binding
+	sessions, err := newSessionTable(Flags)
+	if err != nil {
+		return nil, nil, err
+	}
+	rules, err := newInterceptRules(Flags)
+	if err != nil {
+		return nil, nil, err
+	}
+	upstreams, err := newUpstreamSet(Flags)
+	if err != nil {
+		return nil, nil, err
+	}
+
+	// Bind the listeners first so that port 0 resolves to the actual port
+	port := Flags.Port
+	if port == "" {
+		port = "0"
+	}
+	listeners, err := listen(Flags.Addr, port, Flags.Listeners)
+	if err != nil {
+		upstreams.Close()
+		return nil, nil, err
+	}
 
 	// Setup the proxy instance
+	// Requests and dials in flight are cancelled once the instance is closed
+	ctx, cancel := context.WithCancel(context.Background())
+	metrics := &Metrics{}
+	conns := newConnTracker(metrics)
 	proxy := goproxy.NewProxyHttpServer()
 	proxy.Verbose = Config.Verbose
-	setupProxy(proxy, Flags)
+	// Requests goproxy forwards itself resolve through the DNS cache as well
+	proxy.Tr.DialContext = conns.DialContext(dialDirect)
+	pool := newUpstreamPool(Flags, metrics, conns)
+	accessLog := newAccessLog(Flags)
+	handler := conns.Handler(accessLog.Handler(flushStreams(proxy)))
+	websockets := &websocketRelay{proxy: proxy, sessions: sessions, upstreams: upstreams, pool: pool, metrics: metrics}
+	mitm := newMITMServer(ctx, handler, conns.Handler(accessLog.Handler(websockets)))
+	limiter := newRequestLimiter(Flags, metrics)
+	setupProxy(proxy, Flags, pool, sessions, upstreams, rules, metrics, mitm, conns, limiter)
+	if Flags.MetricsEndpoint {
+		proxy.NonproxyHandler = metrics.Handler(proxy.NonproxyHandler)
+	}
 
 	// Create the server
 	server := &http.Server{
-		Addr:    Flags.Addr + ":" + Flags.Port,
-		Handler: proxy,
+		Addr:    listeners[0].Addr().String(),
+		Handler: handler,
+		BaseContext: func(net.Listener) context.Context {
+			return ctx
+		},
 	}
-	_, cancel := context.WithCancel(context.Background())
 
 	// Add proxy instance to the map
 	proxyInstanceMap[Flags.Id] = &ProxyInstance{
-		Server: server,
-		Cancel: cancel,
+		Server:    server,
+		Cancel:    cancel,
+		Pool:      pool,
+		Sessions:  sessions,
+		Metrics:   metrics,
+		MITM:      mitm,
+		Upstreams: upstreams,
+		AccessLog: accessLog,
+		Conns:     conns,
+	}
+	for i, listener := range listeners {
+		listeners[i] = conns.Listener(listener)
+	}
+	return server, listeners, nil
+}
+
+// Shutdown stops accepting connections and lets open ones finish until the
+// timeout, then closes whatever is left. Returns the number of connections
+// that had to be closed.
+func (p *ProxyInstance) Shutdown(timeout time.Duration) int {
+	ctx, cancel := context.WithTimeout(context.Background(), timeout)
+	defer cancel()
+
+	// Closes the listener and idle connections and waits for active requests.
+	// Hijacked CONNECTs aren't waited on by the servers, only by the tracker.
+	if err := p.Server.Shutdown(ctx); err != nil && err != context.DeadlineExceeded {
+		log.Printf("Failed to shutdown the server gracefully: %v", err)
+	}
+	p.MITM.Shutdown(ctx)
+	p.Conns.Wait(ctx)
+
+	p.Cancel()
+	closed := p.Conns.Close()
+	p.MITM.Close()
+	p.Pool.Close()
+	p.Upstreams.Close()
+	return closed
+}
+
+// Looks up the session of a request, strips its control headers and applies
+// its User-Agent, which selects the ClientHello. Returns a response instead if
+// the request can't be proxied.
+func resolveRequest(req *http.Request, ctx *goproxy.ProxyCtx, sessions *sessionTable, metrics *Metrics) (*session, utls.ClientHelloID, *http.Response) {
+	session, resp := sessions.Resolve(req, ctx)
+	if resp != nil {
+		metrics.Error(errSession)
+		return nil, utls.ClientHelloID{}, resp
 	}
-	return server
+
+	// Override the User-Agent header if specified
+	// If one wasn't specified, verify a User-Agent is in the request
+	if len(session.userAgent) != 0 {
+		req.Header["User-Agent"] = []string{session.userAgent}
+	} else if len(req.Header["User-Agent"]) == 0 {
+		metrics.Error(errUserAgent)
+		return nil, utls.ClientHelloID{}, missingParameterResponse(req, ctx, "User-Agent")
+	}
+
+	// Set the ClientHello from the User-Agent header
+	ua := req.Header["User-Agent"][0]
+	clientHelloId, err := getClientHelloID(ua, ctx)
+	if err != nil {
+		// The latest Chrome is used when the User-Agent header cannot be recognized
+		ctx.Logf("Error parsing User-Agent: %s", err)
+		ctx.Logf("Continuing with the %s ClientHello", clientHelloId.Str())
+	}
+	if record := accessRecordFrom(req.Context()); record != nil {
+		record.Session = session.name
+		record.Fingerprint = clientHelloId.Str()
+	}
+	return session, clientHelloId, nil
 }
 
-func setupProxy(proxy *goproxy.ProxyHttpServer, Flags *ProxySetup) {
-	proxy.OnRequest().HandleConnect(goproxy.AlwaysMitm)
+func setupProxy(proxy *goproxy.ProxyHttpServer, Flags *ProxySetup, pool *UpstreamPool, sessions *sessionTable, upstreams *upstreamSet, rules *interceptRules, metrics *Metrics, mitm *mitmServer, conns *connTracker, limiter *requestLimiter) {
+	// Intercept CONNECTs that match the rules and tunnel the rest, rejecting unknown sessions
+	proxy.OnRequest().HandleConnectFunc(
+		func(host string, ctx *goproxy.ProxyCtx) (*goproxy.ConnectAction, string) {
+			metrics.connects.Add(1)
+			if !sessions.Connect(ctx) {
+				metrics.Error(errSession)
+				return goproxy.RejectConnect, host
+			}
+			if !rules.Intercept(host) {
+				metrics.tunnels.Add(1)
+				session, _ := sessions.Lookup(ctx.UserData.(string))
+				return tunnelConnect(upstreams.For(session, host), conns), host
+			}
+			return mitm.connect, host
+		},
+	)
 
 	proxy.OnRequest().DoFunc(
 		func(req *http.Request, ctx *goproxy.ProxyCtx) (*http.Request, *http.Response) {
-			var upstreamProxy *url.URL
-
-			// Override the User-Agent header if specified
-			// If one wasn't specified, verify a User-Agent is in the request
-			if len(Flags.UserAgent) != 0 {
-				req.Header["User-Agent"] = []string{Flags.UserAgent}
-			} else if len(req.Header["User-Agent"]) == 0 {
-				return req, missingParameterResponse(req, ctx, "User-Agent")
+			metrics.requests.Add(1)
+			record := accessRecordFrom(req.Context())
+
+			session, clientHelloId, resp := resolveRequest(req, ctx, sessions, metrics)
+			if resp != nil {
+				return req, resp
 			}
 
-			// Set the ClientHello from the User-Agent header
-			ua := req.Header["User-Agent"][0]
-			clientHelloId, err := getClientHelloID(ua, ctx)
-			if err != nil {
-				// Use the latest Chrome when the User-Agent header cannot be recognized
-				ctx.Logf("Error parsing User-Agent: %s", err)
-				clientHelloId = utls.HelloChrome_Auto
-				ctx.Logf("Continuing with Chrome %v ClientHello", clientHelloId.Version)
+			// Serve fresh responses from the shared cache before going upstream.
+			// Stale ones with validators turn the request into a revalidation.
+			var lookup *cacheLookup
+			if Flags.ResponseCache {
+				var cached *http.Response
+				lookup, cached = getResponseCache().Lookup(req, session.payload)
+				if cached != nil {
+					if record != nil {
+						record.Cache = "hit"
+					}
+					return req, cached
+				}
+				if lookup != nil && record != nil {
+					record.Cache = "miss"
+				}
 			}
 
-			// Store the payload code in the request's context
+			// Store the payload code and cache lookup in the request's context
 			ctx.Req = req.WithContext(
-				context.WithValue(
-					ctx.Req.Context(),
-					payloadKey,
-					Flags.Payload,
+				withCacheLookup(
+					context.WithValue(
+						ctx.Req.Context(),
+						payloadKey,
+						session.payload,
+					),
+					lookup,
 				),
 			)
 
-			// If a proxy header was passed, set it to upstreamProxy
-			if len(Flags.UpstreamProxy) != 0 {
-				proxyUrl, err := url.Parse(Flags.UpstreamProxy)
-				if err != nil {
-					return req, invalidUpstreamProxyResponse(req, ctx, Flags.UpstreamProxy)
-				}
-				upstreamProxy = proxyUrl
-			}
+			// goproxy drops Accept-Encoding before forwarding, which makes the transport
+			// fetch uncompressed bodies. Restore the client's so responses stay compressed.
+			acceptEncoding := req.Header.Get("Accept-Encoding")
 
 			// Skip TLS handshake if scheme is HTTP
 			ctx.Logf("Scheme: %s", req.URL.Scheme)
+			upstream := upstreams.For(session, req.URL.Host)
+			var roundTripper http.RoundTripper
 			if req.URL.Scheme == "http" {
 				ctx.Logf("Skipping TLS for HTTP request")
-				return req, nil
+				roundTripper = pool.Plain(upstream)
+			} else {
+				// Reuse the pooled round tripper for this origin
+				roundTripper = pool.Get(canonicalAddr(req.URL), clientHelloId, upstream, session.name)
 			}
 
-			// Build round tripper
-			roundTripper := sf.NewUTLSHTTPRoundTripperWithProxy(clientHelloId, &utls.Config{
-				InsecureSkipVerify: true,
-				OmitEmptyPsk:       true,
-			}, http.DefaultTransport, false, upstreamProxy)
-
 			ctx.RoundTripper = goproxy.RoundTripperFunc(
 				func(req *http.Request, ctx *goproxy.ProxyCtx) (*http.Response, error) {
-					return roundTripper.RoundTrip(req)
+					// Wait for an upstream request slot, held until the response body is closed.
+					// Taken here since goproxy doesn't call the round tripper for every request.
+					release := limiter.Acquire(req.Context())
+					if release == nil {
+						return overloadedResponse(req, ctx), nil
+					}
+					held := true
+					defer func() {
+						if held {
+							release()
+						}
+					}()
+
+					if acceptEncoding != "" {
+						req.Header.Set("Accept-Encoding", acceptEncoding)
+					}
+					start := time.Now()
+					resp, err := roundTripper.RoundTrip(req)
+					if err == nil && lookup.Evicted(req, resp) {
+						// The cached entry is gone, so fetch the response itself
+						resp, err = roundTripper.RoundTrip(req)
+					}
+					if err != nil {
+						metrics.Error(errUpstream)
+						if record != nil {
+							record.Error = err.Error()
+						}
+						return nil, err
+					}
+					releaseOnClose(resp, release)
+					held = false
+					metrics.firstByte.Observe(time.Since(start))
+					countBody(resp, &metrics.bytesIn)
+					if record != nil {
+						record.FirstByte = time.Since(start).Seconds()
+						countBody(resp, &record.bytesIn)
+					}
+					// Answer a confirmed revalidation from the cache
+					cached := lookup.Revalidated(req, resp)
+					if cached != resp && record != nil {
+						record.Cache = "revalidated"
+					}
+					markStreaming(req.Context(), cached)
+					return cached, nil
 				})
 
 			return req, nil
@@ -120,18 +305,75 @@ func setupProxy(proxy *goproxy.ProxyHttpServer, Flags *ProxySetup) {
 	)
 
 	// Inject payload code into responses
-	proxy.OnResponse().DoFunc(PayloadInjector)
+	proxy.OnResponse().DoFunc(NewPayloadInjector(Flags, metrics).Inject)
+
+	// Store cacheable responses once they have been injected
+	proxy.OnResponse().DoFunc(
+		func(resp *http.Response, ctx *goproxy.ProxyCtx) *http.Response {
+			if lookup := cacheLookupFrom(ctx.Req.Context()); lookup != nil && resp != nil {
+				lookup.Store(ctx.Req, resp)
+			}
+			return resp
+		},
+	)
+
+	// Count the bytes sent to the client after injection
+	proxy.OnResponse().DoFunc(
+		func(resp *http.Response, ctx *goproxy.ProxyCtx) *http.Response {
+			if resp == nil || ctx.Req.Method == http.MethodHead {
+				return resp
+			}
+			// Replacing the body makes goproxy drop Content-Length, so known lengths are added directly
+			if resp.ContentLength >= 0 {
+				metrics.bytesOut.Add(uint64(resp.ContentLength))
+				return resp
+			}
+			countBody(resp, &metrics.bytesOut)
+			return resp
+		},
+	)
 }
 
-// Launches the server
+// Launches the server and blocks until it is shut down
 func Launch(Flags *ProxySetup) {
-	server := initServer(Flags)
+	server, listeners, err := initServer(Flags)
+	if err != nil {
+		log.Fatalf("HTTP server Listen: %v", err)
+	}
 
 	// Print server startup message if from CLI or verbose CFFI
 	if Flags.Id == "cli" || Config.Verbose {
 		log.Println("Hazetunnel listening at", server.Addr)
 	}
-	if err := server.ListenAndServe(); err != http.ErrServerClosed {
-		log.Fatalf("HTTP server ListenAndServe: %v", err)
+	serve(server, listeners, log.Fatalf)
+}
+
+// Starts the server in the background.
+// Returns once the listeners are accepting connections.
+func Start(Flags *ProxySetup) (*net.TCPAddr, error) {
+	server, listeners, err := initServer(Flags)
+	if err != nil {
+		return nil, err
+	}
+
+	if Config.Verbose {
+		log.Println("Hazetunnel listening at", server.Addr)
+	}
+	go serve(server, listeners, log.Printf)
+	return listeners[0].Addr().(*net.TCPAddr), nil
+}
+
+// Runs an accept loop per listener until the server is shut down
+func serve(server *http.Server, listeners []net.Listener, logf func(string, ...interface{})) {
+	var wg sync.WaitGroup
+	for _, listener := range listeners {
+		wg.Add(1)
+		go func(listener net.Listener) {
+			defer wg.Done()
+			if err := server.Serve(listener); err != http.ErrServerClosed {
+				logf("HTTP server Serve: %v", err)
+			}
+		}(listener)
 	}
+	wg.Wait()
 }
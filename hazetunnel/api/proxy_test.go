@@ -0,0 +1,157 @@
+package api
+
+import (
+	"crypto/tls"
+	"fmt"
+	"io"
+	"net/http"
+	"net/http/httptest"
+	"net/url"
+	"path/filepath"
+	"sort"
+	"strings"
+	"sync"
+	"testing"
+	"time"
+)
+
+/*
+End-to-end benchmarks.
+Requests are sent through a running instance to a local origin, and report
+requests per second along with p50/p99 latency.
+*/
+
+const benchUserAgent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
+
+func benchOrigin() http.Handler {
+	html := benchHTML(16 * 1024)
+	large := benchHTML(4 * 1024 * 1024)
+	mux := http.NewServeMux()
+	mux.HandleFunc("/plain", func(w http.ResponseWriter, _ *http.Request) {
+		w.Header().Set("Content-Type", "text/plain")
+		io.WriteString(w, "Hello world!")
+	})
+	mux.HandleFunc("/html", func(w http.ResponseWriter, _ *http.Request) {
+		w.Header().Set("Content-Type", "text/html; charset=utf-8")
+		io.WriteString(w, html)
+	})
+	mux.HandleFunc("/js", func(w http.ResponseWriter, _ *http.Request) {
+		w.Header().Set("Content-Type", "application/javascript")
+		io.WriteString(w, "console.log('Original JavaScript executed.');")
+	})
+	mux.HandleFunc("/large", func(w http.ResponseWriter, _ *http.Request) {
+		w.Header().Set("Content-Type", "text/html; charset=utf-8")
+		io.WriteString(w, large)
+	})
+	return mux
+}
+
+// Starts an instance with a throwaway CA and returns its URL
+func benchProxy(b *testing.B, Flags *ProxySetup) *url.URL {
+	if !caLoaded {
+		dir := b.TempDir()
+		Config.Cert = filepath.Join(dir, "cert.pem")
+		Config.Key = filepath.Join(dir, "key.pem")
+	}
+	Flags.Addr = "127.0.0.1"
+	Flags.Id = fmt.Sprintf("bench-%d", time.Now().UnixNano())
+	addr, err := Start(Flags)
+	if err != nil {
+		b.Fatal(err)
+	}
+	b.Cleanup(func() { ShutdownServer(Flags.Id) })
+	return &url.URL{Scheme: "http", Host: addr.String()}
+}
+
+func BenchmarkProxy(b *testing.B) {
+	origin := httptest.NewServer(benchOrigin())
+	defer origin.Close()
+	tlsOrigin := httptest.NewTLSServer(benchOrigin())
+	defer tlsOrigin.Close()
+
+	proxyUrl := benchProxy(b, &ProxySetup{Payload: benchPayload})
+	client := &http.Client{
+		Transport: &http.Transport{
+			Proxy:               http.ProxyURL(proxyUrl),
+			TLSClientConfig:     &tls.Config{InsecureSkipVerify: true},
+			MaxIdleConnsPerHost: 64,
+		},
+	}
+	defer client.CloseIdleConnections()
+
+	for _, bench := range []struct {
+		name string
+		url  string
+	}{
+		{"PlainHTTP", origin.URL + "/plain"},
+		{"MitmHTTPS", tlsOrigin.URL + "/plain"},
+		{"HTMLInjection", tlsOrigin.URL + "/html"},
+		{"JSInjection", tlsOrigin.URL + "/js"},
+		{"LargeBody", tlsOrigin.URL + "/large"},
+	} {
+		b.Run(bench.name, func(b *testing.B) {
+			benchRequests(b, client, bench.url)
+		})
+	}
+}
+
+func benchRequests(b *testing.B, client *http.Client, target string) {
+	var (
+		mu        sync.Mutex
+		latencies = make([]time.Duration, 0, b.N)
+	)
+	b.ReportAllocs()
+	b.ResetTimer()
+	start := time.Now()
+	b.RunParallel(func(pb *testing.PB) {
+		local := make([]time.Duration, 0, 64)
+		for pb.Next() {
+			reqStart := time.Now()
+			if err := benchRequest(client, target); err != nil {
+				b.Error(err)
+				return
+			}
+			local = append(local, time.Since(reqStart))
+		}
+		mu.Lock()
+		latencies = append(latencies, local...)
+		mu.Unlock()
+	})
+	elapsed := time.Since(start)
+	b.StopTimer()
+
+	if len(latencies) == 0 {
+		return
+	}
+	sort.Slice(latencies, func(i, j int) bool { return latencies[i] < latencies[j] })
+	b.ReportMetric(float64(len(latencies))/elapsed.Seconds(), "req/s")
+	b.ReportMetric(float64(percentile(latencies, 0.50).Microseconds()), "p50-µs")
+	b.ReportMetric(float64(percentile(latencies, 0.99).Microseconds()), "p99-µs")
+}
+
+func benchRequest(client *http.Client, target string) error {
+	req, err := http.NewRequest(http.MethodGet, target, nil)
+	if err != nil {
+		return err
+	}
+	req.Header.Set("User-Agent", benchUserAgent)
+	resp, err := client.Do(req)
+	if err != nil {
+		return err
+	}
+	defer resp.Body.Close()
+	body, err := io.ReadAll(resp.Body)
+	if err != nil {
+		return err
+	}
+	if resp.StatusCode != http.StatusOK {
+		return fmt.Errorf("%s: %s: %s", target, resp.Status, strings.TrimSpace(string(body)))
+	}
+	return nil
+}
+
+// Returns the value at quantile q of sorted latencies
+func percentile(sorted []time.Duration, q float64) time.Duration {
+	i := int(q * float64(len(sorted)-1))
+	return sorted[i]
+}
@@ -0,0 +1,840 @@
+package api
+
+import (
+	"bytes"
+	"context"
+	"crypto/sha256"
+	"fmt"
+	"io"
+	"log"
+	"net/http"
+	"os"
+	"path/filepath"
+	"sort"
+	"strconv"
+	"strings"
+	"sync"
+	"sync/atomic"
+	"time"
+)
+
+/*
+Shared response cache.
+Cacheable GET responses are stored after injection, so hits skip both the
+upstream request and the rewrite. Small bodies are kept in memory, and larger
+ones, along with those evicted from memory, are written to a directory and
+memory-mapped when served. Entries are keyed by URL, the session's payload
+and the request headers named by Vary. Responses to requests with cookies are
+only stored when they are marked public, since the cache is shared by every
+session and every instance that enables it. Stale entries with validators are
+revalidated with conditional requests.
+*/
+
+const (
+	defaultResponseCacheSize     = 64 << 20
+	defaultResponseCacheDiskSize = 1 << 30
+	// Larger bodies aren't cached
+	maxCachedObject = 32 << 20
+	// Larger bodies skip the memory tier when there is a disk tier
+	maxMemoryObject = 1 << 20
+	// URLs whose Vary header names are remembered
+	varyCacheEntries = 16384
+	// Freshness limit for responses that only have a Last-Modified date
+	maxHeuristicLifetime = 24 * time.Hour
+	// Bodies on disk are named <key>-<version>.body
+	cacheFileSuffix = ".body"
+
+	cacheLookupKey contextKey = "cache"
+)
+
+// Statuses that may be stored, as long as the response allows it
+var cacheableStatus = map[int]bool{
+	http.StatusOK:                   true,
+	http.StatusNonAuthoritativeInfo: true,
+	http.StatusMovedPermanently:     true,
+	http.StatusNotFound:             true,
+	http.StatusGone:                 true,
+}
+
+// Stored headers that a 304 response doesn't replace
+var cacheUpdateExcluded = map[string]bool{
+	"Content-Length":    true,
+	"Content-Encoding":  true,
+	"Content-Range":     true,
+	"Transfer-Encoding": true,
+	"Connection":        true,
+	"Keep-Alive":        true,
+	"Proxy-Connection":  true,
+	"Trailer":           true,
+	"Upgrade":           true,
+}
+
+type ResponseCacheStats struct {
+	// Fresh entries served without contacting upstream
+	Hits uint64 `json:"hits"`
+	// Conditional requests sent for stale entries, and those answered with 304
+	Revalidations uint64 `json:"revalidations"`
+	Revalidated   uint64 `json:"revalidated"`
+	Misses        uint64 `json:"misses"`
+	Stores        uint64 `json:"stores"`
+	// Entries dropped from the cache altogether
+	Evictions uint64 `json:"evictions"`
+	// Requests answered with a cached body, out of every cacheable request
+	HitRatio      float64 `json:"hit_ratio"`
+	MemoryEntries int     `json:"memory_entries"`
+	MemoryBytes   int64   `json:"memory_bytes"`
+	DiskEntries   int     `json:"disk_entries"`
+	DiskBytes     int64   `json:"disk_bytes"`
+}
+
+type responseKey [sha256.Size]byte
+
+type cachedResponse struct {
+	// Increases with every stored or revalidated version, so an older version
+	// spilled to disk late never replaces a newer one
+	seq    uint64
+	status int
+	header http.Header
+	// The body is held in memory, or in the file at path
+	body []byte
+	path string
+	size int64
+	// When the response was received, and its age at that point
+	received   time.Time
+	initialAge time.Duration
+	lifetime   time.Duration
+	// Revalidated before every use (no-cache)
+	revalidate bool
+}
+
+type responseCache struct {
+	// Either tier is nil when it is disabled
+	memory *lruCache[responseKey, *cachedResponse]
+	disk   *lruCache[responseKey, *cachedResponse]
+	dir    string
+	// Header names each URL varies on
+	varies *lruCache[responseKey, []string]
+
+	seq      atomic.Uint64
+	closed   atomic.Bool
+	spillMux sync.Mutex
+
+	hits          atomic.Uint64
+	revalidations atomic.Uint64
+	revalidated   atomic.Uint64
+	misses        atomic.Uint64
+	stores        atomic.Uint64
+	evictions     atomic.Uint64
+}
+
+var (
+	responseCacheMux     sync.RWMutex
+	currentResponseCache *responseCache
+)
+
+// Builds a cache from the process-wide config
+func newResponseCache() *responseCache {
+	c := &responseCache{varies: newLRUCache[responseKey, []string](varyCacheEntries, nil, nil)}
+	size := Config.ResponseCacheSize
+	if size == 0 {
+		size = defaultResponseCacheSize
+	}
+	if size > 0 {
+		c.memory = newLRUCache(size, func(entry *cachedResponse) int64 {
+			return entry.size + headerSize(entry.header)
+		}, c.evictMemory)
+	}
+
+	diskSize := Config.ResponseCacheDiskSize
+	if diskSize == 0 {
+		diskSize = defaultResponseCacheDiskSize
+	}
+	if Config.ResponseCacheDir != "" && diskSize > 0 {
+		if err := prepareCacheDir(Config.ResponseCacheDir); err != nil {
+			log.Printf("Response cache directory is unavailable, caching in memory only: %v", err)
+		} else {
+			c.dir = Config.ResponseCacheDir
+			c.disk = newLRUCache(diskSize, func(entry *cachedResponse) int64 {
+				return entry.size
+			}, c.evictDisk)
+		}
+	}
+	return c
+}
+
+// Creates the disk tier directory and removes bodies left by a previous process
+func prepareCacheDir(dir string) error {
+	if err := os.MkdirAll(dir, 0o700); err != nil {
+		return err
+	}
+	stale, err := filepath.Glob(filepath.Join(dir, "*"+cacheFileSuffix))
+	if err != nil {
+		return err
+	}
+	for _, path := range stale {
+		os.Remove(path)
+	}
+	return nil
+}
+
+// Replaces the process-wide cache for the current config.
+// Entries of the previous cache are dropped.
+func resetResponseCache() {
+	responseCacheMux.Lock()
+	defer responseCacheMux.Unlock()
+	if currentResponseCache != nil {
+		currentResponseCache.Close()
+	}
+	currentResponseCache = newResponseCache()
+}
+
+func getResponseCache() *responseCache {
+	responseCacheMux.RLock()
+	c := currentResponseCache
+	responseCacheMux.RUnlock()
+	if c != nil {
+		return c
+	}
+
+	responseCacheMux.Lock()
+	defer responseCacheMux.Unlock()
+	if currentResponseCache == nil {
+		currentResponseCache = newResponseCache()
+	}
+	return currentResponseCache
+}
+
+// Close drops every entry and removes the bodies on disk
+func (c *responseCache) Close() {
+	c.spillMux.Lock()
+	c.closed.Store(true)
+	c.spillMux.Unlock()
+	if c.memory != nil {
+		c.memory.Purge()
+	}
+	if c.disk != nil {
+		c.disk.Purge()
+	}
+}
+
+// Moves entries evicted from memory to disk
+func (c *responseCache) evictMemory(key responseKey, entry *cachedResponse) {
+	if c.disk == nil || c.closed.Load() {
+		c.evictions.Add(1)
+		return
+	}
+	go c.spill(key, entry, entry.body)
+}
+
+func (c *responseCache) evictDisk(key responseKey, entry *cachedResponse) {
+	os.Remove(entry.path)
+	c.evictions.Add(1)
+}
+
+// Writes a body to the disk tier, unless a newer version is already there
+func (c *responseCache) spill(key responseKey, entry *cachedResponse, body []byte) {
+	path := filepath.Join(c.dir, fmt.Sprintf("%x-%d%s", key, entry.seq, cacheFileSuffix))
+	if err := writeFileAtomic(path, body, 0o600); err != nil {
+		log.Printf("Failed to write a cached response: %v", err)
+		c.evictions.Add(1)
+		return
+	}
+	onDisk := *entry
+	onDisk.body, onDisk.path = nil, path
+
+	c.spillMux.Lock()
+	defer c.spillMux.Unlock()
+	if c.closed.Load() {
+		os.Remove(path)
+		return
+	}
+	current, ok := c.disk.Get(key)
+	if ok && current.seq > entry.seq {
+		os.Remove(path)
+		return
+	}
+	if !c.disk.Add(key, &onDisk) {
+		os.Remove(path)
+		c.evictions.Add(1)
+		return
+	}
+	// Replaced entries aren't evicted, so their files are removed here
+	if ok && current.path != path {
+		os.Remove(current.path)
+	}
+}
+
+// Stores a version of a response, in memory if it fits and on disk otherwise
+func (c *responseCache) store(key responseKey, entry *cachedResponse, body []byte) {
+	if c.closed.Load() {
+		return
+	}
+	c.stores.Add(1)
+	entry.seq = c.seq.Add(1)
+	entry.size = int64(len(body))
+	if c.memory != nil && (c.disk == nil || entry.size <= maxMemoryObject) {
+		entry.body = body
+		if c.memory.Add(key, entry) {
+			return
+		}
+	}
+	if c.disk == nil {
+		c.evictions.Add(1)
+		return
+	}
+	// An older version in memory would shadow the new one on disk
+	if c.memory != nil {
+		c.memory.Remove(key)
+	}
+	go c.spill(key, entry, body)
+}
+
+// Replaces an entry with its revalidated version in the same tier
+func (c *responseCache) update(key responseKey, entry *cachedResponse) {
+	if entry.path == "" {
+		c.memory.Add(key, entry)
+		return
+	}
+	c.spillMux.Lock()
+	defer c.spillMux.Unlock()
+	if current, ok := c.disk.Get(key); ok && current.seq > entry.seq {
+		return
+	}
+	c.disk.Add(key, entry)
+}
+
+func (c *responseCache) get(key responseKey) (*cachedResponse, bool) {
+	if c.memory != nil {
+		if entry, ok := c.memory.Get(key); ok {
+			return entry, true
+		}
+	}
+	if c.disk != nil {
+		return c.disk.Get(key)
+	}
+	return nil, false
+}
+
+// Opens the body of an entry, which is mapped into memory when it is on disk
+func (c *responseCache) open(key responseKey, entry *cachedResponse) (*cachedBody, bool) {
+	if entry.path == "" {
+		return &cachedBody{Reader: bytes.NewReader(entry.body)}, true
+	}
+	data, unmap, err := mapFile(entry.path)
+	if err != nil {
+		// Removed by an eviction after the lookup
+		c.disk.Remove(key)
+		return nil, false
+	}
+	return &cachedBody{Reader: bytes.NewReader(data), unmap: unmap}, true
+}
+
+// Stats of the process-wide cache, nil if it hasn't been created. Creating it
+// here would clear the disk tier directory.
+func responseCacheStats() *ResponseCacheStats {
+	responseCacheMux.RLock()
+	defer responseCacheMux.RUnlock()
+	if currentResponseCache == nil {
+		return nil
+	}
+	stats := currentResponseCache.Stats()
+	return &stats
+}
+
+func (c *responseCache) Stats() ResponseCacheStats {
+	stats := ResponseCacheStats{
+		Hits:          c.hits.Load(),
+		Revalidations: c.revalidations.Load(),
+		Revalidated:   c.revalidated.Load(),
+		Misses:        c.misses.Load(),
+		Stores:        c.stores.Load(),
+		Evictions:     c.evictions.Load(),
+	}
+	if lookups := stats.Hits + stats.Revalidations + stats.Misses; lookups > 0 {
+		stats.HitRatio = float64(stats.Hits+stats.Revalidated) / float64(lookups)
+	}
+	if c.memory != nil {
+		stats.MemoryEntries, stats.MemoryBytes = c.memory.Len(), c.memory.Cost()
+	}
+	if c.disk != nil {
+		stats.DiskEntries, stats.DiskBytes = c.disk.Len(), c.disk.Cost()
+	}
+	return stats
+}
+
+/*
+Lookups
+*/
+
+// A cacheable request on its way upstream
+type cacheLookup struct {
+	cache   *responseCache
+	primary responseKey
+	// The stale entry being revalidated, if any
+	key   responseKey
+	entry *cachedResponse
+	// The entry's body, opened once upstream confirmed it
+	body *cachedBody
+	// The client's own conditions, replaced by the entry's validators
+	ifNoneMatch     string
+	ifModifiedSince string
+}
+
+// Lookup serves a fresh cached response for req, or returns the lookup to
+// store the upstream response with. Stale entries with validators turn req
+// into a conditional request. Both are nil if req can't use the cache.
+func (c *responseCache) Lookup(req *http.Request, payload *preparedPayload) (*cacheLookup, *http.Response) {
+	if !cacheableRequest(req) || (c.memory == nil && c.disk == nil) {
+		return nil, nil
+	}
+	lookup := &cacheLookup{cache: c, primary: primaryKey(req, payload)}
+	names, _ := c.varies.Get(lookup.primary)
+	key := variantKey(lookup.primary, names, req.Header)
+	entry, ok := c.get(key)
+	if !ok {
+		c.misses.Add(1)
+		return lookup, nil
+	}
+
+	now := time.Now()
+	if entry.fresh(now) && !requestRevalidates(req) {
+		body, ok := c.open(key, entry)
+		if !ok {
+			c.misses.Add(1)
+			return lookup, nil
+		}
+		c.hits.Add(1)
+		return nil, entry.response(req, body, now, req.Header.Get("If-None-Match"), req.Header.Get("If-Modified-Since"))
+	}
+
+	etag, lastModified := entry.header.Get("ETag"), entry.header.Get("Last-Modified")
+	if etag == "" && lastModified == "" {
+		c.misses.Add(1)
+		return lookup, nil
+	}
+	c.revalidations.Add(1)
+	lookup.key, lookup.entry = key, entry
+	lookup.ifNoneMatch = req.Header.Get("If-None-Match")
+	lookup.ifModifiedSince = req.Header.Get("If-Modified-Since")
+	req.Header.Del("If-None-Match")
+	req.Header.Del("If-Modified-Since")
+	if etag != "" {
+		req.Header.Set("If-None-Match", etag)
+	}
+	if lastModified != "" {
+		req.Header.Set("If-Modified-Since", lastModified)
+	}
+	return lookup, nil
+}
+
+// Evicted reports whether the entry upstream confirmed with resp was evicted
+// while revalidating. req then has the client's own conditions back, and has
+// to be sent again. A 304 is passed on instead when the client's conditions
+// match the entry.
+func (l *cacheLookup) Evicted(req *http.Request, resp *http.Response) bool {
+	if l == nil || l.entry == nil || resp.StatusCode != http.StatusNotModified {
+		return false
+	}
+	body, ok := l.cache.open(l.key, l.entry)
+	if ok {
+		l.body = body
+		return false
+	}
+	entry := l.entry
+	l.entry = nil
+	if entry.status == http.StatusOK && notModified(entry.header, l.ifNoneMatch, l.ifModifiedSince) {
+		return false
+	}
+	resp.Body.Close()
+	req.Header.Del("If-None-Match")
+	req.Header.Del("If-Modified-Since")
+	if l.ifNoneMatch != "" {
+		req.Header.Set("If-None-Match", l.ifNoneMatch)
+	}
+	if l.ifModifiedSince != "" {
+		req.Header.Set("If-Modified-Since", l.ifModifiedSince)
+	}
+	return true
+}
+
+// Revalidated answers a revalidation that upstream confirmed with a 304 from
+// the cached entry, refreshing its headers and freshness. Other responses are
+// returned as they are.
+func (l *cacheLookup) Revalidated(req *http.Request, resp *http.Response) *http.Response {
+	if l == nil || l.entry == nil || l.body == nil || resp.StatusCode != http.StatusNotModified {
+		return resp
+	}
+	resp.Body.Close()
+	l.cache.revalidated.Add(1)
+
+	now := time.Now()
+	entry := l.entry.revalidatedBy(resp.Header, now)
+	entry.seq = l.cache.seq.Add(1)
+	l.cache.update(l.key, entry)
+	return entry.response(req, l.body, now, l.ifNoneMatch, l.ifModifiedSince)
+}
+
+// Store caches resp once its body has been read to the end, if it is cacheable
+func (l *cacheLookup) Store(req *http.Request, resp *http.Response) {
+	if resp.Body == nil {
+		return
+	}
+	if _, ok := resp.Body.(*cachedBody); ok {
+		return
+	}
+	if !cacheableResponse(resp) || resp.ContentLength > maxCachedObject {
+		return
+	}
+	// Responses to requests with cookies may be personalized
+	if _, public := parseCacheControl(resp.Header)["public"]; !public && req.Header.Get("Cookie") != "" {
+		return
+	}
+	now := time.Now()
+	lifetime, initialAge, revalidate := freshness(resp.StatusCode, resp.Header, now)
+	if lifetime <= 0 && resp.Header.Get("ETag") == "" && resp.Header.Get("Last-Modified") == "" {
+		// Would never be served without being fetched again
+		return
+	}
+
+	names := varyNames(resp.Header)
+	if len(names) > 0 {
+		l.cache.varies.Add(l.primary, names)
+	} else {
+		l.cache.varies.Remove(l.primary)
+	}
+	entry := &cachedResponse{
+		status:     resp.StatusCode,
+		header:     storedHeader(resp.Header),
+		received:   now,
+		initialAge: initialAge,
+		lifetime:   lifetime,
+		revalidate: revalidate,
+	}
+	resp.Body = &cacheWriter{
+		ReadCloser: resp.Body,
+		cache:      l.cache,
+		key:        variantKey(l.primary, names, req.Header),
+		entry:      entry,
+	}
+}
+
+// Stores the lookup for the response handlers
+func withCacheLookup(ctx context.Context, lookup *cacheLookup) context.Context {
+	if lookup == nil {
+		return ctx
+	}
+	return context.WithValue(ctx, cacheLookupKey, lookup)
+}
+
+func cacheLookupFrom(ctx context.Context) *cacheLookup {
+	lookup, _ := ctx.Value(cacheLookupKey).(*cacheLookup)
+	return lookup
+}
+
+func (e *cachedResponse) age(now time.Time) time.Duration {
+	return e.initialAge + now.Sub(e.received)
+}
+
+func (e *cachedResponse) fresh(now time.Time) bool {
+	return !e.revalidate && e.lifetime > e.age(now)
+}
+
+// Returns a copy of the entry with the headers of a 304 response merged in
+func (e *cachedResponse) revalidatedBy(header http.Header, now time.Time) *cachedResponse {
+	updated := *e
+	updated.header = e.header.Clone()
+	for name, values := range header {
+		if !cacheUpdateExcluded[name] {
+			updated.header[name] = values
+		}
+	}
+	updated.received = now
+	updated.lifetime, updated.initialAge, updated.revalidate = freshness(e.status, updated.header, now)
+	return &updated
+}
+
+// Builds the response for an entry, which is a 304 if the client's own
+// conditions match it
+func (e *cachedResponse) response(req *http.Request, body *cachedBody, now time.Time, ifNoneMatch, ifModifiedSince string) *http.Response {
+	header := e.header.Clone()
+	header.Set("Age", strconv.FormatInt(int64(e.age(now)/time.Second), 10))
+	resp := &http.Response{
+		Status:     fmt.Sprintf("%d %s", e.status, http.StatusText(e.status)),
+		StatusCode: e.status,
+		Proto:      "HTTP/1.1",
+		ProtoMajor: 1,
+		ProtoMinor: 1,
+		Header:     header,
+		Request:    req,
+	}
+	if e.status == http.StatusOK && notModified(header, ifNoneMatch, ifModifiedSince) {
+		body.Close()
+		resp.Status, resp.StatusCode = "304 Not Modified", http.StatusNotModified
+		resp.Body = http.NoBody
+		return resp
+	}
+	header.Set("Content-Length", strconv.FormatInt(e.size, 10))
+	resp.Body, resp.ContentLength = body, e.size
+	return resp
+}
+
+// Body of a response served from the cache, which the injector leaves alone
+type cachedBody struct {
+	*bytes.Reader
+	// Unmaps a body on disk
+	unmap  func() error
+	mu     sync.Mutex
+	closed bool
+}
+
+func (b *cachedBody) Read(p []byte) (int, error) {
+	b.mu.Lock()
+	defer b.mu.Unlock()
+	if b.closed {
+		// The mapping is gone
+		return 0, os.ErrClosed
+	}
+	return b.Reader.Read(p)
+}
+
+func (b *cachedBody) Close() error {
+	b.mu.Lock()
+	defer b.mu.Unlock()
+	if b.closed {
+		return nil
+	}
+	b.closed = true
+	if b.unmap != nil {
+		return b.unmap()
+	}
+	return nil
+}
+
+// Copies a body into the cache as it is sent to the client
+type cacheWriter struct {
+	io.ReadCloser
+	cache *responseCache
+	key   responseKey
+	entry *cachedResponse
+	buf   bytes.Buffer
+	// Set once the body is too large or has been stored
+	done bool
+}
+
+func (w *cacheWriter) Read(p []byte) (int, error) {
+	n, err := w.ReadCloser.Read(p)
+	if w.done {
+		return n, err
+	}
+	if w.buf.Len()+n > maxCachedObject {
+		w.done = true
+		w.buf = bytes.Buffer{}
+		return n, err
+	}
+	w.buf.Write(p[:n])
+	if err == io.EOF {
+		// Bodies closed before the end are never stored
+		w.done = true
+		w.cache.store(w.key, w.entry, w.buf.Bytes())
+	}
+	return n, err
+}
+
+/*
+HTTP caching rules
+*/
+
+func cacheableRequest(req *http.Request) bool {
+	if req.Method != http.MethodGet {
+		return false
+	}
+	// Authorized, partial and upgraded requests are never shared
+	for _, name := range []string{"Authorization", "Range", "Upgrade"} {
+		if req.Header.Get(name) != "" {
+			return false
+		}
+	}
+	_, noStore := parseCacheControl(req.Header)["no-store"]
+	return !noStore
+}
+
+// Reports whether the client asked for the response to be revalidated
+func requestRevalidates(req *http.Request) bool {
+	cc := parseCacheControl(req.Header)
+	if _, ok := cc["no-cache"]; ok {
+		return true
+	}
+	if maxAge, ok := cacheSeconds(cc, "max-age"); ok && maxAge == 0 {
+		return true
+	}
+	return strings.Contains(strings.ToLower(req.Header.Get("Pragma")), "no-cache")
+}
+
+func cacheableResponse(resp *http.Response) bool {
+	if !cacheableStatus[resp.StatusCode] {
+		return false
+	}
+	cc := parseCacheControl(resp.Header)
+	if _, ok := cc["no-store"]; ok {
+		return false
+	}
+	if _, ok := cc["private"]; ok {
+		return false
+	}
+	if len(resp.Header.Values("Set-Cookie")) > 0 || resp.Header.Get("Content-Range") != "" {
+		return false
+	}
+	for _, name := range varyNames(resp.Header) {
+		if name == "*" {
+			return false
+		}
+	}
+	return true
+}
+
+// Returns how long a response stays fresh, its age when it was received,
+// and whether it must be revalidated before every use
+func freshness(status int, header http.Header, now time.Time) (lifetime, initialAge time.Duration, revalidate bool) {
+	cc := parseCacheControl(header)
+	_, revalidate = cc["no-cache"]
+
+	date, err := http.ParseTime(header.Get("Date"))
+	if err != nil {
+		date = now
+	}
+	initialAge = max(0, now.Sub(date))
+	if age, err := strconv.ParseInt(header.Get("Age"), 10, 64); err == nil && age > 0 {
+		initialAge = max(initialAge, time.Duration(min(age, 1<<31))*time.Second)
+	}
+
+	if maxAge, ok := cacheSeconds(cc, "s-maxage"); ok {
+		return maxAge, initialAge, revalidate
+	}
+	if maxAge, ok := cacheSeconds(cc, "max-age"); ok {
+		return maxAge, initialAge, revalidate
+	}
+	if value := header.Get("Expires"); value != "" {
+		// Invalid dates mean the response has already expired
+		expires, err := http.ParseTime(value)
+		if err != nil {
+			return 0, initialAge, revalidate
+		}
+		return max(0, expires.Sub(date)), initialAge, revalidate
+	}
+	if lastModified, err := http.ParseTime(header.Get("Last-Modified")); err == nil && cacheableStatus[status] {
+		return min(max(0, date.Sub(lastModified)/10), maxHeuristicLifetime), initialAge, revalidate
+	}
+	return 0, initialAge, revalidate
+}
+
+// Reports whether a client's conditions match the cached headers
+func notModified(header http.Header, ifNoneMatch, ifModifiedSince string) bool {
+	if ifNoneMatch != "" {
+		etag := strings.TrimPrefix(header.Get("ETag"), "W/")
+		if etag == "" {
+			return false
+		}
+		for _, candidate := range strings.Split(ifNoneMatch, ",") {
+			candidate = strings.TrimSpace(candidate)
+			if candidate == "*" || strings.TrimPrefix(candidate, "W/") == etag {
+				return true
+			}
+		}
+		return false
+	}
+	if ifModifiedSince == "" {
+		return false
+	}
+	since, err := http.ParseTime(ifModifiedSince)
+	if err != nil {
+		return false
+	}
+	lastModified, err := http.ParseTime(header.Get("Last-Modified"))
+	return err == nil && !lastModified.After(since)
+}
+
+// Directive names are lowercased and quoted values unquoted
+func parseCacheControl(header http.Header) map[string]string {
+	cc := make(map[string]string)
+	for _, line := range header.Values("Cache-Control") {
+		for _, part := range strings.Split(line, ",") {
+			name, value, _ := strings.Cut(strings.TrimSpace(part), "=")
+			if name != "" {
+				cc[strings.ToLower(name)] = strings.Trim(value, `"`)
+			}
+		}
+	}
+	return cc
+}
+
+func cacheSeconds(cc map[string]string, name string) (time.Duration, bool) {
+	value, ok := cc[name]
+	if !ok {
+		return 0, false
+	}
+	seconds, err := strconv.ParseInt(value, 10, 64)
+	if err != nil || seconds < 0 {
+		return 0, false
+	}
+	return time.Duration(min(seconds, 1<<31)) * time.Second, true
+}
+
+// Returns the canonical header names a response varies on, sorted
+func varyNames(header http.Header) []string {
+	var names []string
+	for _, line := range header.Values("Vary") {
+		for _, name := range strings.Split(line, ",") {
+			if name = strings.TrimSpace(name); name != "" {
+				names = append(names, http.CanonicalHeaderKey(name))
+			}
+		}
+	}
+	sort.Strings(names)
+	return names
+}
+
+// The headers kept with an entry, without hop-by-hop ones
+func storedHeader(header http.Header) http.Header {
+	stored := header.Clone()
+	for name := range cacheUpdateExcluded {
+		if name != "Content-Encoding" {
+			stored.Del(name)
+		}
+	}
+	stored.Del("Age")
+	return stored
+}
+
+func headerSize(header http.Header) int64 {
+	size := int64(0)
+	for name, values := range header {
+		for _, value := range values {
+			size += int64(len(name) + len(value) + 4)
+		}
+	}
+	return size
+}
+
+// The key of every variant of a URL for a payload
+func primaryKey(req *http.Request, payload *preparedPayload) responseKey {
+	h := sha256.New()
+	h.Write(payload.digest[:])
+	io.WriteString(h, req.URL.String())
+	return responseKey(h.Sum(nil))
+}
+
+// The key of the variant selected by the request headers named by Vary
+func variantKey(primary responseKey, names []string, header http.Header) responseKey {
+	if len(names) == 0 {
+		return primary
+	}
+	h := sha256.New()
+	h.Write(primary[:])
+	for _, name := range names {
+		io.WriteString(h, name)
+		h.Write([]byte{0})
+		io.WriteString(h, strings.Join(header.Values(name), ","))
+		h.Write([]byte{0})
+	}
+	return responseKey(h.Sum(nil))
+}
@@ -0,0 +1,310 @@
+package api
+
+import (
+	"io"
+	"net/http"
+	"os"
+	"path/filepath"
+	"reflect"
+	"strings"
+	"testing"
+	"time"
+)
+
+func cacheHeader(pairs ...string) http.Header {
+	header := make(http.Header)
+	for i := 0; i < len(pairs); i += 2 {
+		header.Add(pairs[i], pairs[i+1])
+	}
+	return header
+}
+
+func TestFreshness(t *testing.T) {
+	now := time.Now().Truncate(time.Second)
+	date := now.UTC().Format(http.TimeFormat)
+	before := func(d time.Duration) string {
+		return now.Add(-d).UTC().Format(http.TimeFormat)
+	}
+	tests := []struct {
+		name       string
+		status     int
+		header     http.Header
+		lifetime   time.Duration
+		initialAge time.Duration
+		revalidate bool
+	}{
+		{"nothing", 200, cacheHeader("Date", date), 0, 0, false},
+		{"max-age", 200, cacheHeader("Date", date, "Cache-Control", "public, max-age=60"), time.Minute, 0, false},
+		{"s-maxage over max-age", 200, cacheHeader("Date", date, "Cache-Control", "max-age=60, s-maxage=120"), 2 * time.Minute, 0, false},
+		{"max-age over Expires", 200, cacheHeader("Date", date, "Cache-Control", "max-age=60", "Expires", now.Add(time.Hour).UTC().Format(http.TimeFormat)), time.Minute, 0, false},
+		{"invalid max-age", 200, cacheHeader("Date", date, "Cache-Control", "max-age=-1"), 0, 0, false},
+		{"Expires", 200, cacheHeader("Date", date, "Expires", now.Add(time.Hour).UTC().Format(http.TimeFormat)), time.Hour, 0, false},
+		{"Expires in the past", 200, cacheHeader("Date", date, "Expires", before(time.Hour)), 0, 0, false},
+		{"invalid Expires", 200, cacheHeader("Date", date, "Expires", "0", "Last-Modified", before(10*time.Hour)), 0, 0, false},
+		{"heuristic", 200, cacheHeader("Date", date, "Last-Modified", before(10*time.Hour)), time.Hour, 0, false},
+		{"heuristic limit", 200, cacheHeader("Date", date, "Last-Modified", before(1000*time.Hour)), maxHeuristicLifetime, 0, false},
+		{"heuristic for an uncacheable status", 206, cacheHeader("Date", date, "Last-Modified", before(10*time.Hour)), 0, 0, false},
+		{"no-cache", 200, cacheHeader("Date", date, "Cache-Control", "no-cache, max-age=60"), time.Minute, 0, true},
+		{"Date", 200, cacheHeader("Date", before(10*time.Second), "Cache-Control", "max-age=60"), time.Minute, 10 * time.Second, false},
+		{"Age", 200, cacheHeader("Date", date, "Age", "30", "Cache-Control", "max-age=60"), time.Minute, 30 * time.Second, false},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			lifetime, initialAge, revalidate := freshness(tt.status, tt.header, now)
+			if lifetime != tt.lifetime || initialAge != tt.initialAge || revalidate != tt.revalidate {
+				t.Errorf("freshness() = %v, %v, %v, want %v, %v, %v", lifetime, initialAge, revalidate, tt.lifetime, tt.initialAge, tt.revalidate)
+			}
+		})
+	}
+}
+
+func TestNotModified(t *testing.T) {
+	lastModified := time.Date(2024, 1, 1, 0, 0, 0, 0, time.UTC)
+	header := cacheHeader("ETag", `"v1"`, "Last-Modified", lastModified.Format(http.TimeFormat))
+	tests := []struct {
+		name            string
+		header          http.Header
+		ifNoneMatch     string
+		ifModifiedSince string
+		want            bool
+	}{
+		{"no conditions", header, "", "", false},
+		{"ETag", header, `"v1"`, "", true},
+		{"weak ETag", header, `W/"v1"`, "", true},
+		{"ETag list", header, `"v0", "v1"`, "", true},
+		{"any ETag", header, "*", "", true},
+		{"other ETag", header, `"v2"`, "", false},
+		{"no ETag", cacheHeader("Last-Modified", lastModified.Format(http.TimeFormat)), `"v1"`, "", false},
+		{"If-None-Match over If-Modified-Since", header, `"v2"`, lastModified.Format(http.TimeFormat), false},
+		{"unmodified", header, "", lastModified.Format(http.TimeFormat), true},
+		{"unmodified since later", header, "", lastModified.Add(time.Hour).Format(http.TimeFormat), true},
+		{"modified", header, "", lastModified.Add(-time.Hour).Format(http.TimeFormat), false},
+		{"invalid date", header, "", "yesterday", false},
+		{"no Last-Modified", cacheHeader("ETag", `"v1"`), "", lastModified.Format(http.TimeFormat), false},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			if got := notModified(tt.header, tt.ifNoneMatch, tt.ifModifiedSince); got != tt.want {
+				t.Errorf("notModified() = %v, want %v", got, tt.want)
+			}
+		})
+	}
+}
+
+func TestVaryNames(t *testing.T) {
+	tests := []struct {
+		name   string
+		header http.Header
+		want   []string
+	}{
+		{"none", cacheHeader(), nil},
+		{"canonical and sorted", cacheHeader("Vary", "user-agent, accept-encoding"), []string{"Accept-Encoding", "User-Agent"}},
+		{"several lines", cacheHeader("Vary", "Origin", "Vary", " ,Accept"), []string{"Accept", "Origin"}},
+		{"any", cacheHeader("Vary", "*"), []string{"*"}},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			if got := varyNames(tt.header); !reflect.DeepEqual(got, tt.want) {
+				t.Errorf("varyNames() = %q, want %q", got, tt.want)
+			}
+		})
+	}
+}
+
+func TestVariantKey(t *testing.T) {
+	req, _ := http.NewRequest(http.MethodGet, "https://example.com/app.js", nil)
+	primary := primaryKey(req, preparePayload(benchPayload))
+	names := []string{"Accept-Encoding"}
+
+	if variantKey(primary, nil, cacheHeader("Accept-Encoding", "gzip")) != primary {
+		t.Error("responses without Vary should use the primary key")
+	}
+	gzip := variantKey(primary, names, cacheHeader("Accept-Encoding", "gzip", "User-Agent", "a"))
+	if gzip == primary {
+		t.Error("variants should have their own keys")
+	}
+	if variantKey(primary, names, cacheHeader("Accept-Encoding", "gzip", "User-Agent", "b")) != gzip {
+		t.Error("headers not named by Vary shouldn't change the key")
+	}
+	if variantKey(primary, names, cacheHeader("Accept-Encoding", "br")) == gzip {
+		t.Error("different values should have different keys")
+	}
+	if variantKey(primary, names, cacheHeader()) != variantKey(primary, names, cacheHeader("Accept-Encoding", "")) {
+		t.Error("a missing header and an empty one should select the same variant")
+	}
+}
+
+func TestPrimaryKeyPayload(t *testing.T) {
+	req, _ := http.NewRequest(http.MethodGet, "https://example.com/", nil)
+	if primaryKey(req, preparePayload(benchPayload)) == primaryKey(req, preparePayload("console.log(1);")) {
+		t.Error("payloads should have their own entries")
+	}
+}
+
+func TestCacheableResponse(t *testing.T) {
+	tests := []struct {
+		name   string
+		status int
+		header http.Header
+		want   bool
+	}{
+		{"ok", 200, cacheHeader(), true},
+		{"not found", 404, cacheHeader(), true},
+		{"partial content", 206, cacheHeader(), false},
+		{"server error", 500, cacheHeader("Cache-Control", "max-age=60"), false},
+		{"no-store", 200, cacheHeader("Cache-Control", "max-age=60, no-store"), false},
+		{"private", 200, cacheHeader("Cache-Control", "Private"), false},
+		{"Set-Cookie", 200, cacheHeader("Set-Cookie", "id=1"), false},
+		{"Content-Range", 200, cacheHeader("Content-Range", "bytes 0-1/2"), false},
+		{"Vary", 200, cacheHeader("Vary", "Accept-Encoding"), true},
+		{"Vary *", 200, cacheHeader("Vary", "Accept-Encoding, *"), false},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			resp := &http.Response{StatusCode: tt.status, Header: tt.header}
+			if got := cacheableResponse(resp); got != tt.want {
+				t.Errorf("cacheableResponse() = %v, want %v", got, tt.want)
+			}
+		})
+	}
+}
+
+func TestCacheLookupStoreCookies(t *testing.T) {
+	tests := []struct {
+		name         string
+		cookie       string
+		cacheControl string
+		want         bool
+	}{
+		{"without a cookie", "", "max-age=60", true},
+		{"with a cookie", "id=1", "max-age=60", false},
+		{"public with a cookie", "id=1", "public, max-age=60", true},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			req, _ := http.NewRequest(http.MethodGet, "https://example.com/", nil)
+			if tt.cookie != "" {
+				req.Header.Set("Cookie", tt.cookie)
+			}
+			c := &responseCache{varies: newLRUCache[responseKey, []string](16, nil, nil)}
+			lookup := &cacheLookup{cache: c, primary: primaryKey(req, preparePayload(benchPayload))}
+			resp := &http.Response{
+				StatusCode: http.StatusOK,
+				Header:     cacheHeader("Cache-Control", tt.cacheControl),
+				Body:       io.NopCloser(strings.NewReader("body")),
+			}
+			lookup.Store(req, resp)
+			if _, stored := resp.Body.(*cacheWriter); stored != tt.want {
+				t.Errorf("stored = %v, want %v", stored, tt.want)
+			}
+		})
+	}
+}
+
+// A 304 for an entry evicted from disk while revalidating
+func TestCacheLookupEvicted(t *testing.T) {
+	tests := []struct {
+		name        string
+		ifNoneMatch string
+		evict       bool
+		retry       bool
+		// Header the retried request should carry
+		wantIfNoneMatch string
+		wantStatus      int
+	}{
+		{"cached", "", false, false, "", http.StatusOK},
+		{"cached with the client's ETag", `"v1"`, false, false, "", http.StatusNotModified},
+		{"evicted", "", true, true, "", 0},
+		{"evicted with the client's ETag", `"v1"`, true, false, "", http.StatusNotModified},
+		{"evicted with another ETag", `"v0"`, true, true, `"v0"`, 0},
+	}
+	payload := preparePayload(benchPayload)
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			path := filepath.Join(t.TempDir(), "entry"+cacheFileSuffix)
+			if err := os.WriteFile(path, []byte("body"), 0o600); err != nil {
+				t.Fatal(err)
+			}
+			c := &responseCache{
+				disk:   newLRUCache[responseKey, *cachedResponse](16, nil, nil),
+				varies: newLRUCache[responseKey, []string](16, nil, nil),
+			}
+			req, _ := http.NewRequest(http.MethodGet, "https://example.com/", nil)
+			if tt.ifNoneMatch != "" {
+				req.Header.Set("If-None-Match", tt.ifNoneMatch)
+			}
+			c.disk.Add(primaryKey(req, payload), &cachedResponse{
+				status:   http.StatusOK,
+				header:   cacheHeader("ETag", `"v1"`),
+				path:     path,
+				size:     4,
+				received: time.Now(),
+			})
+
+			lookup, cached := c.Lookup(req, payload)
+			if cached != nil || lookup == nil || req.Header.Get("If-None-Match") != `"v1"` {
+				t.Fatal("stale entry wasn't revalidated")
+			}
+			if tt.evict {
+				os.Remove(path)
+			}
+			resp := &http.Response{StatusCode: http.StatusNotModified, Header: cacheHeader(), Body: http.NoBody}
+			if retry := lookup.Evicted(req, resp); retry != tt.retry {
+				t.Fatalf("Evicted() = %v, want %v", retry, tt.retry)
+			}
+			if tt.retry {
+				if got := req.Header.Get("If-None-Match"); got != tt.wantIfNoneMatch {
+					t.Errorf("retried If-None-Match = %q, want %q", got, tt.wantIfNoneMatch)
+				}
+				return
+			}
+			served := lookup.Revalidated(req, resp)
+			defer served.Body.Close()
+			if served.StatusCode != tt.wantStatus {
+				t.Errorf("status = %d, want %d", served.StatusCode, tt.wantStatus)
+			}
+			if tt.wantStatus == http.StatusOK {
+				if body, _ := io.ReadAll(served.Body); string(body) != "body" {
+					t.Errorf("body = %q, want the cached one", body)
+				}
+			}
+		})
+	}
+}
+
+// Reading the metrics shouldn't create the cache and clear its directory
+func TestResponseCacheStatsUnused(t *testing.T) {
+	responseCacheMux.Lock()
+	previous := currentResponseCache
+	currentResponseCache = nil
+	responseCacheMux.Unlock()
+	dir := Config.ResponseCacheDir
+	t.Cleanup(func() {
+		responseCacheMux.Lock()
+		if currentResponseCache != nil {
+			currentResponseCache.Close()
+		}
+		currentResponseCache = previous
+		responseCacheMux.Unlock()
+		Config.ResponseCacheDir = dir
+	})
+
+	Config.ResponseCacheDir = t.TempDir()
+	path := filepath.Join(Config.ResponseCacheDir, "entry"+cacheFileSuffix)
+	if err := os.WriteFile(path, []byte("body"), 0o600); err != nil {
+		t.Fatal(err)
+	}
+	metrics := &Metrics{}
+	if metrics.Stats().ResponseCache != nil {
+		t.Error("stats has a response cache section")
+	}
+	if strings.Contains(metrics.Prometheus(), "response_cache") {
+		t.Error("Prometheus output has response cache series")
+	}
+	if _, err := os.Stat(path); err != nil {
+		t.Errorf("cached body was removed: %v", err)
+	}
+	if getResponseCache(); metrics.Stats().ResponseCache == nil {
+		t.Error("stats are missing once the cache exists")
+	}
+}
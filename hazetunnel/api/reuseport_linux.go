@@ -0,0 +1,21 @@
+//go:build linux
+
+package api
+
+import (
+	"syscall"
+
+	"golang.org/x/sys/unix"
+)
+
+// Lets the listeners of an instance bind the same port
+func reusePort(network, address string, c syscall.RawConn) error {
+	var sockErr error
+	err := c.Control(func(fd uintptr) {
+		sockErr = unix.SetsockoptInt(int(fd), unix.SOL_SOCKET, unix.SO_REUSEPORT, 1)
+	})
+	if err != nil {
+		return err
+	}
+	return sockErr
+}
@@ -0,0 +1,14 @@
+//go:build !linux
+
+package api
+
+import (
+	"errors"
+	"syscall"
+)
+
+// Other systems either lack SO_REUSEPORT or don't balance connections across
+// the sockets sharing a port
+func reusePort(network, address string, c syscall.RawConn) error {
+	return errors.New("multiple listeners are only supported on Linux")
+}
@@ -0,0 +1,156 @@
+package api
+
+import (
+	"fmt"
+	"net"
+	"path"
+	"strings"
+)
+
+/*
+Intercept rules.
+Hosts are matched against a suffix trie of domain labels, with patterns that
+can't be expressed as a suffix falling back to globs. Hosts that aren't
+intercepted are tunneled to the origin without being decrypted.
+
+Pattern forms:
+	example.com     the host itself
+	*.example.com   subdomains of example.com
+	.example.com    example.com and its subdomains
+	cdn-*.net       any other glob, matched with path.Match
+*/
+
+type interceptRules struct {
+	// Hosts to intercept, every host when empty
+	intercept *hostMatcher
+	// Hosts to tunnel even if they are intercepted
+	passthrough *hostMatcher
+}
+
+func newInterceptRules(Flags *ProxySetup) (*interceptRules, error) {
+	intercept, err := compileHostMatcher(Flags.Intercept)
+	if err != nil {
+		return nil, fmt.Errorf("invalid intercept rule: %w", err)
+	}
+	passthrough, err := compileHostMatcher(Flags.Passthrough)
+	if err != nil {
+		return nil, fmt.Errorf("invalid passthrough rule: %w", err)
+	}
+	return &interceptRules{intercept: intercept, passthrough: passthrough}, nil
+}
+
+// Intercept reports whether a CONNECT to host should be MITM'd
+func (r *interceptRules) Intercept(host string) bool {
+	host = normalizeHost(host)
+	if !r.intercept.Empty() && !r.intercept.Match(host) {
+		return false
+	}
+	return !r.passthrough.Match(host)
+}
+
+type hostMatcher struct {
+	root  suffixNode
+	globs []string
+}
+
+// Trie node keyed by domain labels, from the top-level domain down
+type suffixNode struct {
+	children map[string]*suffixNode
+	// A pattern matches the host ending at this node
+	exact bool
+	// A pattern matches every subdomain below this node
+	subdomains bool
+}
+
+func compileHostMatcher(patterns []string) (*hostMatcher, error) {
+	m := &hostMatcher{}
+	for _, pattern := range patterns {
+		pattern = strings.TrimSuffix(strings.ToLower(strings.TrimSpace(pattern)), ".")
+		if pattern == "" {
+			continue
+		}
+		var exact, subdomains bool
+		switch {
+		case strings.HasPrefix(pattern, "*."):
+			pattern, subdomains = pattern[2:], true
+		case strings.HasPrefix(pattern, "."):
+			pattern, exact, subdomains = pattern[1:], true, true
+		default:
+			exact = true
+		}
+		if strings.ContainsAny(pattern, "*?[") {
+			// Not a plain suffix, match it as a glob instead
+			if _, err := path.Match(pattern, ""); err != nil {
+				return nil, fmt.Errorf("%s: %w", pattern, err)
+			}
+			if exact {
+				m.globs = append(m.globs, pattern)
+			}
+			if subdomains {
+				m.globs = append(m.globs, "*."+pattern)
+			}
+			continue
+		}
+		node := &m.root
+		for _, label := range reverseLabels(pattern) {
+			child, ok := node.children[label]
+			if !ok {
+				if node.children == nil {
+					node.children = make(map[string]*suffixNode)
+				}
+				child = &suffixNode{}
+				node.children[label] = child
+			}
+			node = child
+		}
+		node.exact = node.exact || exact
+		node.subdomains = node.subdomains || subdomains
+	}
+	return m, nil
+}
+
+func (m *hostMatcher) Empty() bool {
+	return len(m.root.children) == 0 && len(m.globs) == 0
+}
+
+// Match reports whether a normalized host matches any pattern
+func (m *hostMatcher) Match(host string) bool {
+	node := &m.root
+	labels := reverseLabels(host)
+	for i, label := range labels {
+		child, ok := node.children[label]
+		if !ok {
+			break
+		}
+		node = child
+		if i == len(labels)-1 {
+			if node.exact {
+				return true
+			}
+		} else if node.subdomains {
+			return true
+		}
+	}
+	for _, glob := range m.globs {
+		if ok, _ := path.Match(glob, host); ok {
+			return true
+		}
+	}
+	return false
+}
+
+// Strips the port and trailing dot, and lowercases the host
+func normalizeHost(host string) string {
+	if h, _, err := net.SplitHostPort(host); err == nil {
+		host = h
+	}
+	return strings.ToLower(strings.TrimSuffix(host, "."))
+}
+
+func reverseLabels(host string) []string {
+	labels := strings.Split(host, ".")
+	for i, j := 0, len(labels)-1; i < j; i, j = i+1, j-1 {
+		labels[i], labels[j] = labels[j], labels[i]
+	}
+	return labels
+}
@@ -0,0 +1,63 @@
+package api
+
+import "testing"
+
+func TestInterceptRules(t *testing.T) {
+	tests := []struct {
+		name        string
+		intercept   []string
+		passthrough []string
+		host        string
+		want        bool
+	}{
+		{"no rules", nil, nil, "example.com:443", true},
+
+		{"exact", []string{"example.com"}, nil, "example.com:443", true},
+		{"exact excludes subdomains", []string{"example.com"}, nil, "www.example.com:443", false},
+		{"exact excludes other hosts", []string{"example.com"}, nil, "example.org:443", false},
+		{"exact excludes suffixes", []string{"example.com"}, nil, "badexample.com:443", false},
+
+		{"wildcard matches subdomains", []string{"*.example.com"}, nil, "www.example.com:443", true},
+		{"wildcard matches nested subdomains", []string{"*.example.com"}, nil, "a.b.example.com:443", true},
+		{"wildcard excludes the host", []string{"*.example.com"}, nil, "example.com:443", false},
+
+		{"dot matches the host", []string{".example.com"}, nil, "example.com:443", true},
+		{"dot matches subdomains", []string{".example.com"}, nil, "www.example.com:443", true},
+		{"dot excludes suffixes", []string{".example.com"}, nil, "badexample.com:443", false},
+
+		{"host without a port", []string{"example.com"}, nil, "example.com", true},
+		{"trailing dot in the host", []string{"example.com"}, nil, "example.com.:443", true},
+		{"trailing dot in the pattern", []string{"example.com."}, nil, "example.com:443", true},
+		{"case insensitive", []string{"Example.COM"}, nil, "EXAMPLE.com:443", true},
+		{"IPv6 literal", []string{"::1"}, nil, "[::1]:443", true},
+
+		{"glob", []string{"cdn-*.example.com"}, nil, "cdn-1.example.com:443", true},
+		{"glob excludes other hosts", []string{"cdn-*.example.com"}, nil, "www.example.com:443", false},
+		{"wildcard glob matches subdomains", []string{"*.cdn-?.net"}, nil, "a.cdn-1.net:443", true},
+		{"wildcard glob excludes the host", []string{"*.cdn-?.net"}, nil, "cdn-1.net:443", false},
+		{"dot glob matches the host", []string{".cdn-?.net"}, nil, "cdn-1.net:443", true},
+
+		{"passthrough only", nil, []string{"*.googlevideo.com"}, "r1.googlevideo.com:443", false},
+		{"passthrough only, other hosts", nil, []string{"*.googlevideo.com"}, "example.com:443", true},
+		{"passthrough wins over intercept", []string{".example.com"}, []string{"static.example.com"}, "static.example.com:443", false},
+		{"intercept beside passthrough", []string{".example.com"}, []string{"static.example.com"}, "www.example.com:443", true},
+		{"passthrough glob", []string{".example.com"}, []string{"cdn-*.example.com"}, "cdn-7.example.com:443", false},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			rules, err := newInterceptRules(&ProxySetup{Intercept: tt.intercept, Passthrough: tt.passthrough})
+			if err != nil {
+				t.Fatal(err)
+			}
+			if got := rules.Intercept(tt.host); got != tt.want {
+				t.Errorf("Intercept(%q) = %v, want %v", tt.host, got, tt.want)
+			}
+		})
+	}
+}
+
+func TestInterceptRulesInvalidGlob(t *testing.T) {
+	if _, err := newInterceptRules(&ProxySetup{Passthrough: []string{"cdn-[.example.com"}}); err == nil {
+		t.Fatal("invalid glob was accepted")
+	}
+}
@@ -0,0 +1,28 @@
+package api
+
+import (
+	"math"
+	"runtime"
+	"runtime/debug"
+)
+
+/*
+Go runtime settings.
+The runtime of the shared library only reads GOMAXPROCS, GOGC and GOMEMLIMIT
+from the environment when it is loaded, so they can be changed here instead.
+*/
+
+// Applies the runtime settings in the config. Settings left at 0 are unchanged.
+func UpdateRuntime() {
+	if Config.MaxProcs > 0 {
+		runtime.GOMAXPROCS(Config.MaxProcs)
+	}
+	if Config.GCPercent != 0 {
+		debug.SetGCPercent(Config.GCPercent)
+	}
+	if Config.MemoryLimit > 0 {
+		debug.SetMemoryLimit(Config.MemoryLimit)
+	} else if Config.MemoryLimit < 0 {
+		debug.SetMemoryLimit(math.MaxInt64)
+	}
+}
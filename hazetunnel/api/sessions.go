@@ -0,0 +1,191 @@
+package api
+
+import (
+	"fmt"
+	"net/http"
+	"net/url"
+	"strings"
+	"sync/atomic"
+
+	"github.com/cristalhq/base64"
+
+	"github.com/elazarl/goproxy"
+)
+
+/*
+Per-session settings.
+A single instance serves many sessions. The session is picked from the proxy
+credentials' username or the x-mitm-session header, and individual settings
+can be overridden with x-mitm-* control headers. Control headers are stripped
+before requests are forwarded.
+*/
+
+const (
+	mitmHeaderPrefix        = "X-Mitm-"
+	sessionHeader           = "X-Mitm-Session"
+	payloadHeader           = "X-Mitm-Payload"
+	userAgentHeader         = "X-Mitm-User-Agent"
+	upstreamProxyHeader     = "X-Mitm-Upstream-Proxy"
+	proxyAuthorizationField = "Proxy-Authorization"
+)
+
+type SessionSettings struct {
+	Payload       string `json:"payload,omitempty"`
+	UserAgent     string `json:"user_agent,omitempty"`
+	UpstreamProxy string `json:"upstream_proxy,omitempty"`
+}
+
+// Settings compiled once when the session is registered
+type session struct {
+	name          string
+	payload       *preparedPayload
+	userAgent     string
+	upstreamProxy *url.URL
+}
+
+func compileSession(name string, settings SessionSettings) (*session, error) {
+	s := &session{
+		name:      name,
+		payload:   preparePayload(settings.Payload),
+		userAgent: settings.UserAgent,
+	}
+	if settings.UpstreamProxy != "" {
+		proxyUrl, err := url.Parse(settings.UpstreamProxy)
+		if err != nil {
+			return nil, fmt.Errorf("invalid upstream proxy %q: %w", settings.UpstreamProxy, err)
+		}
+		s.upstreamProxy = proxyUrl
+	}
+	return s, nil
+}
+
+type sessionTable struct {
+	// Instance-wide settings, used when no session is named
+	defaults *session
+	sessions atomic.Pointer[map[string]*session]
+}
+
+func newSessionTable(Flags *ProxySetup) (*sessionTable, error) {
+	// The instance's upstream proxies are picked per request by the upstream set
+	defaults, err := compileSession("", SessionSettings{
+		Payload:   Flags.Payload,
+		UserAgent: Flags.UserAgent,
+	})
+	if err != nil {
+		return nil, err
+	}
+	t := &sessionTable{defaults: defaults}
+	if err := t.Update(Flags.Sessions); err != nil {
+		return nil, err
+	}
+	return t, nil
+}
+
+// Update replaces the named sessions. In-flight requests keep their settings.
+func (t *sessionTable) Update(settings map[string]SessionSettings) error {
+	sessions := make(map[string]*session, len(settings))
+	for name, s := range settings {
+		compiled, err := compileSession(name, s)
+		if err != nil {
+			return fmt.Errorf("session %s: %w", name, err)
+		}
+		sessions[name] = compiled
+	}
+	t.sessions.Store(&sessions)
+	return nil
+}
+
+// Lookup returns the named session, or the defaults for an empty name
+func (t *sessionTable) Lookup(name string) (*session, bool) {
+	if name == "" {
+		return t.defaults, true
+	}
+	s, ok := (*t.sessions.Load())[name]
+	return s, ok
+}
+
+// Picks the session for a CONNECT from its proxy credentials.
+// The session name is kept in ctx.UserData for the intercepted requests.
+// Returns false and sets the rejection response for unknown sessions.
+func (t *sessionTable) Connect(ctx *goproxy.ProxyCtx) bool {
+	name := proxyAuthUsername(ctx.Req.Header)
+	if _, ok := t.Lookup(name); !ok {
+		ctx.Resp = unknownSessionResponse(ctx.Req, ctx, name)
+		return false
+	}
+	ctx.UserData = name
+	return true
+}
+
+// Resolve returns the settings for a request and strips its control headers.
+// A response is returned if the request names an unknown session or passes an
+// invalid setting.
+func (t *sessionTable) Resolve(req *http.Request, ctx *goproxy.ProxyCtx) (*session, *http.Response) {
+	// The CONNECT credentials apply to requests within the tunnel
+	name, _ := ctx.UserData.(string)
+	if name == "" {
+		name = proxyAuthUsername(req.Header)
+	}
+	if header := req.Header.Get(sessionHeader); header != "" {
+		name = header
+	}
+	s, ok := t.Lookup(name)
+	if !ok {
+		return nil, unknownSessionResponse(req, ctx, name)
+	}
+
+	// Apply per-request overrides on a copy of the session
+	if hasHeader(req.Header, payloadHeader, userAgentHeader, upstreamProxyHeader) {
+		override := *s
+		if payload := req.Header.Get(payloadHeader); payload != "" {
+			override.payload = preparePayload(payload)
+		}
+		if userAgent := req.Header.Get(userAgentHeader); userAgent != "" {
+			override.userAgent = userAgent
+		}
+		if upstreamProxy := req.Header.Get(upstreamProxyHeader); upstreamProxy != "" {
+			proxyUrl, err := url.Parse(upstreamProxy)
+			if err != nil {
+				return nil, invalidUpstreamProxyResponse(req, ctx, upstreamProxy)
+			}
+			override.upstreamProxy = proxyUrl
+		}
+		s = &override
+	}
+
+	stripControlHeaders(req.Header)
+	return s, nil
+}
+
+func hasHeader(header http.Header, keys ...string) bool {
+	for _, key := range keys {
+		if header.Get(key) != "" {
+			return true
+		}
+	}
+	return false
+}
+
+func stripControlHeaders(header http.Header) {
+	for key := range header {
+		if strings.HasPrefix(key, mitmHeaderPrefix) {
+			header.Del(key)
+		}
+	}
+	header.Del(proxyAuthorizationField)
+}
+
+// Returns the username of Basic proxy credentials, or "" if there are none
+func proxyAuthUsername(header http.Header) string {
+	auth := header.Get(proxyAuthorizationField)
+	scheme, credentials, ok := strings.Cut(auth, " ")
+	if !ok || !strings.EqualFold(scheme, "Basic") {
+		return ""
+	}
+	decoded, err := base64.StdEncoding.DecodeString(strings.TrimSpace(credentials))
+	if err != nil {
+		return ""
+	}
+	username, _, _ := strings.Cut(string(decoded), ":")
+	return username
+}
@@ -0,0 +1,272 @@
+package api
+
+import (
+	"fmt"
+	"strconv"
+	"strings"
+
+	utls "github.com/refraction-networking/utls"
+)
+
+/*
+Custom ClientHello specs.
+Profiles describe a ClientHello with a JA3 string, explicit fields, or both,
+with explicit fields taking precedence. They are parsed and validated once
+when the registry is loaded. utls mutates specs while handshaking, so each
+connection builds its own copy from the compiled profile.
+*/
+
+// Extensions with their own utls types. Other ids are sent empty.
+const (
+	extServerName           = 0
+	extStatusRequest        = 5
+	extSupportedGroups      = 10
+	extPointFormats         = 11
+	extSignatureAlgorithms  = 13
+	extALPN                 = 16
+	extSCT                  = 18
+	extPadding              = 21
+	extExtendedMasterSecret = 23
+	extCompressCertificate  = 27
+	extSessionTicket        = 35
+	extPreSharedKey         = 41
+	extSupportedVersions    = 43
+	extPSKModes             = 45
+	extKeyShare             = 51
+	extApplicationSettings  = 17513
+	extEncryptedClientHello = 65037
+	extRenegotiationInfo    = 65281
+)
+
+// JA3 strings don't carry these, so Chrome's are used
+var (
+	defaultSignatureAlgorithms = []uint16{
+		uint16(utls.ECDSAWithP256AndSHA256),
+		uint16(utls.PSSWithSHA256),
+		uint16(utls.PKCS1WithSHA256),
+		uint16(utls.ECDSAWithP384AndSHA384),
+		uint16(utls.PSSWithSHA384),
+		uint16(utls.PKCS1WithSHA384),
+		uint16(utls.PSSWithSHA512),
+		uint16(utls.PKCS1WithSHA512),
+	}
+	defaultALPN = []string{"h2", "http/1.1"}
+)
+
+type helloSpec struct {
+	// Highest TLS version offered without the supported_versions extension
+	version             uint16
+	ciphers             []uint16
+	extensions          []uint16
+	curves              []uint16
+	pointFormats        []uint8
+	signatureAlgorithms []uint16
+	alpn                []string
+	// Adds GREASE values as Chrome does
+	grease bool
+}
+
+func compileHelloSpec(setting ProfileSetting) (*helloSpec, error) {
+	spec := &helloSpec{version: utls.VersionTLS12, grease: setting.Grease}
+	if setting.JA3 != "" {
+		if err := spec.parseJA3(setting.JA3); err != nil {
+			return nil, err
+		}
+	}
+	if len(setting.CipherSuites) > 0 {
+		spec.ciphers = stripGREASE(setting.CipherSuites, &spec.grease)
+	}
+	if len(setting.Extensions) > 0 {
+		spec.extensions = stripGREASE(setting.Extensions, &spec.grease)
+	}
+	if len(setting.Curves) > 0 {
+		spec.curves = stripGREASE(setting.Curves, &spec.grease)
+	}
+	if len(setting.PointFormats) > 0 {
+		spec.pointFormats = setting.PointFormats
+	}
+	spec.signatureAlgorithms = setting.SignatureAlgorithms
+	if len(spec.signatureAlgorithms) == 0 {
+		spec.signatureAlgorithms = defaultSignatureAlgorithms
+	}
+	spec.alpn = setting.ALPN
+	if len(spec.alpn) == 0 {
+		spec.alpn = defaultALPN
+	}
+	if len(spec.pointFormats) == 0 {
+		spec.pointFormats = []uint8{utls.PointFormatUncompressed}
+	}
+
+	if len(spec.ciphers) == 0 {
+		return nil, fmt.Errorf("no cipher suites")
+	}
+	for _, id := range spec.extensions {
+		switch id {
+		case extPreSharedKey:
+			return nil, fmt.Errorf("the pre_shared_key extension isn't supported")
+		case extSupportedGroups, extKeyShare:
+			if len(spec.curves) == 0 {
+				return nil, fmt.Errorf("extension %d needs curves", id)
+			}
+		}
+	}
+	// Catch specs utls refuses before they are used
+	conn := utls.UClient(nil, &utls.Config{ServerName: "example.com"}, utls.HelloCustom)
+	if err := conn.ApplyPreset(spec.Build()); err != nil {
+		return nil, err
+	}
+	return spec, nil
+}
+
+// Parses a JA3 string: version,ciphers,extensions,curves,point formats
+func (s *helloSpec) parseJA3(ja3 string) error {
+	fields := strings.Split(ja3, ",")
+	if len(fields) != 5 {
+		return fmt.Errorf("JA3 string has %d fields instead of 5", len(fields))
+	}
+	version, err := strconv.ParseUint(fields[0], 10, 16)
+	if err != nil {
+		return fmt.Errorf("invalid JA3 version: %v", err)
+	}
+	s.version = uint16(version)
+
+	var lists [4][]uint16
+	for i, field := range fields[1:] {
+		if lists[i], err = parseJA3List(field); err != nil {
+			return err
+		}
+	}
+	s.ciphers = stripGREASE(lists[0], &s.grease)
+	s.extensions = stripGREASE(lists[1], &s.grease)
+	s.curves = stripGREASE(lists[2], &s.grease)
+	for _, format := range lists[3] {
+		if format > 0xff {
+			return fmt.Errorf("invalid JA3 point format: %d", format)
+		}
+		s.pointFormats = append(s.pointFormats, uint8(format))
+	}
+	return nil
+}
+
+func parseJA3List(field string) ([]uint16, error) {
+	if field == "" {
+		return nil, nil
+	}
+	values := strings.Split(field, "-")
+	list := make([]uint16, len(values))
+	for i, value := range values {
+		n, err := strconv.ParseUint(value, 10, 16)
+		if err != nil {
+			return nil, fmt.Errorf("invalid JA3 value: %v", err)
+		}
+		list[i] = uint16(n)
+	}
+	return list, nil
+}
+
+// GREASE values are randomized by utls, so they're dropped from lists and
+// enable GREASE instead
+func stripGREASE(values []uint16, grease *bool) []uint16 {
+	stripped := make([]uint16, 0, len(values))
+	for _, v := range values {
+		if isGREASE(v) {
+			*grease = true
+		} else {
+			stripped = append(stripped, v)
+		}
+	}
+	return stripped
+}
+
+func isGREASE(v uint16) bool {
+	return v&0x0f0f == 0x0a0a && v>>8 == v&0xff
+}
+
+// Build returns a new spec for a connection
+func (s *helloSpec) Build() *utls.ClientHelloSpec {
+	spec := &utls.ClientHelloSpec{
+		CompressionMethods: []uint8{0},
+		TLSVersMin:         utls.VersionTLS10,
+		TLSVersMax:         s.version,
+	}
+	if s.grease {
+		spec.CipherSuites = append(spec.CipherSuites, utls.GREASE_PLACEHOLDER)
+		spec.Extensions = append(spec.Extensions, &utls.UtlsGREASEExtension{})
+	}
+	spec.CipherSuites = append(spec.CipherSuites, s.ciphers...)
+
+	for i, id := range s.extensions {
+		// Chrome sends its second GREASE extension right before padding
+		if s.grease && id == extPadding && i == len(s.extensions)-1 {
+			spec.Extensions = append(spec.Extensions, &utls.UtlsGREASEExtension{})
+		}
+		if id == extSupportedVersions {
+			spec.TLSVersMax = utls.VersionTLS13
+		}
+		spec.Extensions = append(spec.Extensions, s.extension(id))
+	}
+	if s.grease && (len(s.extensions) == 0 || s.extensions[len(s.extensions)-1] != extPadding) {
+		spec.Extensions = append(spec.Extensions, &utls.UtlsGREASEExtension{})
+	}
+	return spec
+}
+
+func (s *helloSpec) extension(id uint16) utls.TLSExtension {
+	switch id {
+	case extServerName:
+		return &utls.SNIExtension{}
+	case extStatusRequest:
+		return &utls.StatusRequestExtension{}
+	case extSupportedGroups:
+		curves := make([]utls.CurveID, 0, len(s.curves)+1)
+		if s.grease {
+			curves = append(curves, utls.GREASE_PLACEHOLDER)
+		}
+		for _, curve := range s.curves {
+			curves = append(curves, utls.CurveID(curve))
+		}
+		return &utls.SupportedCurvesExtension{Curves: curves}
+	case extPointFormats:
+		return &utls.SupportedPointsExtension{SupportedPoints: s.pointFormats}
+	case extSignatureAlgorithms:
+		schemes := make([]utls.SignatureScheme, len(s.signatureAlgorithms))
+		for i, scheme := range s.signatureAlgorithms {
+			schemes[i] = utls.SignatureScheme(scheme)
+		}
+		return &utls.SignatureAlgorithmsExtension{SupportedSignatureAlgorithms: schemes}
+	case extALPN:
+		return &utls.ALPNExtension{AlpnProtocols: s.alpn}
+	case extSCT:
+		return &utls.SCTExtension{}
+	case extPadding:
+		return &utls.UtlsPaddingExtension{GetPaddingLen: utls.BoringPaddingStyle}
+	case extExtendedMasterSecret:
+		return &utls.UtlsExtendedMasterSecretExtension{}
+	case extCompressCertificate:
+		return &utls.UtlsCompressCertExtension{Algorithms: []utls.CertCompressionAlgo{utls.CertCompressionBrotli}}
+	case extSessionTicket:
+		return &utls.SessionTicketExtension{}
+	case extSupportedVersions:
+		versions := make([]uint16, 0, 3)
+		if s.grease {
+			versions = append(versions, utls.GREASE_PLACEHOLDER)
+		}
+		return &utls.SupportedVersionsExtension{Versions: append(versions, utls.VersionTLS13, utls.VersionTLS12)}
+	case extPSKModes:
+		return &utls.PSKKeyExchangeModesExtension{Modes: []uint8{utls.PskModeDHE}}
+	case extKeyShare:
+		shares := make([]utls.KeyShare, 0, 2)
+		if s.grease {
+			shares = append(shares, utls.KeyShare{Group: utls.CurveID(utls.GREASE_PLACEHOLDER), Data: []byte{0}})
+		}
+		// Only the preferred curve gets a key
+		return &utls.KeyShareExtension{KeyShares: append(shares, utls.KeyShare{Group: utls.CurveID(s.curves[0])})}
+	case extApplicationSettings:
+		return &utls.ApplicationSettingsExtension{SupportedProtocols: []string{"h2"}}
+	case extEncryptedClientHello:
+		return utls.BoringGREASEECH()
+	case extRenegotiationInfo:
+		return &utls.RenegotiationInfoExtension{Renegotiation: utls.RenegotiateOnceAsClient}
+	}
+	return &utls.GenericExtension{Id: id}
+}
@@ -0,0 +1,158 @@
+package api
+
+import (
+	"bytes"
+	"io"
+	"regexp"
+
+	"github.com/elazarl/goproxy"
+)
+
+/*
+Streaming HTML injection.
+Rewrites embedded base64 scripts while the body is being read, holding at most
+one embedded script (up to maxEmbeddedScript bytes) in memory at a time.
+*/
+
+const (
+	streamChunkSize   = 32 * 1024
+	maxEmbeddedScript = 4 * 1024 * 1024
+	// Longest possible embedded script prefix, "data:application/javascript;base64,"
+	maxScriptPrefix = 35
+)
+
+var embeddedPrefixPattern = regexp.MustCompile(`data:(?:application|text)/javascript;base64,`)
+
+type htmlInjectReader struct {
+	src     io.ReadCloser
+	payload *preparedPayload
+	cache   *injectionCache
+	ctx     *goproxy.ProxyCtx
+
+	chunk []byte
+	// Bytes read from src that have not been scanned yet
+	pending []byte
+	// Scanned bytes that are ready to be returned
+	out bytes.Buffer
+	// Set while passing through an embedded script that is too large to rewrite
+	skipping bool
+	// How far the script at the start of pending has already been scanned
+	scanned int
+	eof     bool
+	err     error
+}
+
+func newHTMLInjectReader(src io.ReadCloser, payload *preparedPayload, cache *injectionCache, ctx *goproxy.ProxyCtx) *htmlInjectReader {
+	ctx.Logf("Scanning for embedded scripts")
+	return &htmlInjectReader{src: src, payload: payload, cache: cache, ctx: ctx}
+}
+
+func (r *htmlInjectReader) Read(p []byte) (int, error) {
+	for r.out.Len() == 0 {
+		if r.eof && len(r.pending) == 0 {
+			return 0, r.err
+		}
+		if !r.eof {
+			r.fill()
+		}
+		r.scan()
+	}
+	return r.out.Read(p)
+}
+
+func (r *htmlInjectReader) Close() error {
+	return r.src.Close()
+}
+
+func (r *htmlInjectReader) fill() {
+	if r.chunk == nil {
+		r.chunk = make([]byte, streamChunkSize)
+	}
+	n, err := r.src.Read(r.chunk)
+	r.pending = append(r.pending, r.chunk[:n]...)
+	if err != nil {
+		r.eof, r.err = true, err
+	}
+}
+
+// Moves every byte of pending that can no longer be part of an unfinished
+// match into out, rewriting complete embedded scripts on the way
+func (r *htmlInjectReader) scan() {
+	for len(r.pending) > 0 {
+		if r.skipping {
+			// Pass the rest of an oversized script through untouched
+			end := scriptEnd(r.pending, 0)
+			r.emit(end)
+			if end == len(r.pending) && !r.eof {
+				return
+			}
+			r.skipping = false
+			continue
+		}
+
+		loc := embeddedPrefixPattern.FindIndex(r.pending)
+		if loc == nil {
+			// Hold back a tail that might be the start of a prefix
+			keep := 0
+			if !r.eof {
+				keep = min(len(r.pending), maxScriptPrefix-1)
+			}
+			r.emit(len(r.pending) - keep)
+			return
+		}
+		r.emit(loc[0])
+
+		prefixEnd := loc[1] - loc[0]
+		end := scriptEnd(r.pending, max(prefixEnd, r.scanned))
+		complete := end < len(r.pending) || r.eof
+		if end-prefixEnd > maxEmbeddedScript {
+			// Also when the rest of it arrived in the same read
+			r.ctx.Warnf("Embedded script exceeds %d bytes, skipping injection", maxEmbeddedScript)
+			r.emit(end)
+			r.scanned = 0
+			if !complete {
+				r.skipping = true
+				return
+			}
+			continue
+		}
+		if !complete {
+			// Wait for the rest of the script
+			r.scanned = end
+			return
+		}
+		r.scanned = 0
+		if end == prefixEnd {
+			// Not followed by a script, leave it as-is
+			r.emit(end)
+			continue
+		}
+
+		r.ctx.Logf("Match found!")
+		r.out.Write(r.pending[:prefixEnd])
+		r.out.WriteString(injectPayloadIntoBase64(string(r.pending[prefixEnd:end]), r.payload, r.cache, r.ctx))
+		r.pending = r.pending[end:]
+	}
+}
+
+// Moves the first n pending bytes to out
+func (r *htmlInjectReader) emit(n int) {
+	r.out.Write(r.pending[:n])
+	r.pending = r.pending[n:]
+}
+
+// Returns the index after the base64 run in buf starting at start
+func scriptEnd(buf []byte, start int) int {
+	for i := start; i < len(buf); i++ {
+		if !isBase64Char(buf[i]) {
+			return i
+		}
+	}
+	return len(buf)
+}
+
+// Matches the [\w+/=] character class
+func isBase64Char(c byte) bool {
+	return c >= 'a' && c <= 'z' || c >= 'A' && c <= 'Z' || c >= '0' && c <= '9' ||
+		c == '_' || c == '+' || c == '/' || c == '='
+}
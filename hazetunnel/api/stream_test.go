@@ -0,0 +1,87 @@
+package api
+
+import (
+	"io"
+	"math/rand"
+	"strings"
+	"testing"
+	"testing/iotest"
+
+	"github.com/cristalhq/base64"
+)
+
+// Returns reads of random sizes up to max bytes
+type randomChunkReader struct {
+	r   io.Reader
+	rng *rand.Rand
+	max int
+}
+
+func (r *randomChunkReader) Read(p []byte) (int, error) {
+	n := 1 + r.rng.Intn(r.max)
+	if n < len(p) {
+		p = p[:n]
+	}
+	return r.r.Read(p)
+}
+
+func streamHTML(t *testing.T, src io.Reader, payload *preparedPayload) string {
+	t.Helper()
+	reader := newHTMLInjectReader(io.NopCloser(src), payload, nil, benchCtx())
+	out, err := io.ReadAll(reader)
+	if err != nil {
+		t.Fatal(err)
+	}
+	return string(out)
+}
+
+func TestHTMLInjectReader(t *testing.T) {
+	script := base64.StdEncoding.EncodeToString([]byte(`console.log("Original JavaScript executed.");`))
+	tests := []struct {
+		name string
+		html string
+	}{
+		{"empty", ""},
+		{"no scripts", "<html><body><p>Hello</p></body></html>"},
+		{"script", `<script src="data:application/javascript;base64,` + script + `"></script>`},
+		{"text/javascript", `<script src="data:text/javascript;base64,` + script + `"></script>`},
+		{"script at the end", `<script src="data:application/javascript;base64,` + script},
+		{"adjacent scripts", `"data:text/javascript;base64,` + script + `""data:application/javascript;base64,` + script + `"`},
+		{"prefix without a script", `<a href="data:application/javascript;base64,">x</a>`},
+		{"prefix at the end", `<p>x</p>data:application/javascript;base64,`},
+		{"partial prefix at the end", `<p>x</p>data:application/java`},
+		{"invalid base64", `"data:application/javascript;base64,abc"`},
+		{"page", benchHTML(64 * 1024)},
+	}
+	payload := preparePayload(benchPayload)
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			want := injectPayloadIntoHTML(tt.html, payload, nil, benchCtx())
+			if got := streamHTML(t, iotest.OneByteReader(strings.NewReader(tt.html)), payload); got != want {
+				t.Errorf("one byte reads:\ngot  %q\nwant %q", got, want)
+			}
+			for seed := int64(0); seed < 16; seed++ {
+				src := &randomChunkReader{r: strings.NewReader(tt.html), rng: rand.New(rand.NewSource(seed)), max: 64}
+				if got := streamHTML(t, src, payload); got != want {
+					t.Fatalf("random reads (seed %d):\ngot  %q\nwant %q", seed, got, want)
+				}
+			}
+		})
+	}
+}
+
+// Scripts over maxEmbeddedScript are passed through, and later ones still rewritten
+func TestHTMLInjectReaderSkipsOversizedScripts(t *testing.T) {
+	payload := preparePayload(benchPayload)
+	script := base64.StdEncoding.EncodeToString([]byte(`console.log("Original JavaScript executed.");`))
+	oversized := `<script src="data:application/javascript;base64,` + strings.Repeat("QUFB", maxEmbeddedScript/4+1024) + `"></script>`
+	tail := `<script src="data:text/javascript;base64,` + script + `"></script>`
+	want := oversized + injectPayloadIntoHTML(tail, payload, nil, benchCtx())
+
+	for seed := int64(0); seed < 4; seed++ {
+		src := &randomChunkReader{r: strings.NewReader(oversized + tail), rng: rand.New(rand.NewSource(seed)), max: 2 * streamChunkSize}
+		if got := streamHTML(t, src, payload); got != want {
+			t.Fatalf("seed %d: oversized script wasn't passed through unchanged", seed)
+		}
+	}
+}
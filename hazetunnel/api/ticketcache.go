@@ -0,0 +1,42 @@
+package api
+
+import (
+	"strings"
+
+	utls "github.com/refraction-networking/utls"
+)
+
+/*
+Upstream TLS session cache.
+Session tickets are kept in a process-wide LRU keyed by fingerprint, upstream
+proxy, session and server name, so a ticket is only ever offered by the same
+ClientHello that received it, and resumption can't link requests made through
+different proxies or sessions. Whether a ticket or PSK is actually sent is still decided by the
+fingerprint's spec, which keeps resumption faithful to the emulated browser.
+*/
+
+const ticketCacheSize = 4096
+
+var tlsSessions = newLRUCache[string, *utls.ClientSessionState](ticketCacheSize, nil, nil)
+
+// View of the shared session cache for a single pool entry
+type ticketCache struct {
+	prefix string
+}
+
+func newTicketCache(key upstreamKey) *ticketCache {
+	return &ticketCache{prefix: strings.Join([]string{key.client, key.version, key.upstream, key.session, ""}, "|")}
+}
+
+func (c *ticketCache) Get(sessionKey string) (*utls.ClientSessionState, bool) {
+	return tlsSessions.Get(c.prefix + sessionKey)
+}
+
+// Put stores a session, or forgets it when cs is nil
+func (c *ticketCache) Put(sessionKey string, cs *utls.ClientSessionState) {
+	if cs == nil {
+		tlsSessions.Remove(c.prefix + sessionKey)
+		return
+	}
+	tlsSessions.Add(c.prefix+sessionKey, cs)
+}
@@ -0,0 +1,379 @@
+package api
+
+import (
+	"bufio"
+	"context"
+	"crypto/tls"
+	"encoding/base64"
+	"errors"
+	"fmt"
+	"net"
+	"net/http"
+	"net/url"
+	"sync"
+	"time"
+
+	utls "github.com/refraction-networking/utls"
+	"golang.org/x/net/http2"
+	"golang.org/x/net/proxy"
+)
+
+/*
+uTLS round tripper.
+Keeps one HTTP/1.1 and one HTTP/2 transport per fingerprint so that
+connections are kept alive and multiplexed instead of redialed per request.
+*/
+
+// Probe connections that aren't claimed by then may have been closed by the origin
+const pendingConnTTL = 5 * time.Second
+
+type utlsTransport struct {
+	helloID  utls.ClientHelloID
+	config   *utls.Config
+	upstream *url.URL
+	metrics  *Metrics
+	conns    *connTracker
+
+	h1 *http.Transport
+	h2 *http2.Transport
+
+	mu sync.Mutex
+	// Negotiated ALPN protocol per address
+	protos map[string]string
+	// ALPN probes in flight, shared by concurrent first requests to an address
+	probes map[string]*alpnProbe
+	// Connections that were handshaked while probing ALPN, waiting to be claimed
+	pending map[string][]pendingConn
+}
+
+type alpnProbe struct {
+	done  chan struct{}
+	proto string
+	err   error
+}
+
+type pendingConn struct {
+	conn   net.Conn
+	parked time.Time
+}
+
+func newUTLSTransport(helloID utls.ClientHelloID, config *utls.Config, upstream *url.URL, opts *poolOptions, metrics *Metrics, conns *connTracker) *utlsTransport {
+	t := &utlsTransport{
+		helloID:  helloID,
+		config:   config,
+		upstream: upstream,
+		metrics:  metrics,
+		conns:    conns,
+		protos:   make(map[string]string),
+		probes:   make(map[string]*alpnProbe),
+		pending:  make(map[string][]pendingConn),
+	}
+	t.h1 = &http.Transport{
+		DialTLSContext: func(ctx context.Context, network, addr string) (net.Conn, error) {
+			return t.claimOrDial(ctx, addr)
+		},
+		// Disable the standard library's HTTP/2, t.h2 handles it
+		TLSNextProto:        make(map[string]func(string, *tls.Conn) http.RoundTripper),
+		MaxIdleConnsPerHost: opts.maxIdlePerHost,
+		MaxConnsPerHost:     opts.maxConnsPerHost,
+		IdleConnTimeout:     opts.idleTimeout,
+	}
+	t.h2 = &http2.Transport{
+		DialTLSContext: func(ctx context.Context, network, addr string, _ *tls.Config) (net.Conn, error) {
+			return t.claimOrDial(ctx, addr)
+		},
+		IdleConnTimeout: opts.idleTimeout,
+		// Queue streams on the open connection instead of dialing another once
+		// the server's stream limit is reached
+		StrictMaxConcurrentStreams: opts.maxConnsPerHost > 0,
+	}
+	return t
+}
+
+func (t *utlsTransport) RoundTrip(req *http.Request) (*http.Response, error) {
+	addr := canonicalAddr(req.URL)
+	proto, err := t.negotiatedProto(req.Context(), addr)
+	if err != nil {
+		return nil, err
+	}
+	if proto == http2.NextProtoTLS {
+		return t.h2.RoundTrip(req)
+	}
+	return t.h1.RoundTrip(req)
+}
+
+func (t *utlsTransport) CloseIdleConnections() {
+	t.h1.CloseIdleConnections()
+	t.h2.CloseIdleConnections()
+
+	t.mu.Lock()
+	pending := t.pending
+	t.pending = make(map[string][]pendingConn)
+	t.mu.Unlock()
+	for _, conns := range pending {
+		for _, pc := range conns {
+			pc.conn.Close()
+		}
+	}
+}
+
+func (t *utlsTransport) negotiatedProto(ctx context.Context, addr string) (string, error) {
+	for {
+		t.mu.Lock()
+		if proto, ok := t.protos[addr]; ok {
+			t.mu.Unlock()
+			return proto, nil
+		}
+		probe, probing := t.probes[addr]
+		if !probing {
+			probe = &alpnProbe{done: make(chan struct{})}
+			t.probes[addr] = probe
+		}
+		t.mu.Unlock()
+
+		if !probing {
+			return t.probe(ctx, addr, probe)
+		}
+		// Wait for the request that is already probing this address
+		select {
+		case <-probe.done:
+		case <-ctx.Done():
+			return "", ctx.Err()
+		}
+		// Probe again if it only failed because its own request went away
+		if probe.err == nil || !errors.Is(probe.err, context.Canceled) && !errors.Is(probe.err, context.DeadlineExceeded) {
+			return probe.proto, probe.err
+		}
+	}
+}
+
+// First connection to this address: handshake once to learn the ALPN result,
+// then hand the connection over to the matching transport
+func (t *utlsTransport) probe(ctx context.Context, addr string, probe *alpnProbe) (string, error) {
+	conn, err := t.dialTLS(ctx, addr, nil)
+
+	t.mu.Lock()
+	delete(t.probes, addr)
+	if err == nil {
+		probe.proto = conn.ConnectionState().NegotiatedProtocol
+		t.protos[addr] = probe.proto
+		t.pending[addr] = append(t.pending[addr], pendingConn{conn: conn, parked: time.Now()})
+	}
+	probe.err = err
+	t.mu.Unlock()
+	close(probe.done)
+	return probe.proto, err
+}
+
+func (t *utlsTransport) claimOrDial(ctx context.Context, addr string) (net.Conn, error) {
+	var claimed net.Conn
+	var expired []pendingConn
+	t.mu.Lock()
+	fresh := t.pending[addr][:0]
+	for _, pc := range t.pending[addr] {
+		if time.Since(pc.parked) < pendingConnTTL {
+			fresh = append(fresh, pc)
+		} else {
+			expired = append(expired, pc)
+		}
+	}
+	if len(fresh) > 0 {
+		claimed = fresh[len(fresh)-1].conn
+		fresh = fresh[:len(fresh)-1]
+	}
+	if len(fresh) > 0 {
+		t.pending[addr] = fresh
+	} else {
+		delete(t.pending, addr)
+	}
+	t.mu.Unlock()
+
+	for _, pc := range expired {
+		pc.conn.Close()
+	}
+	if claimed != nil {
+		return claimed, nil
+	}
+	return t.dialTLS(ctx, addr, nil)
+}
+
+// DialHTTP1 opens a connection with the transport's fingerprint that only
+// offers HTTP/1.1 over ALPN, as browsers do for WebSockets
+func (t *utlsTransport) DialHTTP1(ctx context.Context, addr string) (net.Conn, error) {
+	conn, err := t.dialTLS(ctx, addr, []string{"http/1.1"})
+	if err != nil {
+		return nil, err
+	}
+	if proto := conn.ConnectionState().NegotiatedProtocol; proto != "" && proto != "http/1.1" {
+		conn.Close()
+		return nil, fmt.Errorf("%s negotiated %s instead of http/1.1", addr, proto)
+	}
+	return conn, nil
+}
+
+// Handshakes with addr. A non-nil alpn replaces the protocols offered by the
+// fingerprint, keeping the rest of its ClientHello.
+func (t *utlsTransport) dialTLS(ctx context.Context, addr string, alpn []string) (*utls.UConn, error) {
+	rawConn, err := dialUpstream(ctx, t.upstream, addr)
+	if err != nil {
+		return nil, err
+	}
+	rawConn = t.conns.Track(rawConn, connUpstream)
+	host, _, err := net.SplitHostPort(addr)
+	if err != nil {
+		rawConn.Close()
+		return nil, err
+	}
+
+	config := t.config.Clone()
+	config.ServerName = host
+	conn, err := t.client(rawConn, config, alpn)
+	if err != nil {
+		rawConn.Close()
+		return nil, err
+	}
+	start := time.Now()
+	if err := conn.HandshakeContext(ctx); err != nil {
+		rawConn.Close()
+		t.metrics.Error(errHandshake)
+		return nil, err
+	}
+	t.metrics.handshake.Observe(time.Since(start))
+	if conn.ConnectionState().DidResume {
+		t.metrics.resumptions.Add(1)
+	}
+	return conn, nil
+}
+
+func (t *utlsTransport) client(rawConn net.Conn, config *utls.Config, alpn []string) (*utls.UConn, error) {
+	spec, err := customHelloSpec(t.helloID)
+	if err != nil {
+		return nil, err
+	}
+	if spec == nil {
+		if alpn == nil {
+			return utls.UClient(rawConn, config, t.helloID), nil
+		}
+		builtin, err := utls.UTLSIdToSpec(t.helloID)
+		if err != nil {
+			return nil, err
+		}
+		spec = &builtin
+	}
+	if alpn != nil {
+		for _, ext := range spec.Extensions {
+			if ext, ok := ext.(*utls.ALPNExtension); ok {
+				ext.AlpnProtocols = alpn
+			}
+		}
+		config.NextProtos = alpn
+	}
+	conn := utls.UClient(rawConn, config, utls.HelloCustom)
+	if err := conn.ApplyPreset(spec); err != nil {
+		return nil, err
+	}
+	return conn, nil
+}
+
+/*
+Upstream dialing
+*/
+
+// Opens a TCP connection to addr, optionally through an upstream proxy
+func dialUpstream(ctx context.Context, upstream *url.URL, addr string) (net.Conn, error) {
+	if upstream == nil {
+		return dialDirect(ctx, "tcp", addr)
+	}
+	switch upstream.Scheme {
+	case "http", "https":
+		return dialConnectProxy(ctx, upstream, addr)
+	case "socks5", "socks5h":
+		dialer, err := proxy.FromURL(upstream, getUpstreamDialer())
+		if err != nil {
+			return nil, err
+		}
+		if ctxDialer, ok := dialer.(proxy.ContextDialer); ok {
+			return ctxDialer.DialContext(ctx, "tcp", addr)
+		}
+		return dialer.Dial("tcp", addr)
+	}
+	return nil, fmt.Errorf("unsupported upstream proxy scheme: %s", upstream.Scheme)
+}
+
+// Opens a tunnel to addr through an HTTP(S) proxy with the CONNECT method
+func dialConnectProxy(ctx context.Context, upstream *url.URL, addr string) (net.Conn, error) {
+	conn, err := dialDirect(ctx, "tcp", canonicalAddr(upstream))
+	if err != nil {
+		return nil, err
+	}
+	if deadline, ok := ctx.Deadline(); ok {
+		conn.SetDeadline(deadline)
+		defer conn.SetDeadline(time.Time{})
+	}
+	if upstream.Scheme == "https" {
+		tlsConn := tls.Client(conn, &tls.Config{ServerName: upstream.Hostname()})
+		if err := tlsConn.HandshakeContext(ctx); err != nil {
+			conn.Close()
+			return nil, err
+		}
+		conn = tlsConn
+	}
+
+	req := &http.Request{
+		Method: http.MethodConnect,
+		URL:    &url.URL{Opaque: addr},
+		Host:   addr,
+		Header: make(http.Header),
+	}
+	if upstream.User != nil {
+		password, _ := upstream.User.Password()
+		credentials := upstream.User.Username() + ":" + password
+		req.Header.Set("Proxy-Authorization", "Basic "+base64.StdEncoding.EncodeToString([]byte(credentials)))
+	}
+	if err := req.Write(conn); err != nil {
+		conn.Close()
+		return nil, err
+	}
+
+	reader := bufio.NewReader(conn)
+	resp, err := http.ReadResponse(reader, req)
+	if err != nil {
+		conn.Close()
+		return nil, err
+	}
+	resp.Body.Close()
+	if resp.StatusCode != http.StatusOK {
+		conn.Close()
+		return nil, fmt.Errorf("upstream proxy refused CONNECT to %s: %s", addr, resp.Status)
+	}
+	if reader.Buffered() > 0 {
+		return &bufferedConn{Conn: conn, reader: reader}, nil
+	}
+	return conn, nil
+}
+
+// net.Conn that drains bytes read ahead by a bufio.Reader first
+type bufferedConn struct {
+	net.Conn
+	reader *bufio.Reader
+}
+
+func (c *bufferedConn) Read(p []byte) (int, error) {
+	return c.reader.Read(p)
+}
+
+// Returns host:port, filling in the default port for the scheme
+func canonicalAddr(u *url.URL) string {
+	port := u.Port()
+	if port == "" {
+		switch u.Scheme {
+		case "http":
+			port = "80"
+		case "socks5", "socks5h":
+			port = "1080"
+		default:
+			port = "443"
+		}
+	}
+	return net.JoinHostPort(u.Hostname(), port)
+}
@@ -0,0 +1,76 @@
+package api
+
+import (
+	"io"
+	"net"
+	"net/http"
+	"net/url"
+	"sync"
+
+	"github.com/elazarl/goproxy"
+)
+
+/*
+Direct tunnels for CONNECTs that aren't intercepted.
+Bytes are relayed without being decrypted. Between two TCP connections,
+io.Copy uses splice(2) on Linux, so the payload never enters user space.
+*/
+
+// Tunnels the CONNECT to its origin, through the session's upstream proxy if one is set
+func tunnelConnect(upstream *url.URL, conns *connTracker) *goproxy.ConnectAction {
+	return &goproxy.ConnectAction{
+		Action: goproxy.ConnectHijack,
+		Hijack: func(req *http.Request, client net.Conn, ctx *goproxy.ProxyCtx) {
+			defer client.Close()
+			target, err := dialUpstream(req.Context(), upstream, req.URL.Host)
+			if err != nil {
+				ctx.Warnf("Error dialing to %s: %s", req.URL.Host, err)
+				io.WriteString(client, "HTTP/1.0 502 Bad Gateway\r\n\r\n")
+				return
+			}
+			target = conns.Track(target, connUpstream)
+			defer target.Close()
+			if _, err := io.WriteString(client, "HTTP/1.0 200 OK\r\n\r\n"); err != nil {
+				return
+			}
+			ctx.Logf("Tunneling %s without interception", req.URL.Host)
+			relay(client, target)
+		},
+	}
+}
+
+// Copies between a and b until both directions are finished
+func relay(a, b net.Conn) {
+	done := make(chan struct{})
+	go func() {
+		copyBuffer(unwrapConn(b), unwrapConn(a))
+		closeWrite(b)
+		close(done)
+	}()
+	copyBuffer(unwrapConn(a), unwrapConn(b))
+	closeWrite(a)
+	<-done
+}
+
+var copyBuffers = sync.Pool{
+	New: func() any {
+		buf := make([]byte, 32*1024)
+		return &buf
+	},
+}
+
+// io.Copy with a pooled buffer, for connections that can't be spliced
+func copyBuffer(dst io.Writer, src io.Reader) (int64, error) {
+	buf := copyBuffers.Get().(*[]byte)
+	defer copyBuffers.Put(buf)
+	return io.CopyBuffer(dst, src, *buf)
+}
+
+// Half-closes conn so the peer sees EOF, closing it fully if that isn't supported
+func closeWrite(conn net.Conn) {
+	if c, ok := conn.(interface{ CloseWrite() error }); ok {
+		c.CloseWrite()
+		return
+	}
+	conn.Close()
+}
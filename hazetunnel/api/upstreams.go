@@ -0,0 +1,241 @@
+package api
+
+import (
+	"context"
+	"fmt"
+	"hash/fnv"
+	"io"
+	"log"
+	"net"
+	"net/http"
+	"net/url"
+	"sync/atomic"
+	"time"
+)
+
+/*
+Upstream proxy set.
+Upstream proxies are parsed once when the instance starts, and requests are
+spread across them by a policy. Optional health checks eject proxies that fail
+to reach a target, and bring them back once they recover.
+*/
+
+const (
+	policyRoundRobin    = "round_robin"
+	policyLeastLatency  = "least_latency"
+	policyStickyHost    = "sticky_host"
+	policyStickySession = "sticky_session"
+
+	defaultHealthCheckInterval = 30 * time.Second
+	healthCheckTimeout         = 10 * time.Second
+	// Consecutive failed checks before a proxy is ejected
+	ejectAfterFailures = 2
+)
+
+type upstreamProxy struct {
+	url     *url.URL
+	healthy atomic.Bool
+	// Consecutive failed health checks
+	failures atomic.Int32
+	// Moving average of the health check latency in nanoseconds, 0 until measured
+	latency atomic.Int64
+}
+
+type UpstreamStats struct {
+	Url     string  `json:"url"`
+	Healthy bool    `json:"healthy"`
+	Latency float64 `json:"latency"`
+}
+
+type upstreamSet struct {
+	proxies  []*upstreamProxy
+	policy   string
+	next     atomic.Uint64
+	checkUrl string
+	interval time.Duration
+	done     chan struct{}
+}
+
+// Parses the instance's upstream proxies. Returns nil if there are none.
+func newUpstreamSet(Flags *ProxySetup) (*upstreamSet, error) {
+	var raw []string
+	if Flags.UpstreamProxy != "" {
+		raw = append(raw, Flags.UpstreamProxy)
+	}
+	raw = append(raw, Flags.UpstreamProxies...)
+	if len(raw) == 0 {
+		return nil, nil
+	}
+
+	s := &upstreamSet{
+		policy:   Flags.UpstreamPolicy,
+		checkUrl: Flags.HealthCheckUrl,
+		interval: defaultHealthCheckInterval,
+		done:     make(chan struct{}),
+	}
+	switch s.policy {
+	case "":
+		s.policy = policyRoundRobin
+	case policyRoundRobin, policyLeastLatency, policyStickyHost, policyStickySession:
+	default:
+		return nil, fmt.Errorf("unknown upstream policy: %s", s.policy)
+	}
+	if s.policy == policyLeastLatency && s.checkUrl == "" {
+		// Latency is only measured by the health checks
+		return nil, fmt.Errorf("the %s upstream policy requires a health check URL", policyLeastLatency)
+	}
+	if Flags.HealthCheckInterval > 0 {
+		s.interval = time.Duration(Flags.HealthCheckInterval) * time.Second
+	}
+	for _, u := range raw {
+		proxyUrl, err := url.Parse(u)
+		if err != nil {
+			return nil, fmt.Errorf("invalid upstream proxy %q: %w", u, err)
+		}
+		proxy := &upstreamProxy{url: proxyUrl}
+		proxy.healthy.Store(true)
+		s.proxies = append(s.proxies, proxy)
+	}
+
+	if s.checkUrl != "" {
+		go s.healthCheck()
+	}
+	return s, nil
+}
+
+// Returns the upstream proxy for a request: the session's own if it has one,
+// otherwise one picked from the set. Returns nil to connect directly.
+func (s *upstreamSet) For(session *session, host string) *url.URL {
+	if session.upstreamProxy != nil {
+		return session.upstreamProxy
+	}
+	if s == nil {
+		return nil
+	}
+	return s.Pick(host, session.name)
+}
+
+// Pick selects a proxy by the set's policy, ignoring ejected proxies.
+// If every proxy is ejected, all of them are considered.
+func (s *upstreamSet) Pick(host string, session string) *url.URL {
+	candidates := make([]*upstreamProxy, 0, len(s.proxies))
+	for _, proxy := range s.proxies {
+		if proxy.healthy.Load() {
+			candidates = append(candidates, proxy)
+		}
+	}
+	if len(candidates) == 0 {
+		candidates = s.proxies
+	}
+	if len(candidates) == 1 {
+		return candidates[0].url
+	}
+
+	switch s.policy {
+	case policyLeastLatency:
+		// Proxies that haven't been measured yet aren't assumed to be fastest
+		var best *upstreamProxy
+		for _, proxy := range candidates {
+			if latency := proxy.latency.Load(); latency > 0 && (best == nil || latency < best.latency.Load()) {
+				best = proxy
+			}
+		}
+		if best != nil {
+			return best.url
+		}
+	case policyStickyHost:
+		return rendezvous(candidates, normalizeHost(host)).url
+	case policyStickySession:
+		if session != "" {
+			return rendezvous(candidates, session).url
+		}
+	}
+	// Round robin, also until least_latency has measured a proxy
+	return candidates[s.next.Add(1)%uint64(len(candidates))].url
+}
+
+// Highest random weight hashing. Ejecting a proxy only moves the keys it held.
+func rendezvous(candidates []*upstreamProxy, key string) *upstreamProxy {
+	var (
+		best      *upstreamProxy
+		bestScore uint64
+	)
+	for _, proxy := range candidates {
+		h := fnv.New64a()
+		io.WriteString(h, proxy.url.String())
+		h.Write([]byte{0})
+		io.WriteString(h, key)
+		if score := h.Sum64(); best == nil || score > bestScore {
+			best, bestScore = proxy, score
+		}
+	}
+	return best
+}
+
+func (s *upstreamSet) Stats() []UpstreamStats {
+	if s == nil {
+		return nil
+	}
+	stats := make([]UpstreamStats, len(s.proxies))
+	for i, proxy := range s.proxies {
+		stats[i] = UpstreamStats{
+			Url:     proxy.url.Redacted(),
+			Healthy: proxy.healthy.Load(),
+			Latency: time.Duration(proxy.latency.Load()).Seconds(),
+		}
+	}
+	return stats
+}
+
+// Stops the health checks
+func (s *upstreamSet) Close() {
+	if s != nil {
+		close(s.done)
+	}
+}
+
+func (s *upstreamSet) healthCheck() {
+	ticker := time.NewTicker(s.interval)
+	defer ticker.Stop()
+	for {
+		for _, proxy := range s.proxies {
+			go s.check(proxy)
+		}
+		select {
+		case <-s.done:
+			return
+		case <-ticker.C:
+		}
+	}
+}
+
+func (s *upstreamSet) check(proxy *upstreamProxy) {
+	transport := &http.Transport{
+		DialContext: func(ctx context.Context, _, addr string) (net.Conn, error) {
+			return dialUpstream(ctx, proxy.url, addr)
+		},
+		DisableKeepAlives: true,
+	}
+	defer transport.CloseIdleConnections()
+	client := &http.Client{Transport: transport, Timeout: healthCheckTimeout}
+
+	start := time.Now()
+	resp, err := client.Get(s.checkUrl)
+	if err != nil {
+		if proxy.failures.Add(1) >= ejectAfterFailures && proxy.healthy.Swap(false) && Config.Verbose {
+			log.Printf("Ejecting upstream proxy %s: %v", proxy.url.Redacted(), err)
+		}
+		return
+	}
+	resp.Body.Close()
+
+	elapsed := int64(time.Since(start))
+	if previous := proxy.latency.Load(); previous != 0 {
+		elapsed = (previous*3 + elapsed) / 4
+	}
+	proxy.latency.Store(elapsed)
+	proxy.failures.Store(0)
+	if !proxy.healthy.Swap(true) && Config.Verbose {
+		log.Printf("Upstream proxy %s recovered", proxy.url.Redacted())
+	}
+}
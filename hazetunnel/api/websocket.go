@@ -0,0 +1,150 @@
+package api
+
+import (
+	"bufio"
+	"fmt"
+	"net"
+	"net/http"
+	"time"
+
+	"github.com/elazarl/goproxy"
+)
+
+/*
+WebSocket relay for intercepted connections.
+Upgrades are resolved against their session like any other request, so the
+origin sees the same User-Agent and uTLS fingerprint, through the same
+upstream proxy. The handshake goes over a fresh connection that only offers
+http/1.1, as browsers do for WebSockets. Once the origin switches protocols,
+frames are copied in both directions without being parsed.
+*/
+
+type websocketRelay struct {
+	// Used for the request context passed to the session lookup
+	proxy     *goproxy.ProxyHttpServer
+	sessions  *sessionTable
+	upstreams *upstreamSet
+	pool      *UpstreamPool
+	metrics   *Metrics
+}
+
+func (ws *websocketRelay) ServeHTTP(w http.ResponseWriter, r *http.Request) {
+	ws.metrics.requests.Add(1)
+	record := accessRecordFrom(r.Context())
+	ctx := &goproxy.ProxyCtx{Req: r, Proxy: ws.proxy}
+	session, clientHelloId, resp := resolveRequest(r, ctx, ws.sessions, ws.metrics)
+	if resp != nil {
+		writeResponse(w, resp)
+		return
+	}
+
+	// HTTP/2 connections can't be hijacked. Clients open an HTTP/1.1 one for
+	// WebSockets since extended CONNECT isn't advertised.
+	if r.ProtoMajor != 1 {
+		http.Error(w, "WebSocket upgrades require HTTP/1.1", http.StatusHTTPVersionNotSupported)
+		return
+	}
+
+	addr := canonicalAddr(r.URL)
+	transport := ws.pool.Get(addr, clientHelloId, ws.upstreams.For(session, r.URL.Host), session.name)
+	start := time.Now()
+	target, err := transport.DialHTTP1(r.Context(), addr)
+	if err != nil {
+		ws.fail(w, record, err)
+		return
+	}
+	defer target.Close()
+
+	if err := r.Write(target); err != nil {
+		ws.fail(w, record, err)
+		return
+	}
+	reader := bufio.NewReader(target)
+	resp, err = http.ReadResponse(reader, r)
+	if err != nil {
+		ws.fail(w, record, err)
+		return
+	}
+	ws.metrics.firstByte.Observe(time.Since(start))
+	if record != nil {
+		record.FirstByte = time.Since(start).Seconds()
+	}
+	if resp.StatusCode != http.StatusSwitchingProtocols {
+		// Refused by the origin, which explains why in its response
+		resp.Header.Del("Connection")
+		resp.Header.Del("Keep-Alive")
+		writeResponse(w, resp)
+		return
+	}
+
+	// Unwraps the access log's writer
+	client, buffered, err := http.NewResponseController(w).Hijack()
+	if err != nil {
+		ws.fail(w, record, err)
+		return
+	}
+	defer client.Close()
+	// The server's timeouts no longer apply
+	client.SetDeadline(time.Time{})
+	fmt.Fprintf(buffered, "HTTP/1.1 %s\r\n", resp.Status)
+	resp.Header.Write(buffered)
+	buffered.WriteString("\r\n")
+	if err := buffered.Flush(); err != nil {
+		return
+	}
+	if record != nil {
+		record.Status = http.StatusSwitchingProtocols
+	}
+
+	// Bytes read ahead on either side are relayed first
+	if reader.Buffered() > 0 {
+		target = &bufferedConn{Conn: target, reader: reader}
+	}
+	var clientConn net.Conn = client
+	if buffered.Reader.Buffered() > 0 {
+		clientConn = &bufferedConn{Conn: client, reader: buffered.Reader}
+	}
+	ws.metrics.websockets.Add(1)
+	defer ws.metrics.websockets.Add(-1)
+	ws.relay(clientConn, target, record)
+}
+
+// Copies frames until the origin closes, then closes the client
+func (ws *websocketRelay) relay(client, target net.Conn, record *accessEntry) {
+	done := make(chan struct{})
+	go func() {
+		copyBuffer(target, client)
+		target.Close()
+		close(done)
+	}()
+
+	received := &countingReader{ReadCloser: target, counter: &ws.metrics.bytesIn}
+	if record != nil {
+		received = &countingReader{ReadCloser: received, counter: &record.bytesIn}
+	}
+	n, _ := copyBuffer(client, received)
+	ws.metrics.bytesOut.Add(uint64(n))
+	if record != nil {
+		record.BytesOut += uint64(n)
+	}
+	client.Close()
+	<-done
+}
+
+func (ws *websocketRelay) fail(w http.ResponseWriter, record *accessEntry, err error) {
+	ws.metrics.Error(errUpstream)
+	if record != nil {
+		record.Error = err.Error()
+	}
+	http.Error(w, err.Error(), http.StatusBadGateway)
+}
+
+// Writes a response built for goproxy or read from the origin to the client
+func writeResponse(w http.ResponseWriter, resp *http.Response) {
+	defer resp.Body.Close()
+	for name, values := range resp.Header {
+		w.Header()[name] = values
+	}
+	w.WriteHeader(resp.StatusCode)
+	copyBuffer(w, resp.Body)
+}
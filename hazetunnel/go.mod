@@ -3,29 +3,28 @@ module github.com/daijro/hazetunnel/hazetunnel
 go 1.21.5
 
 require (
+	github.com/andybalholm/brotli v1.1.0
 	github.com/cloudflare/cfssl v1.6.5
 	github.com/cristalhq/base64 v0.1.2
 	github.com/elazarl/goproxy v0.0.0-20231117061959-7cc037d33fb5
 	github.com/goccy/go-json v0.10.3
+	github.com/klauspost/compress v1.17.8
 	github.com/mileusna/useragent v1.3.4
 	github.com/refraction-networking/utls v1.6.6
-	gitlab.torproject.org/tpo/anti-censorship/pluggable-transports/snowflake/v2 v2.9.2
+	golang.org/x/net v0.25.0
+	golang.org/x/sys v0.20.0
 )
 
 require (
-	github.com/andybalholm/brotli v1.1.0 // indirect
 	github.com/cloudflare/circl v1.3.8 // indirect
 	github.com/go-logr/logr v1.4.2 // indirect
 	github.com/google/certificate-transparency-go v1.2.1 // indirect
 	github.com/jmoiron/sqlx v1.4.0 // indirect
-	github.com/klauspost/compress v1.17.8 // indirect
 	github.com/pelletier/go-toml v1.9.5 // indirect
 	github.com/weppos/publicsuffix-go v0.30.2 // indirect
 	github.com/zmap/zcrypto v0.0.0-20240512203510-0fef58d9a9db // indirect
 	github.com/zmap/zlint/v3 v3.6.2 // indirect
 	golang.org/x/crypto v0.23.0 // indirect
-	golang.org/x/net v0.25.0 // indirect
-	golang.org/x/sys v0.20.0 // indirect
 	golang.org/x/text v0.15.0 // indirect
 	google.golang.org/protobuf v1.34.1 // indirect
 	k8s.io/klog/v2 v2.120.1 // indirect
@@ -2,6 +2,8 @@ package main
 
 import (
 	"flag"
+	"log"
+	"strings"
 
 	"github.com/daijro/hazetunnel/hazetunnel/api"
 )
@@ -15,15 +17,74 @@ func main() {
 	var Flags api.ProxySetup
 	flag.StringVar(&Flags.Addr, "addr", "", "Proxy listen address")
 	flag.StringVar(&Flags.Port, "port", "8080", "Proxy listen port")
+	flag.IntVar(&Flags.Listeners, "listeners", 1, "Listeners sharing the port with SO_REUSEPORT, each with its own accept loop (Linux only)")
 	flag.StringVar(&Flags.UserAgent, "user_agent", "", "Override the User-Agent header for incoming requests. Optional.")
+	flag.Func("upstream_proxy", "Comma-separated upstream proxies to forward requests through", stringList(&Flags.UpstreamProxies))
+	flag.StringVar(&Flags.UpstreamPolicy, "upstream_policy", "round_robin", "How upstream proxies are picked (round_robin, least_latency, sticky_host or sticky_session)")
+	flag.StringVar(&Flags.HealthCheckUrl, "health_check_url", "", "URL fetched through each upstream proxy to check its health. Optional.")
+	flag.IntVar(&Flags.HealthCheckInterval, "health_check_interval", 30, "Seconds between upstream proxy health checks")
+	flag.Func("intercept", "Comma-separated host patterns to intercept, all hosts if unset", stringList(&Flags.Intercept))
+	flag.Func("passthrough", "Comma-separated host patterns to tunnel without interception", stringList(&Flags.Passthrough))
+	flag.BoolVar(&Flags.StreamInjection, "stream_injection", false, "Inject payloads while streaming responses instead of buffering them")
+	flag.IntVar(&Flags.CompressionLevel, "compression_level", 0, "Compression level for re-encoded responses (0 for the encoding's default)")
+	flag.Int64Var(&Flags.InjectCacheSize, "inject_cache_size", 64<<20, "Injection result cache size in bytes (-1 to disable)")
+	flag.IntVar(&Flags.IdleTimeout, "idle_timeout", 90, "Seconds before idle upstream connections are closed")
+	flag.BoolVar(&Flags.MetricsEndpoint, "metrics_endpoint", false, "Serve Prometheus metrics at /metrics on the proxy listener")
+	flag.IntVar(&Flags.MaxIdlePerHost, "max_idle_per_host", 8, "Maximum idle upstream connections kept per host")
+	flag.IntVar(&Flags.MaxConnsPerHost, "max_conns_per_host", 0, "Maximum upstream connections per host and fingerprint (0 for no limit)")
+	flag.IntVar(&Flags.MaxRequests, "max_requests", 0, "Maximum concurrent upstream requests (0 for no limit)")
+	flag.IntVar(&Flags.QueueTimeout, "queue_timeout", 10, "Seconds requests wait for an upstream request slot before they are refused (-1 to refuse right away)")
+	flag.BoolVar(&Flags.ResponseCache, "response_cache", false, "Serve cacheable responses from the shared response cache")
 	flag.StringVar(&api.Config.Cert, "cert", "cert.pem", "TLS CA certificate (generated automatically if not present)")
 	flag.StringVar(&api.Config.Key, "key", "key.pem", "TLS CA key (generated automatically if not present)")
+	flag.StringVar(&api.Config.CAKeyType, "ca_key", "ecdsa", "Key type for a newly generated CA (ecdsa or rsa)")
+	flag.IntVar(&api.Config.CAKeySize, "ca_key_size", 0, "Key size for a newly generated CA (0 for P-256 or 2048-bit RSA)")
+	flag.IntVar(&api.Config.CertCacheSize, "cert_cache_size", 1024, "Maximum number of cached MITM leaf certificates")
+	flag.StringVar(&api.Config.LeafKeyType, "leaf_key", "rsa", "Key type for MITM leaf certificates (rsa or ecdsa)")
+	flag.IntVar(&api.Config.DNSCacheTTL, "dns_cache_ttl", 60, "Seconds upstream DNS lookups are cached (-1 to disable)")
+	flag.IntVar(&api.Config.DNSNegativeTTL, "dns_negative_ttl", 5, "Seconds missing names are cached (-1 to disable)")
+	flag.BoolVar(&api.Config.DNSPrefetch, "dns_prefetch", false, "Refresh cached names that are in use before they expire")
+	flag.IntVar(&api.Config.FallbackDelay, "fallback_delay", 300, "Milliseconds before racing the other address family (-1 to disable)")
+	flag.IntVar(&api.Config.ConnectTimeout, "connect_timeout", 30, "Seconds before an upstream connection attempt fails")
+	flag.IntVar(&api.Config.KeepAlive, "keep_alive", 30, "Seconds between TCP keepalive probes (-1 to disable)")
+	flag.BoolVar(&api.Config.Nagle, "nagle", false, "Leave Nagle's algorithm enabled on upstream connections (disables TCP_NODELAY)")
+	flag.Int64Var(&api.Config.BodyBudget, "body_budget", 256<<20, "Memory budget in bytes for bodies buffered for injection (-1 for no limit)")
+	flag.IntVar(&api.Config.BodyQueueLength, "body_queue_length", 64, "Bodies that may wait for room in the memory budget")
+	flag.IntVar(&api.Config.BodyQueueTimeout, "body_queue_timeout", 2000, "Milliseconds bodies wait for room before they are streamed instead (-1 to stream right away)")
+	flag.Int64Var(&api.Config.ResponseCacheSize, "response_cache_size", 64<<20, "Memory for cached responses in bytes (-1 to disable the memory tier)")
+	flag.StringVar(&api.Config.ResponseCacheDir, "response_cache_dir", "", "Directory for cached responses that don't fit in memory. Optional.")
+	flag.Int64Var(&api.Config.ResponseCacheDiskSize, "response_cache_disk_size", 1<<30, "Disk space for cached responses in bytes")
+	flag.IntVar(&api.Config.MaxProcs, "max_procs", 0, "Maximum CPUs executing Go code at once (0 to leave GOMAXPROCS unchanged)")
+	flag.IntVar(&api.Config.GCPercent, "gc_percent", 0, "GC target as a percentage of live heap growth (0 to leave GOGC unchanged, -1 to disable the GC)")
+	flag.Int64Var(&api.Config.MemoryLimit, "memory_limit", 0, "Soft memory limit in bytes (0 to leave GOMEMLIMIT unchanged, -1 for no limit)")
+	var profiles string
+	flag.StringVar(&profiles, "profiles", "", "JSON file with fingerprint profiles. Optional.")
 	flag.BoolVar(&api.Config.Verbose, "verbose", false, "Enable verbose logging")
 	flag.Parse()
+	// Load fingerprint profiles
+	if profiles != "" {
+		if err := api.LoadProfileFile(profiles); err != nil {
+			log.Fatalf("Failed to load profiles: %v", err)
+		}
+	}
 	// Set ID
 	Flags.Id = "cli"
 	// Set verbose level
 	api.UpdateVerbosity()
+	// Apply the Go runtime settings
+	api.UpdateRuntime()
 	// Launch proxy server
 	api.Launch(&Flags)
 }
+
+// Appends comma-separated values to a list, so the flag can be repeated
+func stringList(list *[]string) func(string) error {
+	return func(value string) error {
+		for _, pattern := range strings.Split(value, ",") {
+			if pattern = strings.TrimSpace(pattern); pattern != "" {
+				*list = append(*list, pattern)
+			}
+		}
+		return nil
+	}
+}
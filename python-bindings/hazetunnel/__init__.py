@@ -1,3 +1,47 @@
-from .control import HazeTunnel, cert, key, set_key_pair, set_verbose, verbose
+from typing import Any
 
-__all__ = ['HazeTunnel', 'cert', 'key', 'set_key_pair', 'set_verbose', 'verbose']
+from .control import (
+    HazeTunnel,
+    cert,
+    cert_cache_stats,
+    key,
+    load_profiles,
+    prewarm,
+    set_cert_cache,
+    set_dialer,
+    set_key_pair,
+    set_memory_budget,
+    set_response_cache,
+    set_runtime,
+    set_verbose,
+    verbose,
+)
+
+__all__ = [
+    'AsyncHazeTunnel',
+    'HazeTunnel',
+    'cert',
+    'cert_cache_stats',
+    'key',
+    'launch_all',
+    'load_profiles',
+    'prewarm',
+    'set_cert_cache',
+    'set_dialer',
+    'set_key_pair',
+    'set_memory_budget',
+    'set_response_cache',
+    'set_runtime',
+    'set_verbose',
+    'stop_all',
+    'verbose',
+]
+
+
+def __getattr__(name: str) -> Any:
+    # The asyncio API is imported on first use, asyncio itself is slow to import
+    if name in ('AsyncHazeTunnel', 'launch_all', 'stop_all'):
+        from . import aio
+
+        return getattr(aio, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -4,6 +4,7 @@ Binary CLI manager for hazetunnel-api.
 Adapted from https://github.com/daijro/hrequests/blob/main/hrequests/__main__.py
 """
 
+import json
 import os
 import re
 import time
@@ -11,13 +12,15 @@ from dataclasses import dataclass
 from functools import total_ordering
 from importlib.metadata import version as pkg_version
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 
 import click
 from hazetunnel.__version__ import BRIDGE_VERSION
-from hazetunnel.cffi import LibraryManager, root_dir
+from hazetunnel.cffi import MANIFEST_NAME, LibraryManager, root_dir
 
 from hazetunnel import HazeTunnel, set_key_pair, set_verbose
+from hazetunnel import cert as default_cert
+from hazetunnel import key as default_key
 
 
 def rprint(*a, **k):
@@ -151,6 +154,7 @@ def remove() -> None:
     for file in (root_dir / 'bin').glob('*.pem'):
         rprint(f"Removed {file}", fg="green")
         file.unlink()
+    (root_dir / 'bin' / MANIFEST_NAME).unlink(missing_ok=True)
     # remove library
     if not os.path.exists(path):
         rprint("Library is not downloaded.", fg="yellow")
@@ -196,29 +200,60 @@ def version() -> None:
 @click.option('--user_agent', type=str, default=None, help="Override User-Agent headers.")
 @click.option('--payload', type=str, default=None, help="Payload to inject into responses.")
 @click.option(
-    '--upstream_proxy', type=str, default=None, help="Forward requests to an upstream proxy."
+    '--upstream_proxy',
+    type=str,
+    multiple=True,
+    help="Forward requests to an upstream proxy. May be repeated.",
+)
+@click.option(
+    '--upstream_policy',
+    type=click.Choice(['round_robin', 'least_latency', 'sticky_host', 'sticky_session']),
+    default='round_robin',
+    help="How upstream proxies are picked.",
 )
 @click.option('--cert', type=str, default=None, help="Path to the certificate file.")
 @click.option('--key', type=str, default=None, help="Path to the key file.")
+@click.option(
+    '--ca_key',
+    type=click.Choice(['ecdsa', 'rsa']),
+    default='ecdsa',
+    help="Key type to generate if the CA doesn't exist.",
+)
+@click.option(
+    '--ca_key_size',
+    type=int,
+    default=0,
+    help="Key size to generate if the CA doesn't exist. Default: P-256 or 2048-bit RSA.",
+)
+@click.option('--metrics', is_flag=True, help="Serve Prometheus metrics at /metrics.")
 @click.option('-v', '--verbose', is_flag=True, help="Enable verbose output.")
 def run(
     port: str,
     user_agent: str,
     payload: str,
-    upstream_proxy: str,
+    upstream_proxy: Tuple[str, ...],
+    upstream_policy: str,
     cert: str,
     key: str,
+    ca_key: str,
+    ca_key_size: int,
+    metrics: bool,
     verbose: bool,
 ) -> None:
     """
     Run the MITM proxy
     """
-    if cert or key:
-        set_key_pair(cert, key)
+    if cert or key or ca_key != 'ecdsa' or ca_key_size:
+        set_key_pair(cert or default_cert(), key or default_key(), ca_key, ca_key_size)
     if verbose:
         set_verbose(True)
     server = HazeTunnel(
-        port=port, payload=payload, user_agent=user_agent, upstream_proxy=upstream_proxy
+        port=port,
+        payload=payload,
+        user_agent=user_agent,
+        upstream_proxy=list(upstream_proxy),
+        upstream_policy=upstream_policy,
+        metrics_endpoint=metrics,
     )
     # wait forever until keyboard interrupt
     server.launch()
@@ -231,5 +266,35 @@ def run(
         server.stop()
 
 
+@cli.command(name='bench')
+@click.option('-n', '--requests', type=int, default=1000, help="Requests per scenario.")
+@click.option('-c', '--concurrency', type=int, default=16, help="Concurrent requests.")
+@click.option('--large_size', type=int, default=4 << 20, help="Size of the large body in bytes.")
+@click.option(
+    '--startup',
+    type=int,
+    default=None,
+    help="Measure cold starts over this many fresh processes instead.",
+)
+@click.option('-o', '--output', type=click.Path(), default=None, help="Write the results to a file.")
+def bench(
+    requests: int, concurrency: int, large_size: int, startup: Optional[int], output: Optional[str]
+) -> None:
+    """
+    Benchmark the proxy against a local origin
+    """
+    from hazetunnel import bench
+
+    if startup:
+        results = json.dumps(bench.startup(startup), indent=2)
+    else:
+        results = json.dumps(bench.run(requests, concurrency, large_size), indent=2)
+    if output:
+        Path(output).write_text(results)
+        rprint(f"Results written to {output}", fg="green")
+    else:
+        print(results)
+
+
 if __name__ == '__main__':
     cli()
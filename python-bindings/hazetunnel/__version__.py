@@ -1,2 +1,2 @@
 # Supported binary version
-BRIDGE_VERSION = '2.'
+BRIDGE_VERSION = '3.'
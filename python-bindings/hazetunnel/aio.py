@@ -0,0 +1,130 @@
+import asyncio
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from .cffi import Library, get_library
+from .control import HazeTunnel
+
+"""
+Hazetunnel may also be managed from asyncio.
+
+Launching and stopping don't block the event loop. The library returns
+immediately and calls back from Go once the server is listening or closed.
+
+from hazetunnel import AsyncHazeTunnel
+...
+async with AsyncHazeTunnel(payload='alert("Hello World!");') as proxy:
+    async with httpx.AsyncClient(proxy=proxy.url, verify=proxy.cert) as client:
+        await client.get('https://tls.peet.ws/api/clean')
+...
+"""
+
+# Completes an async library call by calling its argument with the result
+AsyncCall = Callable[[Callable[[Dict[str, Any]], None]], None]
+
+
+async def _call(
+    start: AsyncCall, on_cancelled: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> Dict[str, Any]:
+    """
+    Runs an async library call and waits for Go to report its result
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result: Dict[str, Any]) -> None:
+        if not future.cancelled():
+            future.set_result(result)
+        elif on_cancelled:
+            on_cancelled(result)
+
+    # The callback runs on a Go thread, hand the result over to the loop
+    start(lambda result: loop.call_soon_threadsafe(resolve, result))
+    return await future
+
+
+async def _get_library() -> Library:
+    """
+    Loads the library in a thread on first use, since it may be downloaded
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, get_library)
+
+
+class AsyncHazeTunnel(HazeTunnel):
+    """
+    HazeTunnel that is launched and stopped without blocking the event loop.
+    Takes the same parameters as HazeTunnel.
+    """
+
+    async def launch(self) -> None:
+        """
+        Launch the server and wait until it is accepting connections
+        """
+        if self.is_running:
+            raise RuntimeError("Server is already running.")
+        lib = await _get_library()
+
+        def stop_orphan(result: Dict[str, Any]) -> None:
+            # The launch was cancelled, but the server started anyway
+            if not result.get('error'):
+                lib.stop_server_async(self.id, 0, lambda _: None)
+
+        result = await _call(
+            lambda on_done: lib.start_server_async(self.options, on_done), stop_orphan
+        )
+        if result.get('error'):
+            raise RuntimeError(f"Failed to start hazetunnel: {result['error']}")
+        self.options['port'] = str(result['port'])
+        self.is_running = True
+
+    async def stop(self, timeout: float = 0) -> int:
+        """
+        Stop the server and wait until it is closed
+
+        Parameters:
+            timeout (float): Seconds to let open connections and tunnels finish.
+                Whatever is still open afterwards is closed.
+
+        Returns the number of connections that had to be closed.
+        """
+        if not self.is_running:
+            raise RuntimeError("Server is not running.")
+        self.is_running = False
+        lib = await _get_library()
+        result = await _call(lambda on_done: lib.stop_server_async(self.id, timeout, on_done))
+        if result.get('error'):
+            raise RuntimeError(f"Failed to stop hazetunnel: {result['error']}")
+        return result['closed']
+
+    """
+    Context manager methods
+    """
+
+    async def __aenter__(self) -> "AsyncHazeTunnel":
+        await self.launch()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.stop()
+
+    def __enter__(self) -> "AsyncHazeTunnel":
+        raise TypeError("AsyncHazeTunnel must be used with 'async with'")
+
+
+async def launch_all(tunnels: Iterable[AsyncHazeTunnel]) -> None:
+    """
+    Launch tunnels concurrently and wait until all of them are accepting connections.
+    If any of them fails, the ones that started are stopped again and the first error is raised.
+    """
+    tunnels = list(tunnels)
+    results = await asyncio.gather(*(tunnel.launch() for tunnel in tunnels), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        await stop_all(tunnels)
+        raise errors[0]
+
+
+async def stop_all(tunnels: Iterable[AsyncHazeTunnel], timeout: float = 0) -> None:
+    """
+    Stop every running tunnel concurrently, letting open connections finish until the timeout
+    """
+    await asyncio.gather(*(tunnel.stop(timeout) for tunnel in tunnels if tunnel.is_running))
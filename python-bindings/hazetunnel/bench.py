@@ -0,0 +1,229 @@
+"""
+End-to-end benchmarks for hazetunnel.
+
+Serves a local HTTP and HTTPS origin, sends traffic to it through a HazeTunnel
+instance, and reports requests per second along with p50/p99 latency.
+The startup benchmark instead measures fresh processes, from importing
+hazetunnel through the first proxied request.
+"""
+
+import json
+import ssl
+import subprocess
+import sys
+import threading
+import time
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from statistics import median
+from typing import Any, Dict, List, Tuple
+
+import httpx
+
+from .control import HazeTunnel
+
+USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
+)
+PAYLOAD = 'alert("Hello world!");'
+
+# Same pages as example/server.py
+js_script = "console.log('Original JavaScript executed.');"
+encoded_js_script = b64encode(js_script.encode()).decode('utf-8')
+html_content = f"""
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Testing Page</title>
+</head>
+<body>
+    <h1>Base64 JavaScript Testing Page</h1>
+    <p>This page includes an embedded base64 encoded JavaScript for testing.</p>
+    <!-- Embedding the JavaScript directly using a data URI scheme -->
+    <script src="data:application/javascript;base64,{encoded_js_script}"></script>
+</body>
+</html>
+"""
+
+
+def make_handler(large_body: bytes):
+    routes: Dict[str, Tuple[str, bytes]] = {
+        '/plain': ('text/plain', b'Hello world!'),
+        '/html': ('text/html; charset=utf-8', html_content.encode()),
+        '/js': ('application/javascript', js_script.encode()),
+        '/large': ('text/html; charset=utf-8', large_body),
+    }
+
+    class OriginHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self) -> None:
+            content_type, body = routes.get(self.path, ('text/plain', b'Not found'))
+            self.send_response(200 if self.path in routes else 404)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_) -> None:
+            pass
+
+    return OriginHandler
+
+
+class Origin:
+    """
+    Local HTTP and HTTPS origin, served from background threads
+    """
+
+    def __init__(self, cert: str, key: str, large_size: int) -> None:
+        # Repeat the test page until it reaches the requested size
+        large_body = html_content.encode() * max(1, large_size // len(html_content))
+        handler = make_handler(large_body)
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.https = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        # The proxy doesn't verify upstream certificates, so its CA can serve TLS here
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.https.socket = context.wrap_socket(self.https.socket, server_side=True)
+
+    def url(self, scheme: str, path: str) -> str:
+        server = self.https if scheme == 'https' else self.http
+        return f'{scheme}://127.0.0.1:{server.server_address[1]}{path}'
+
+    def __enter__(self) -> 'Origin':
+        for server in (self.http, self.https):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        for server in (self.http, self.https):
+            server.shutdown()
+            server.server_close()
+
+
+def percentile(latencies: List[float], q: float) -> float:
+    return latencies[int(q * (len(latencies) - 1))]
+
+
+def run_scenario(client: httpx.Client, url: str, requests: int, concurrency: int) -> Dict[str, Any]:
+    def send(_) -> Tuple[float, bool]:
+        start = time.perf_counter()
+        try:
+            resp = client.get(url, headers={'User-Agent': USER_AGENT})
+            ok = resp.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    # Warm up the connections and caches before measuring
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(send, range(concurrency)))
+        start = time.perf_counter()
+        results = list(pool.map(send, range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, ok in results if ok)
+    errors = len(results) - len(latencies)
+    if not latencies:
+        return {'requests': requests, 'errors': errors}
+    return {
+        'requests': requests,
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run(requests: int = 1000, concurrency: int = 16, large_size: int = 4 << 20) -> Dict[str, Any]:
+    """
+    Run every scenario and return the results
+
+    Parameters:
+        requests (int): Requests per scenario
+        concurrency (int): Concurrent requests
+        large_size (int): Size of the large body in bytes
+    """
+    results: Dict[str, Any] = {}
+    with HazeTunnel(payload=PAYLOAD) as proxy:
+        with Origin(proxy.cert, proxy.key, large_size) as origin:
+            scenarios = {
+                'plain_http': origin.url('http', '/plain'),
+                'mitm_https': origin.url('https', '/plain'),
+                'html_injection': origin.url('https', '/html'),
+                'js_injection': origin.url('https', '/js'),
+                'large_body': origin.url('https', '/large'),
+            }
+            transport = httpx.HTTPTransport(
+                proxy=proxy.url,
+                verify=proxy.cert,
+                limits=httpx.Limits(max_keepalive_connections=concurrency),
+            )
+            with httpx.Client(mounts={'all://': transport}, timeout=30) as client:
+                for name, url in scenarios.items():
+                    results[name] = run_scenario(client, url, requests, concurrency)
+            stats = proxy.stats()
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'large_size': large_size,
+        'results': results,
+        'proxy_stats': stats,
+    }
+
+
+# Runs in a fresh interpreter. Uses urllib so the request doesn't pay for importing httpx.
+STARTUP_SCRIPT = """
+import json, sys, time, urllib.request
+start = time.perf_counter()
+import hazetunnel
+imported = time.perf_counter()
+proxy = hazetunnel.HazeTunnel()
+proxy.launch()
+launched = time.perf_counter()
+opener = urllib.request.build_opener(urllib.request.ProxyHandler({'http': proxy.url}))
+request = urllib.request.Request(sys.argv[1], headers={'User-Agent': sys.argv[2]})
+opener.open(request, timeout=30).read()
+done = time.perf_counter()
+proxy.stop()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'launch_ms': (launched - imported) * 1000,
+    'first_request_ms': (done - launched) * 1000,
+    'total_ms': (done - start) * 1000,
+}))
+"""
+
+
+def startup(runs: int = 10) -> Dict[str, Any]:
+    """
+    Measure cold starts in fresh processes and return the median of each phase
+
+    Parameters:
+        runs (int): Number of processes to start
+    """
+    from . import cert, key, prewarm
+
+    # Generate the CA up front, so every run measures loading the persisted one
+    prewarm()
+    origin = Origin(cert(), key(), 0)
+    samples: List[Dict[str, float]] = []
+    with origin:
+        url = origin.url('http', '/plain')
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT, url, USER_AGENT],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            samples.append(json.loads(output.splitlines()[-1]))
+    return {
+        'runs': runs,
+        'results': {
+            phase: round(median(sample[phase] for sample in samples), 3) for phase in samples[0]
+        },
+    }
@@ -7,20 +7,20 @@ Adapted from https://github.com/daijro/hrequests/blob/main/hrequests/cffi.py
 import ctypes
 import json
 import os
-import socket
-from contextlib import closing
+import threading
+from itertools import count
 from pathlib import Path
 from platform import machine
 from sys import platform
-from typing import Dict, Optional, Tuple
-
-import click
-from httpx import get, stream
+from typing import Any, Callable, Dict, Optional, Tuple
 
 from .__version__ import BRIDGE_VERSION
 
 root_dir: Path = Path(os.path.abspath(os.path.dirname(__file__)))
 
+# Records which library file belongs to this version, so it can be found without a scan
+MANIFEST_NAME = 'manifest.json'
+
 
 # Map machine architecture to hazetunnel-api binary name
 arch_map = {
@@ -64,12 +64,40 @@ class LibraryManager:
         files: list = [file.name for file in self.parent_path.glob('hazetunnel-api-*')]
         return sorted(files, reverse=True)
 
+    def read_manifest(self) -> Optional[str]:
+        try:
+            with open(self.parent_path / MANIFEST_NAME) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        file = manifest.get('file')
+        if (
+            manifest.get('version') == BRIDGE_VERSION
+            and manifest.get('platform') == self.file_cont
+            and file
+            and os.path.exists(self.parent_path / file)
+        ):
+            return file
+        return None
+
+    def write_manifest(self, file: str) -> None:
+        manifest = {'version': BRIDGE_VERSION, 'platform': self.file_cont, 'file': file}
+        try:
+            with open(self.parent_path / MANIFEST_NAME, 'w') as f:
+                json.dump(manifest, f)
+        except OSError:
+            # Read-only installs fall back to scanning bin/ every time
+            pass
+
     def check_library(self) -> str:
+        if file := self.read_manifest():
+            return file
         files: list = self.get_files()
         for file in files:
             if not file.endswith(self.file_ext):
                 continue
             if file.startswith(self.file_pref):
+                self.write_manifest(file)
                 return file
             # delete residual files from previous versions
             os.remove(self.parent_path / file)
@@ -89,6 +117,8 @@ class LibraryManager:
                 return asset['browser_download_url'], asset['name']
 
     def get_releases(self) -> dict:
+        from httpx import get
+
         # pull release assets from github daijro/hazetunnel
         resp = get('https://api.github.com/repos/daijro/hazetunnel/releases')
         if resp.status_code != 200:
@@ -120,6 +150,9 @@ class LibraryManager:
 
     @staticmethod
     def download_exec(fstream, url):
+        import click
+        from httpx import stream
+
         # file downloader with progress bar
         with stream('GET', url, follow_redirects=True) as resp:
             total = int(resp.headers['Content-Length'])
@@ -154,6 +187,10 @@ def gostring(s: str) -> GoString:
     return go_str
 
 
+# Called by Go with the handle of an async call and its JSON result, which must be freed
+CompletionCallback = ctypes.CFUNCTYPE(None, ctypes.c_ulonglong, ctypes.c_void_p)
+
+
 class Library:
     def __init__(self) -> None:
         # Load the shared package
@@ -161,34 +198,173 @@ class Library:
 
         # Global config data
         self._key_pair: Tuple[str, str]
+        # Key type and size used if the key pair has to be generated
+        self._ca_key: Tuple[str, int] = ('ecdsa', 0)
         self._verbose: bool = False
 
         # Extract the exposed functions
         self.library.StartServer.argtypes = [GoString]
+        self.library.StartServerSync.argtypes = [GoString]
+        self.library.StartServerSync.restype = ctypes.c_void_p
         self.library.ShutdownServer.argtypes = [GoString]
+        self.library.DrainServer.argtypes = [GoString]
+        self.library.DrainServer.restype = ctypes.c_void_p
+        self.library.StartServerAsync.argtypes = [GoString, ctypes.c_ulonglong, CompletionCallback]
+        self.library.ShutdownServerAsync.argtypes = [GoString, ctypes.c_ulonglong, CompletionCallback]
         self.library.SetVerbose.argtypes = [GoString]
         self.library.SetKeyPair.argtypes = [GoString]
+        self.library.UpdateSessions.argtypes = [GoString]
+        self.library.UpdateSessions.restype = ctypes.c_void_p
+        self.library.GetStats.argtypes = [GoString]
+        self.library.GetStats.restype = ctypes.c_void_p
+        self.library.DrainAccessLog.argtypes = [GoString]
+        self.library.DrainAccessLog.restype = ctypes.c_void_p
+        self.library.SetCertCache.argtypes = [GoString]
+        self.library.SetDialer.argtypes = [GoString]
+        self.library.SetMemoryBudget.argtypes = [GoString]
+        self.library.SetResponseCache.argtypes = [GoString]
+        self.library.SetRuntime.argtypes = [GoString]
+        self.library.LoadProfiles.argtypes = [GoString]
+        self.library.LoadProfiles.restype = ctypes.c_void_p
+        self.library.GetCertCacheStats.restype = ctypes.c_void_p
+        self.library.PrewarmCA.restype = ctypes.c_void_p
+        self.library.FreeMemory.argtypes = [ctypes.c_void_p]
+
+        # Async calls waiting on Go, resolved through a single callback
+        self._pending: Dict[int, Callable[[Dict[str, Any]], None]] = {}
+        self._pending_lock = threading.Lock()
+        self._handles = count(1)
+        # Keep a reference so the callback isn't garbage collected while Go holds it
+        self._completion = CompletionCallback(self._complete)
 
         # Set the default key pair paths
         bin_path = root_dir / "bin"
         self.key_pair = (str(bin_path / "key.pem"), str(bin_path / "cert.pem"))
 
-    @staticmethod
-    def get_open_port() -> int:
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-            s.bind(('', 0))
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            return s.getsockname()[1]
-
-    def start_server(self, options: Dict[str, str]):
-        # Launch the server
+    def start_server(self, options: Dict[str, Any]) -> Dict[str, Any]:
+        # Launch the server and wait until it is accepting connections
         ref: GoString = gostring(json.dumps(options))
-        self.library.StartServer(ref)
+        result = json.loads(self.read_string(self.library.StartServerSync(ref)))
+        if result.get('error'):
+            raise RuntimeError(f"Failed to start hazetunnel: {result['error']}")
+        return result
+
+    def stop_server(self, id: str, timeout: float = 0) -> Dict[str, Any]:
+        # Stop the server, letting open connections finish until the timeout
+        ref: GoString = gostring(json.dumps({"id": id, "timeout": timeout}))
+        result = json.loads(self.read_string(self.library.DrainServer(ref)))
+        if result.get('error'):
+            raise RuntimeError(f"Failed to stop hazetunnel: {result['error']}")
+        return result
+
+    def start_server_async(
+        self, options: Dict[str, Any], on_done: Callable[[Dict[str, Any]], None]
+    ) -> None:
+        # Launch the server without blocking. on_done is called from a Go thread once it is listening
+        ref: GoString = gostring(json.dumps(options))
+        self.library.StartServerAsync(ref, self._register(on_done), self._completion)
+
+    def stop_server_async(
+        self, id: str, timeout: float, on_done: Callable[[Dict[str, Any]], None]
+    ) -> None:
+        # Stop the server without blocking. on_done is called from a Go thread once it is closed
+        ref: GoString = gostring(json.dumps({"id": id, "timeout": timeout}))
+        self.library.ShutdownServerAsync(ref, self._register(on_done), self._completion)
+
+    def _register(self, on_done: Callable[[Dict[str, Any]], None]) -> int:
+        handle = next(self._handles)
+        with self._pending_lock:
+            self._pending[handle] = on_done
+        return handle
+
+    def _complete(self, handle: int, ptr: Optional[int]) -> None:
+        # Runs on a Go thread. Exceptions can't propagate back to Go, so report them as errors
+        try:
+            result = json.loads(self.read_string(ptr))
+        except Exception as e:
+            result = {'error': str(e)}
+        with self._pending_lock:
+            on_done = self._pending.pop(handle, None)
+        if on_done:
+            try:
+                on_done(result)
+            except Exception:
+                # e.g. the event loop waiting on the result was closed meanwhile
+                pass
+
+    def prewarm(self):
+        # Load the CA ahead of the first launch, generating it if needed
+        result = json.loads(self.read_string(self.library.PrewarmCA()))
+        if result.get('error'):
+            raise RuntimeError(f"Failed to load the CA: {result['error']}")
+
+    def update_sessions(self, id: str, sessions: Dict[str, Dict[str, str]]):
+        # Replace the named sessions of a running server
+        ref: GoString = gostring(json.dumps({"id": id, "sessions": sessions}))
+        result = json.loads(self.read_string(self.library.UpdateSessions(ref)))
+        if result.get('error'):
+            raise ValueError(f"Failed to update sessions: {result['error']}")
+
+    def read_string(self, ptr: Optional[int]) -> str:
+        # Copy a string returned by Go and free the original
+        if not ptr:
+            raise RuntimeError("No data was returned from hazetunnel-api")
+        try:
+            return ctypes.string_at(ptr).decode('utf-8')
+        finally:
+            self.library.FreeMemory(ptr)
 
-    def stop_server(self, id: str):
-        # Stop the server
+    def set_cert_cache(self, size: int, key_type: str):
+        # Configure the MITM leaf certificate cache
+        ref: GoString = gostring(json.dumps({"size": size, "key_type": key_type}))
+        self.library.SetCertCache(ref)
+
+    def set_dialer(self, options: Dict[str, Any]):
+        # Configure the upstream dialer and DNS cache
+        ref: GoString = gostring(json.dumps(options))
+        self.library.SetDialer(ref)
+
+    def set_memory_budget(self, options: Dict[str, Any]):
+        # Configure the memory budget for bodies buffered for injection
+        ref: GoString = gostring(json.dumps(options))
+        self.library.SetMemoryBudget(ref)
+
+    def set_response_cache(self, options: Dict[str, Any]):
+        # Configure the shared response cache
+        ref: GoString = gostring(json.dumps(options))
+        self.library.SetResponseCache(ref)
+
+    def set_runtime(self, options: Dict[str, Any]):
+        # Tune GOMAXPROCS and the GC targets
+        ref: GoString = gostring(json.dumps(options))
+        self.library.SetRuntime(ref)
+
+    def load_profiles(self, options: Dict[str, Any]):
+        # Replace the fingerprint profile registry
+        ref: GoString = gostring(json.dumps(options))
+        result = json.loads(self.read_string(self.library.LoadProfiles(ref)))
+        if result.get('error'):
+            raise ValueError(f"Failed to load profiles: {result['error']}")
+
+    def stats(self, id: str) -> Dict[str, Any]:
+        # Runtime metrics of a running server
         ref: GoString = gostring(id)
-        self.library.ShutdownServer(ref)
+        result = json.loads(self.read_string(self.library.GetStats(ref)))
+        if result.get('error'):
+            raise RuntimeError(result['error'])
+        return result
+
+    def drain_access_log(self, id: str, max: int) -> Dict[str, Any]:
+        # Remove up to max access log records from a running server
+        ref: GoString = gostring(json.dumps({"id": id, "max": max}))
+        result = json.loads(self.read_string(self.library.DrainAccessLog(ref)))
+        if result.get('error'):
+            raise RuntimeError(result['error'])
+        return result
+
+    def cert_cache_stats(self) -> Dict[str, Any]:
+        # Leaf certificate cache counters
+        return json.loads(self.read_string(self.library.GetCertCacheStats()))
 
     """
     Global config data
@@ -213,16 +389,28 @@ class Library:
     def key_pair(self, key_pair: Tuple[str, str]):
         # Set the cert and key pair
         cert, key = self._key_pair = key_pair
-        ref: GoString = gostring(json.dumps({"cert": cert, "key": key}))
+        key_type, key_size = self._ca_key
+        ref: GoString = gostring(
+            json.dumps({"cert": cert, "key": key, "key_type": key_type, "key_size": key_size})
+        )
         self.library.SetKeyPair(ref)
 
+    def set_key_pair(self, key_pair: Tuple[str, str], key_type: str, key_size: int):
+        # Set the cert and key pair, along with the key to generate if they don't exist
+        self._ca_key = (key_type, key_size)
+        self.key_pair = key_pair
+
 
 # Maintain a universal library instance
 _library: Optional[Library] = None
+_library_lock = threading.Lock()
 
 
 def get_library() -> Library:
     global _library
     if _library is None:
-        _library = Library()
+        # Threads loading it at the same time share a single download and load
+        with _library_lock:
+            if _library is None:
+                _library = Library()
     return _library
@@ -1,8 +1,9 @@
 from pathlib import Path
-from typing import Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Union
+from urllib.parse import quote
 from uuid import uuid4
 
-from .cffi import get_library
+from .cffi import Library, get_library
 
 """
 Hazetunnel may also run in a context manager.
@@ -26,7 +27,23 @@ class HazeTunnel:
         port: Optional[str] = None,
         payload: Optional[str] = None,
         user_agent: Optional[str] = None,
-        upstream_proxy: Optional[str] = None,
+        upstream_proxy: Optional[Union[str, List[str]]] = None,
+        upstream_policy: str = 'round_robin',
+        health_check_url: Optional[str] = None,
+        health_check_interval: int = 30,
+        stream_injection: bool = False,
+        sessions: Optional[Dict[str, Dict[str, str]]] = None,
+        metrics_endpoint: bool = False,
+        intercept: Optional[List[str]] = None,
+        passthrough: Optional[List[str]] = None,
+        access_log: bool = False,
+        access_log_size: int = 4096,
+        access_log_sample: float = 1.0,
+        max_requests: int = 0,
+        max_conns_per_host: int = 0,
+        queue_timeout: int = 10,
+        response_cache: bool = False,
+        listeners: int = 1,
     ) -> None:
         """
         HazeTunnel constructor
@@ -35,23 +52,67 @@ class HazeTunnel:
             port (Optional[str]): Specify a port to listen on. Default is random.
             payload (Optional[str]): Payload to inject into responses
             user_agent (Optional[str]): Override user agent
-            upstream_proxy (Optional[str]): Optionally forward requests to an upstream proxy
+            upstream_proxy (Optional[Union[str, List[str]]]): Optionally forward requests to one or more upstream proxies
+            upstream_policy (str): How upstream proxies are picked: round_robin, least_latency,
+                sticky_host or sticky_session
+            health_check_url (Optional[str]): URL fetched through each upstream proxy to check its health
+            health_check_interval (int): Seconds between health checks
+            stream_injection (bool): Inject payloads while streaming responses instead of buffering them
+            sessions (Optional[Dict[str, Dict[str, str]]]): Named sessions with their own
+                payload, user_agent and upstream_proxy. Selected by the proxy username.
+            metrics_endpoint (bool): Serve Prometheus metrics at /metrics on the proxy listener
+            intercept (Optional[List[str]]): Host patterns to intercept. Default is all hosts.
+            passthrough (Optional[List[str]]): Host patterns to tunnel without interception
+            access_log (bool): Record each request, read with access_log_records()
+            access_log_size (int): Records kept until they are read. Newer records are dropped when full.
+            access_log_sample (float): Fraction of requests to record
+            max_requests (int): Concurrent upstream requests, 0 for no limit
+            max_conns_per_host (int): Upstream connections per host and fingerprint, 0 for no limit
+            queue_timeout (int): Seconds requests wait for a free slot before they are refused
+                with 503, -1 to refuse right away
+            response_cache (bool): Serve cacheable responses from the shared cache, see set_response_cache()
+            listeners (int): Listeners sharing the port with SO_REUSEPORT, each with its own
+                accept loop. Only supported on Linux.
         """
         # Generate a ID
         self.id = str(uuid4())
 
+        # Accept a single upstream proxy or a list of them
+        if isinstance(upstream_proxy, str):
+            upstream_proxy = [upstream_proxy]
+
         # Set options
         self.options = {
             "port": port or '',
             "payload": payload or '',
             "user_agent": user_agent or '',
-            "upstream_proxy": upstream_proxy or '',
+            "upstream_proxies": upstream_proxy or [],
+            "upstream_policy": upstream_policy,
+            "health_check_url": health_check_url or '',
+            "health_check_interval": health_check_interval,
+            "stream_injection": stream_injection,
+            "sessions": sessions or {},
+            "metrics_endpoint": metrics_endpoint,
+            "intercept": intercept or [],
+            "passthrough": passthrough or [],
+            "access_log": access_log,
+            "access_log_size": access_log_size,
+            "access_log_sample": access_log_sample,
+            "max_requests": max_requests,
+            "max_conns_per_host": max_conns_per_host,
+            "queue_timeout": queue_timeout,
+            "response_cache": response_cache,
+            "listeners": listeners,
             "id": self.id,
         }
 
-        self.lib = get_library()
         self.is_running = False
 
+    @property
+    def lib(self) -> Library:
+        # Loaded on first use, so constructing a tunnel stays cheap
+        return get_library()
+
     """
     Start/stopping the server
     """
@@ -63,21 +124,25 @@ class HazeTunnel:
         # Raise error if running already
         if self.is_running:
             raise RuntimeError("Server is already running.")
-        # Generate a port if one wasn't passed
-        if not self.options['port']:
-            self.options['port'] = str(self.lib.get_open_port())
-
-        self.lib.start_server(self.options)
+        # Returns once the proxy is listening. A random port is used if one wasn't passed
+        result = self.lib.start_server(self.options)
+        self.options['port'] = str(result['port'])
         self.is_running = True
 
-    def stop(self) -> None:
+    def stop(self, timeout: float = 0) -> int:
         """
         Stop the server
+
+        Parameters:
+            timeout (float): Seconds to let open connections and tunnels finish.
+                Whatever is still open afterwards is closed.
+
+        Returns the number of connections that had to be closed.
         """
         if not self.is_running:
             raise RuntimeError("Server is not running.")
-        self.lib.stop_server(self.id)
         self.is_running = False
+        return self.lib.stop_server(self.id, timeout)['closed']
 
     """
     Configuration
@@ -93,6 +158,52 @@ class HazeTunnel:
             raise RuntimeError("Server is not running.")
         return f"http://127.0.0.1:{self.options['port']}"
 
+    def session_url(self, name: str) -> str:
+        """
+        Returns the URL of the server for a named session
+        """
+        if not self.is_running:
+            raise RuntimeError("Server is not running.")
+        return f"http://{quote(name, safe='')}:@127.0.0.1:{self.options['port']}"
+
+    def set_sessions(self, sessions: Dict[str, Dict[str, str]]) -> None:
+        """
+        Replace the named sessions of the running server
+        """
+        if not self.is_running:
+            raise RuntimeError("Server is not running.")
+        self.lib.update_sessions(self.id, sessions)
+        self.options['sessions'] = sessions
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the runtime metrics of the server
+        """
+        if not self.is_running:
+            raise RuntimeError("Server is not running.")
+        return self.lib.stats(self.id)
+
+    def access_log_records(self, batch_size: int = 1024) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the recorded requests, oldest first, until none are left.
+        Records are fetched from the server in batches of batch_size.
+        """
+        if not self.is_running:
+            raise RuntimeError("Server is not running.")
+        while True:
+            batch = self.lib.drain_access_log(self.id, batch_size)
+            yield from batch['records']
+            if len(batch['records']) < batch_size:
+                return
+
+    def access_log_dropped(self) -> int:
+        """
+        Returns the number of records dropped because the access log was full
+        """
+        if not self.is_running:
+            raise RuntimeError("Server is not running.")
+        return self.lib.drain_access_log(self.id, 0)['dropped']
+
     @property
     def cert(self) -> str:
         """
@@ -154,15 +265,192 @@ Note: These MUST be done before starting the HazeTunnel instance.
 
 
 def set_key_pair(
-    cert_path: Optional[Union[str, Path]], key_path: Optional[Union[str, Path]] = ''
+    cert_path: Optional[Union[str, Path]],
+    key_path: Optional[Union[str, Path]] = '',
+    key_type: str = 'ecdsa',
+    key_size: int = 0,
 ) -> None:
     """
     Set the certificate path
+
+    Parameters:
+        cert_path (Union[str, Path]): Path to the CA certificate
+        key_path (Union[str, Path]): Path to the CA key
+        key_type (str): Key type to generate if the CA doesn't exist yet, "ecdsa" or "rsa"
+        key_size (int): Key size to generate. 256 or 384 for ECDSA, 2048 or more for RSA.
+            Default is 0, which selects P-256 or 2048-bit RSA.
     """
     if not (cert_path or key_path):
         raise ValueError("Either cert and key must be set")
+    if key_type not in ('ecdsa', 'rsa'):
+        raise ValueError("key_type must be 'ecdsa' or 'rsa'")
+    lib = get_library()
+    lib.set_key_pair((str(cert_path), str(key_path)), key_type, key_size)
+
+
+def set_cert_cache(size: int = 1024, key_type: str = 'rsa') -> None:
+    """
+    Configure the MITM leaf certificate cache
+
+    Parameters:
+        size (int): Maximum number of cached leaf certificates
+        key_type (str): Key type for leaf certificates, "rsa" or "ecdsa"
+    """
+    if key_type not in ('rsa', 'ecdsa'):
+        raise ValueError("key_type must be 'rsa' or 'ecdsa'")
+    lib = get_library()
+    lib.set_cert_cache(size, key_type)
+
+
+def set_dialer(
+    dns_cache_ttl: int = 60,
+    dns_negative_ttl: int = 5,
+    dns_prefetch: bool = False,
+    fallback_delay: int = 300,
+    connect_timeout: int = 30,
+    keep_alive: int = 30,
+    nagle: bool = False,
+) -> None:
+    """
+    Configure the upstream dialer and the DNS cache shared by every instance
+
+    Parameters:
+        dns_cache_ttl (int): Seconds lookups are cached, -1 to disable the cache
+        dns_negative_ttl (int): Seconds missing names are cached, -1 to disable
+        dns_prefetch (bool): Refresh names that are in use before they expire
+        fallback_delay (int): Milliseconds before racing the other address family, -1 to disable
+        connect_timeout (int): Seconds before a connection attempt fails
+        keep_alive (int): Seconds between TCP keepalive probes, -1 to disable
+        nagle (bool): Leave Nagle's algorithm enabled instead of setting TCP_NODELAY
+    """
+    lib = get_library()
+    lib.set_dialer(
+        {
+            "dns_cache_ttl": dns_cache_ttl,
+            "dns_negative_ttl": dns_negative_ttl,
+            "dns_prefetch": dns_prefetch,
+            "fallback_delay": fallback_delay,
+            "connect_timeout": connect_timeout,
+            "keep_alive": keep_alive,
+            "nagle": nagle,
+        }
+    )
+
+
+def set_memory_budget(
+    budget: int = 256 << 20,
+    queue_length: int = 64,
+    queue_timeout: int = 2000,
+) -> None:
+    """
+    Configure the memory budget shared by every instance for bodies buffered for injection.
+    Bodies that don't fit wait in a queue, and are injected while streaming if they still don't fit.
+
+    Parameters:
+        budget (int): Bytes of bodies held in memory at once, -1 for no limit
+        queue_length (int): Bodies that may wait for room
+        queue_timeout (int): Milliseconds bodies wait for room, -1 to stream right away
+    """
+    lib = get_library()
+    lib.set_memory_budget(
+        {
+            "budget": budget,
+            "queue_length": queue_length,
+            "queue_timeout": queue_timeout,
+        }
+    )
+
+
+def set_response_cache(
+    size: int = 64 << 20,
+    dir: Optional[str] = None,
+    disk_size: int = 1 << 30,
+) -> None:
+    """
+    Configure the response cache shared by every instance launched with response_cache=True.
+    Responses are stored after injection. Larger bodies, and those evicted from memory, are kept on disk.
+    Previously cached responses are dropped.
+
+    Parameters:
+        size (int): Bytes of responses held in memory, -1 to disable the memory tier
+        dir (Optional[str]): Directory for responses kept on disk. Default is memory only.
+        disk_size (int): Bytes of responses kept on disk
+    """
+    lib = get_library()
+    lib.set_response_cache(
+        {
+            "size": size,
+            "dir": dir or '',
+            "disk_size": disk_size,
+        }
+    )
+
+
+def set_runtime(
+    max_procs: int = 0,
+    gc_percent: int = 0,
+    memory_limit: int = 0,
+) -> None:
+    """
+    Tune the Go runtime that serves every instance in the process.
+    Settings left at 0 are unchanged.
+
+    Parameters:
+        max_procs (int): CPUs executing Go code at once (GOMAXPROCS). Default is every CPU.
+        gc_percent (int): Heap growth in percent before the next collection (GOGC), -1 to disable the GC
+        memory_limit (int): Soft memory limit in bytes (GOMEMLIMIT), -1 for no limit
+    """
+    lib = get_library()
+    lib.set_runtime(
+        {
+            "max_procs": max_procs,
+            "gc_percent": gc_percent,
+            "memory_limit": memory_limit,
+        }
+    )
+
+
+def load_profiles(
+    path: Optional[str] = None,
+    profiles: Optional[Dict[str, Dict[str, Any]]] = None,
+    browsers: Optional[Dict[str, Dict[str, str]]] = None,
+    user_agents: Optional[Dict[str, str]] = None,
+    default: Optional[str] = None,
+) -> None:
+    """
+    Replace the fingerprint profiles used to pick a ClientHello from the User-Agent.
+    Profiles are compiled once and swapped in for every instance, including running ones.
+    The built-in browser table is always included.
+
+    Parameters:
+        path (Optional[str]): JSON file with the other parameters as keys. Overrides them if set.
+        profiles (Optional[Dict[str, Dict[str, Any]]]): Named profiles. Either a utls ClientHelloID
+            as client and version, or a custom spec from a ja3 string and/or cipher_suites,
+            extensions, curves, point_formats, signature_algorithms, alpn and grease.
+        browsers (Optional[Dict[str, Dict[str, str]]]): Profile names by browser and the minimum
+            major version they apply to, "-1" for older versions
+        user_agents (Optional[Dict[str, str]]): Profile names by exact User-Agent
+        default (Optional[str]): Profile for unrecognized User-Agents. Default is Chrome.
+    """
+    lib = get_library()
+    lib.load_profiles(
+        {
+            "path": path or '',
+            "profiles": profiles or {},
+            "browsers": browsers or {},
+            "user_agents": user_agents or {},
+            "default": default or '',
+        }
+    )
+
+
+def prewarm() -> None:
+    """
+    Load the library and the CA ahead of the first launch.
+    The CA is generated and saved if it doesn't exist yet, and reused by later processes.
+    """
     lib = get_library()
-    lib.key_pair = (str(cert_path), str(key_path))
+    lib.prewarm()
 
 
 def set_verbose(option: bool) -> None:
@@ -180,3 +468,4 @@ Global config getters
 cert = lambda: get_library().key_pair[0]
 key = lambda: get_library().key_pair[1]
 verbose = lambda: get_library().verbose
+cert_cache_stats = lambda: get_library().cert_cache_stats()